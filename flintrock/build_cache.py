@@ -0,0 +1,169 @@
+"""
+Caches for things we build on cluster nodes, like Spark distributions built
+from source, so that we don't have to build the same thing twice.
+"""
+import hashlib
+import logging
+import os
+import posixpath
+import shlex
+import urllib.parse
+
+# External modules
+import boto3
+import botocore
+import paramiko
+
+# Flintrock modules
+from .ssh import ssh_check_output
+
+logger = logging.getLogger('flintrock.build_cache')
+
+
+def get_build_cache_key(*, repository: str, commit: str, hadoop_version: str) -> str:
+    """
+    Get the key to cache a Spark build under. The key covers everything that
+    determines what the build produces.
+    """
+    return '{r}/{c}/hadoop{v}'.format(
+        r=hashlib.sha256(repository.encode('utf-8')).hexdigest()[:16],
+        c=commit,
+        v='.'.join(hadoop_version.split('.')[:2]))
+
+
+def get_m2_cache_key(*, repository: str) -> str:
+    """
+    Get the key to cache a node's Maven repository under. Builds of different
+    commits share most of their dependencies, so we don't key this by commit.
+    """
+    return '{r}/m2.tgz'.format(
+        r=hashlib.sha256(repository.encode('utf-8')).hexdigest()[:16])
+
+
+class BuildCache:
+    """
+    This is an abstract class. Implementations of this class store files under
+    keys and move them to and from cluster nodes.
+    """
+
+    def restore(
+            self,
+            *,
+            client: paramiko.client.SSHClient,
+            key: str,
+            remote_path: str) -> bool:
+        """
+        Copy the file cached under the provided key to remote_path on a node.
+        Return False if nothing is cached under the key.
+        """
+        raise NotImplementedError
+
+    def store(
+            self,
+            *,
+            client: paramiko.client.SSHClient,
+            key: str,
+            remote_path: str):
+        """
+        Cache the file at remote_path on a node under the provided key.
+        """
+        raise NotImplementedError
+
+
+class LocalBuildCache(BuildCache):
+    """
+    A cache in a directory on the machine running Flintrock.
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+
+    def get_local_path(self, key: str) -> str:
+        return os.path.join(self.path, *key.split('/'))
+
+    def restore(self, *, client, key, remote_path):
+        local_path = self.get_local_path(key)
+        if not os.path.isfile(local_path):
+            return False
+
+        with client.open_sftp() as sftp:
+            sftp.put(localpath=local_path, remotepath=remote_path)
+        return True
+
+    def store(self, *, client, key, remote_path):
+        local_path = self.get_local_path(key)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+        with client.open_sftp() as sftp:
+            sftp.get(remotepath=remote_path, localpath=local_path + '.part')
+        os.replace(local_path + '.part', local_path)
+
+
+class S3BuildCache(BuildCache):
+    """
+    A cache in S3 or in an S3-compatible store like MinIO.
+
+    Nodes move files to and from the store via presigned URLs, so they don't
+    need credentials of their own.
+    """
+
+    def __init__(self, *, bucket: str, prefix: str, endpoint_url: str=None):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.s3 = boto3.client(service_name='s3', endpoint_url=endpoint_url or None)
+
+    def get_object_key(self, key: str) -> str:
+        return posixpath.join(self.prefix, key) if self.prefix else key
+
+    def get_presigned_url(self, *, method: str, key: str) -> str:
+        return self.s3.generate_presigned_url(
+            ClientMethod=method,
+            Params={
+                'Bucket': self.bucket,
+                'Key': self.get_object_key(key)},
+            ExpiresIn=60 * 60)
+
+    def restore(self, *, client, key, remote_path):
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=self.get_object_key(key))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+                return False
+            raise
+
+        ssh_check_output(
+            client=client,
+            command="""
+                set -e
+                curl --fail --silent --show-error --output {p}.part {u}
+                mv {p}.part {p}
+            """.format(
+                p=shlex.quote(remote_path),
+                u=shlex.quote(self.get_presigned_url(method='get_object', key=key))))
+        return True
+
+    def store(self, *, client, key, remote_path):
+        ssh_check_output(
+            client=client,
+            command="""
+                curl --fail --silent --show-error --upload-file {p} {u}
+            """.format(
+                p=shlex.quote(remote_path),
+                u=shlex.quote(self.get_presigned_url(method='put_object', key=key))))
+
+
+def get_build_cache(location: str, *, endpoint_url: str=None) -> BuildCache:
+    """
+    Get the build cache at the provided location, which is either an S3 URL
+    like s3://bucket/prefix or a local directory.
+
+    endpoint_url lets you point an S3 cache at an S3-compatible store instead.
+    """
+    parsed_location = urllib.parse.urlparse(location)
+    if parsed_location.scheme == 's3':
+        return S3BuildCache(
+            bucket=parsed_location.netloc,
+            prefix=parsed_location.path,
+            endpoint_url=endpoint_url)
+    else:
+        return LocalBuildCache(location)
@@ -7,14 +7,16 @@ import shlex
 import sys
 import time
 import logging
+from collections import namedtuple
 from concurrent.futures import FIRST_EXCEPTION
+from xml.sax.saxutils import escape as xml_escape
 
 # External modules
 import paramiko
 
 # Flintrock modules
 from .ssh import get_ssh_client, ssh_check_output, ssh, SSHKeyPair
-from .exceptions import SSHError
+from .exceptions import Error, SSHError
 
 FROZEN = getattr(sys, 'frozen', False)
 
@@ -25,6 +27,23 @@ else:
 
 SCRIPTS_DIR = os.path.join(THIS_DIR, 'scripts')
 
+# The port cluster nodes serve artifacts like the Spark and Hadoop tarballs
+# on, so that the rest of the cluster doesn't have to download them from
+# the internet.
+ARTIFACT_SERVER_PORT = 8099
+
+# A node leaves this marker in its artifacts directory while it's being set up,
+# so that nodes fetching artifacts from it know it will get them eventually.
+# Must match PENDING_MARKER_NAME in fetch-artifact.py.
+ARTIFACT_PENDING_MARKER_NAME = '.pending'
+
+# Images built with `flintrock build-image` carry a marker listing the services
+# installed on them, so that nodes launched from them can skip installation.
+IMAGE_MARKER_PATH = '/etc/flintrock-image.json'
+# The service settings that determine what gets installed on a node, as
+# opposed to how the installed software gets configured.
+IMAGE_SERVICE_KEYS = ['version', 'hadoop_version', 'download_source', 'git_commit', 'git_repository']
+
 
 logger = logging.getLogger('flintrock.core')
 
@@ -36,6 +55,24 @@ class StorageDirs:
         self.persistent = persistent
 
 
+class NodeTopology(namedtuple('NodeTopology', ['zone', 'placement_group', 'partition'])):
+    """
+    Where a node sits in its provider's network. Services like HDFS use this
+    to place data close to where it's read.
+    """
+    @property
+    def rack(self) -> str:
+        """
+        The rack path that Hadoop should use for this node.
+
+        Hadoop requires all racks in a cluster to be at the same depth, so nodes
+        outside a partitioned placement group still get a second level.
+        """
+        return '/{zone}/{partition}'.format(
+            zone=self.zone or 'default-zone',
+            partition='partition-{p}'.format(p=self.partition) if self.partition else 'default')
+
+
 # TODO: Implement concept of ClusterNode. (?) That way we can
 #       define a cluster as having several nodes, and implement
 #       actions as `for node in nodes: node.action()`.
@@ -77,6 +114,16 @@ class FlintrockCluster:
         """
         raise NotImplementedError
 
+    @property
+    def master_private_ip(self) -> str:
+        """
+        The IP address of the master within the cluster's private network.
+
+        Providers must override this property since it is typically derived from
+        an underlying object, like an EC2 instance.
+        """
+        raise NotImplementedError
+
     @property
     def slave_ips(self) -> 'List[str]':
         """
@@ -87,6 +134,17 @@ class FlintrockCluster:
         """
         raise NotImplementedError
 
+    @property
+    def slave_private_ips(self) -> 'List[str]':
+        """
+        A list of the IP addresses of the slaves within the cluster's private
+        network.
+
+        Providers must override this property since it is typically derived from
+        an underlying object, like an EC2 instance.
+        """
+        raise NotImplementedError
+
     @property
     def slave_hosts(self) -> 'List[str]':
         """
@@ -97,6 +155,17 @@ class FlintrockCluster:
         """
         raise NotImplementedError
 
+    @property
+    def topology(self) -> dict:
+        """
+        A map from each of the cluster's node addresses -- IP addresses and
+        hostnames, public and private -- to the node's topology.
+
+        Providers should override this property if they know how their nodes
+        are laid out. Nodes missing from this map all end up in the same rack.
+        """
+        return {}
+
     @property
     def num_masters(self) -> int:
         """
@@ -280,6 +349,15 @@ class FlintrockCluster:
         """
         pass
 
+    def is_unreachable(self, host: str) -> bool:
+        """
+        Check whether the provider knows the provided host to be unreachable, so
+        that we can stop waiting for SSH to come up on it.
+
+        Providers can override this method if they have a way to tell.
+        """
+        return False
+
     def add_slaves_check(self):
         pass
 
@@ -398,21 +476,44 @@ class FlintrockCluster:
         Copy a file to each node of an existing cluster.
 
         If master_only is True, then copy the file to the master only.
-        """
-        if master_only:
-            target_hosts = [self.master_ip]
-        else:
-            target_hosts = [self.master_ip] + self.slave_ips
 
-        partial_func = functools.partial(
-            copy_file_node,
+        We upload the file to the master only once. From there, every node that
+        has the file copies it to a node that doesn't, so the number of nodes
+        with the file doubles in each round.
+        """
+        copy_file_node(
             user=user,
+            host=self.master_ip,
             identity_file=identity_file,
             local_path=local_path,
             remote_path=remote_path)
-        hosts = target_hosts
 
-        run_against_hosts(partial_func=partial_func, hosts=hosts)
+        if master_only or not self.slave_ips:
+            return
+
+        master_ssh_client = get_ssh_client(
+            user=user,
+            host=self.master_ip,
+            identity_file=identity_file)
+
+        with master_ssh_client:
+            with master_ssh_client.open_sftp() as sftp:
+                sftp.put(
+                    localpath=os.path.join(SCRIPTS_DIR, 'distribute-file.sh'),
+                    remotepath='/tmp/distribute-file.sh')
+                sftp.chmod(path='/tmp/distribute-file.sh', mode=0o755)
+
+            logger.info("[{h}] Distributing file to slaves...".format(h=self.master_ip))
+            ssh_check_output(
+                client=master_ssh_client,
+                command="""
+                    set -e
+                    /tmp/distribute-file.sh {path} {hosts}
+                    rm -f /tmp/distribute-file.sh
+                """.format(
+                    path=shlex.quote(remote_path),
+                    hosts=' '.join(self.slave_private_ips)))
+            logger.info("[{h}] Distribution complete.".format(h=self.master_ip))
 
     def login(
             self,
@@ -431,33 +532,76 @@ class FlintrockCluster:
 def generate_template_mapping(
     *,
     cluster: FlintrockCluster,
+    node_ip: str,
     # If we add additional services later on we may want to refactor
     # this to take a list of services and dynamically pull the service
     # name.
     hadoop_version: str,
-    spark_version: str
+    spark_version: str,
+    spark_worker_layout: tuple=None,
+    hdfs_properties: dict=None
 ) -> dict:
     """
     Generate a template mapping from a FlintrockCluster instance that we can use
     to fill in template parameters.
+
+    node_ip is the IP address we use to reach the node the templates are for.
+    We resolve node-specific values like the node's hostname here, once, so the
+    resulting files don't have to look them up every time they're used.
+
+    If no Spark worker layout is provided, Spark falls back to running a single
+    worker that claims all of a node's cores and memory.
+
+    HDFS properties starting with `dfs.` go into hdfs-site.xml. All others go
+    into core-site.xml.
     """
+    node_index = ([cluster.master_ip] + cluster.slave_ips).index(node_ip)
+    node_host = ([cluster.master_host] + cluster.slave_hosts)[node_index]
+    node_private_ip = ([cluster.master_private_ip] + cluster.slave_private_ips)[node_index]
+
     hadoop_root_dir = posixpath.join(cluster.storage_dirs.root, 'hadoop')
     hadoop_ephemeral_dirs = ','.join(
         posixpath.join(path, 'hadoop')
         for path in cluster.storage_dirs.ephemeral
     )
     spark_root_dir = posixpath.join(cluster.storage_dirs.root, 'spark')
+    spark_packages_dir = posixpath.join(cluster.storage_dirs.root, 'spark-packages')
     spark_ephemeral_dirs = ','.join(
         posixpath.join(path, 'spark')
         for path in cluster.storage_dirs.ephemeral
     )
 
+    if spark_worker_layout:
+        spark_worker_settings = '\n'.join([
+            'export SPARK_WORKER_INSTANCES="{n}"'.format(n=spark_worker_layout.instances),
+            'export SPARK_WORKER_CORES="{c}"'.format(c=spark_worker_layout.cores),
+            'export SPARK_WORKER_MEMORY="{m}m"'.format(m=spark_worker_layout.memory_mb),
+        ])
+    else:
+        spark_worker_settings = ''
+
+    hadoop_topology = '\n'.join(
+        '{address} {rack}'.format(address=address, rack=node_topology.rack)
+        for address, node_topology in sorted(cluster.topology.items()))
+
+    hdfs_site_properties = {}
+    core_site_properties = {}
+    for name, value in (hdfs_properties or {}).items():
+        if name.startswith('dfs.'):
+            hdfs_site_properties[name] = value
+        else:
+            core_site_properties[name] = value
+
     template_mapping = {
         'master_ip': cluster.master_ip,
         'master_host': cluster.master_host,
         'slave_ips': '\n'.join(cluster.slave_ips),
         'slave_hosts': '\n'.join(cluster.slave_hosts),
 
+        'node_ip': node_ip,
+        'node_host': node_host,
+        'node_private_ip': node_private_ip,
+
         'hadoop_version': hadoop_version,
         'hadoop_short_version': '.'.join(hadoop_version.split('.')[:2]),
         'spark_version': spark_version,
@@ -467,6 +611,7 @@ def generate_template_mapping(
         'hadoop_ephemeral_dirs': hadoop_ephemeral_dirs,
         'spark_root_dir': spark_root_dir,
         'spark_ephemeral_dirs': spark_ephemeral_dirs,
+        'spark_packages_dir': spark_packages_dir,
 
         # If ephemeral storage is available, it replaces the root volume, which is
         # typically persistent. We don't want to mix persistent and ephemeral
@@ -474,11 +619,32 @@ def generate_template_mapping(
         # have leftover data, whereas others start fresh.
         'hadoop_root_ephemeral_dirs': hadoop_ephemeral_dirs if hadoop_ephemeral_dirs else hadoop_root_dir,
         'spark_root_ephemeral_dirs': spark_ephemeral_dirs if spark_ephemeral_dirs else spark_root_dir,
+
+        'spark_worker_settings': spark_worker_settings,
+
+        'hadoop_topology': hadoop_topology,
+        'hdfs_site_properties': format_hadoop_properties(hdfs_site_properties),
+        'core_site_properties': format_hadoop_properties(core_site_properties),
     }
 
     return template_mapping
 
 
+def format_hadoop_properties(properties: dict) -> str:
+    """
+    Format a dictionary of Hadoop configuration properties as <property> elements
+    that can go into files like core-site.xml.
+    """
+    return '\n\n'.join(
+        '  <property>\n'
+        '    <name>{name}</name>\n'
+        '    <value>{value}</value>\n'
+        '  </property>'.format(
+            name=xml_escape(name),
+            value=xml_escape(str(value)))
+        for name, value in sorted(properties.items()))
+
+
 # TODO: Cache these files. (?) They are being read potentially tens or
 #       hundreds of times. Maybe it doesn't matter because the files
 #       are so small.
@@ -554,6 +720,247 @@ def ensure_java8(client: paramiko.client.SSHClient):
             """)
 
 
+def tune_os(client: paramiko.client.SSHClient, ephemeral_dirs: list):
+    """
+    Tune OS limits and kernel settings for big data workloads like large
+    Spark shuffles.
+
+    This is safe to run repeatedly. Some of these settings don't survive a
+    reboot, so we reapply them every time the cluster is started.
+    """
+    host = client.get_transport().getpeername()[0]
+    logger.info("[{h}] Tuning OS...".format(h=host))
+
+    ssh_check_output(
+        client=client,
+        command="""
+            set -e
+
+            # Raise open file and process limits for new sessions. We name the file
+            # so that it sorts after any distribution defaults in limits.d.
+            printf '%s\\n' \
+                '* soft nofile 1000000' \
+                '* hard nofile 1000000' \
+                '* soft nproc 65536' \
+                '* hard nproc 65536' \
+                | sudo tee /etc/security/limits.d/99-flintrock.conf > /dev/null
+
+            printf '%s\\n' \
+                'vm.swappiness = 1' \
+                'net.core.somaxconn = 4096' \
+                'net.core.netdev_max_backlog = 16384' \
+                'net.core.rmem_max = 16777216' \
+                'net.core.wmem_max = 16777216' \
+                'net.ipv4.tcp_rmem = 4096 87380 16777216' \
+                'net.ipv4.tcp_wmem = 4096 65536 16777216' \
+                | sudo tee /etc/sysctl.d/99-flintrock.conf > /dev/null
+            sudo sysctl -q -p /etc/sysctl.d/99-flintrock.conf
+
+            # Transparent huge pages cause CPU spikes and long pauses in JVMs.
+            for thp_dir in /sys/kernel/mm/transparent_hugepage /sys/kernel/mm/redhat_transparent_hugepage; do
+                if [ -d "$thp_dir" ]; then
+                    echo never | sudo tee "$thp_dir/enabled" "$thp_dir/defrag" > /dev/null
+                fi
+            done
+
+            # Favor large sequential reads on the ephemeral devices.
+            for dir in {ephemeral_dirs}; do
+                sudo blockdev --setra 4096 "$(findmnt --noheadings --output SOURCE --target "$dir")"
+            done
+        """.format(
+            ephemeral_dirs=' '.join(shlex.quote(d) for d in ephemeral_dirs)))
+
+
+def get_artifacts_dir(cluster: FlintrockCluster) -> str:
+    return posixpath.join(cluster.storage_dirs.root, 'artifacts')
+
+
+def start_artifact_server(client: paramiko.client.SSHClient, cluster: FlintrockCluster):
+    """
+    Serve the artifacts on a node to the rest of the cluster.
+
+    The server shuts itself down once it has been idle for a while, so it's
+    fine to call this whenever new nodes are about to need artifacts.
+    """
+    with client.open_sftp() as sftp:
+        sftp.put(
+            localpath=os.path.join(SCRIPTS_DIR, 'serve-artifacts.py'),
+            remotepath='/tmp/serve-artifacts.py')
+
+    ssh_check_output(
+        client=client,
+        command="""
+            nohup python /tmp/serve-artifacts.py {d} {p} > /dev/null 2>&1 < /dev/null &
+        """.format(
+            d=shlex.quote(get_artifacts_dir(cluster)),
+            p=ARTIFACT_SERVER_PORT))
+
+
+def fetch_artifact(
+        *,
+        client: paramiko.client.SSHClient,
+        cluster: FlintrockCluster,
+        url: str,
+        name: str,
+        extract_dir: str=None,
+        checksum_urls: list=None,
+        seed_timeout: int=None) -> str:
+    """
+    Fetch an artifact like a Spark or Hadoop tarball onto a node and return
+    its path on the node. If extract_dir is provided, the tarball is extracted
+    there as it downloads.
+
+    checksum_urls are the places to look for the artifact's published SHA-512
+    checksum, in order. Nodes other than the master first look for the
+    checksum on their seed, and only look at these URLs if the seed doesn't
+    have it.
+
+    If url is empty, the artifact must already be on the master, or be on its
+    way there, since nodes can only fall back to fetching it from the master.
+    seed_timeout is how many seconds nodes wait for their seed to make the
+    artifact available.
+
+    Nodes form a binary tree rooted at the master. The master fetches the
+    artifact from the provided URL, and every other node fetches it from its
+    parent in the tree, falling back to the provided URL if the parent can't
+    provide it. Every node then serves the artifact to its own children, so no
+    single node has to serve the whole cluster.
+    """
+    host = client.get_transport().getpeername()[0]
+    node_index = ([cluster.master_ip] + cluster.slave_ips).index(host)
+
+    if node_index == 0:
+        seed_url = ''
+        fallback_seed_url = ''
+    else:
+        seed_url = 'http://{m}:{p}'.format(
+            m=([cluster.master_private_ip] + cluster.slave_private_ips)[(node_index - 1) // 2],
+            p=ARTIFACT_SERVER_PORT)
+        # Only the master can produce artifacts without a source, so when a node
+        # added to the cluster later has a parent without the artifact, the
+        # master seeds it instead.
+        if url:
+            fallback_seed_url = ''
+        else:
+            fallback_seed_url = 'http://{m}:{p}'.format(
+                m=cluster.master_private_ip,
+                p=ARTIFACT_SERVER_PORT)
+
+    with client.open_sftp() as sftp:
+        sftp.put(
+            localpath=os.path.join(SCRIPTS_DIR, 'fetch-artifact.py'),
+            remotepath='/tmp/fetch-artifact.py')
+
+    ssh_check_output(
+        client=client,
+        command="""
+            python /tmp/fetch-artifact.py {url} {d} {name} \
+                --seed-url {seed_url} \
+                --fallback-seed-url {fallback_seed_url} \
+                --extract-to {extract_dir} \
+                {seed_timeout_option} \
+                {checksum_url_options}
+        """.format(
+            url=shlex.quote(url),
+            d=shlex.quote(get_artifacts_dir(cluster)),
+            name=shlex.quote(name),
+            seed_url=shlex.quote(seed_url),
+            fallback_seed_url=shlex.quote(fallback_seed_url),
+            extract_dir=shlex.quote(extract_dir or ''),
+            seed_timeout_option='--seed-timeout {t}'.format(t=seed_timeout) if seed_timeout else '',
+            checksum_url_options=' '.join(
+                '--checksum-url ' + shlex.quote(u) for u in checksum_urls or [])))
+
+    return posixpath.join(get_artifacts_dir(cluster), name)
+
+
+def get_image_services(client: paramiko.client.SSHClient) -> list:
+    """
+    Get the services pre-installed on the image a node was launched from, in the
+    same format as the cluster manifest. Return None if the node wasn't launched
+    from an image built by Flintrock.
+    """
+    image_marker = ssh_check_output(
+        client=client,
+        command="""
+            cat {p} 2> /dev/null || true
+        """.format(p=shlex.quote(IMAGE_MARKER_PATH)))
+
+    if image_marker.strip():
+        return json.loads(image_marker)['services']
+    else:
+        return None
+
+
+def check_image_services(*, image_services: list, services: list):
+    """
+    Make sure an image has the services we want installed on it.
+    """
+    def get_image_settings(manifest: dict) -> dict:
+        return {k: v for (k, v) in manifest.items() if k in IMAGE_SERVICE_KEYS}
+
+    installed_services = {
+        name: get_image_settings(manifest)
+        for (name, manifest) in image_services}
+
+    for service in services:
+        name = type(service).__name__
+        if installed_services.get(name) != get_image_settings(service.manifest):
+            raise Error(
+                "The image this cluster was launched from was built with "
+                "different services. Image services: {i}"
+                .format(i=json.dumps(installed_services, sort_keys=True)))
+
+
+def prepare_image_node(
+        *,
+        ssh_client: paramiko.client.SSHClient,
+        services: list,
+        cluster: FlintrockCluster):
+    """
+    Install the provided services on a node that has been set up, and strip it of
+    anything specific to the node or cluster, so that we can build an image from
+    it. Nodes launched from that image then skip installation.
+    """
+    host = ssh_client.get_transport().getpeername()[0]
+
+    for service in services:
+        service.install(
+            ssh_client=ssh_client,
+            cluster=cluster)
+
+    logger.info("[{h}] Preparing node for imaging...".format(h=host))
+
+    image_marker = {
+        'services': [[type(s).__name__, s.manifest] for s in services],
+    }
+    ssh_check_output(
+        client=ssh_client,
+        command="""
+            set -e
+
+            # Artifacts are only useful for distributing the install.
+            rm -rf {artifacts_dir}
+
+            # Each cluster gets its own key pair.
+            rm -f "$HOME/.ssh/id_rsa" "$HOME/.flintrock-manifest.json" "$HOME/.bash_history"
+            grep -v -x -F {public_key} "$HOME/.ssh/authorized_keys" > /tmp/authorized_keys || true
+            cat /tmp/authorized_keys > "$HOME/.ssh/authorized_keys"
+            rm -f /tmp/authorized_keys
+
+            # Storage gets set up again on each node launched from the image, and the
+            # devices may well be different.
+            sudo sed -i -e '\\#   /media/ephemeral#d' -e '\\#   /media/persistent#d' /etc/fstab
+            sudo rm -f /media/tmp
+
+            echo {image_marker} | sudo tee {image_marker_path} > /dev/null
+        """.format(
+            artifacts_dir=shlex.quote(get_artifacts_dir(cluster)),
+            public_key=shlex.quote(cluster.ssh_key_pair.public.strip()),
+            image_marker=shlex.quote(json.dumps(image_marker, indent=4, sort_keys=True)),
+            image_marker_path=shlex.quote(IMAGE_MARKER_PATH)))
+
+
 def setup_node(
         *,
         # Change this to take host, user, and identity_file?
@@ -602,12 +1009,41 @@ def setup_node(
     cluster.storage_dirs.root = storage_dirs['root']
     cluster.storage_dirs.ephemeral = storage_dirs['ephemeral']
 
-    ensure_java8(ssh_client)
+    pending_marker_path = posixpath.join(
+        get_artifacts_dir(cluster),
+        ARTIFACT_PENDING_MARKER_NAME)
+    ssh_check_output(
+        client=ssh_client,
+        command="""
+            mkdir -p {d}
+            touch {m}
+        """.format(
+            d=shlex.quote(get_artifacts_dir(cluster)),
+            m=shlex.quote(pending_marker_path)))
 
-    for service in services:
-        service.install(
-            ssh_client=ssh_client,
-            cluster=cluster)
+    start_artifact_server(ssh_client, cluster)
+
+    try:
+        tune_os(ssh_client, cluster.storage_dirs.ephemeral)
+
+        image_services = get_image_services(ssh_client)
+        if image_services is not None:
+            logger.info("[{h}] Services are pre-installed on this node's image.".format(h=host))
+            check_image_services(image_services=image_services, services=services)
+            return
+
+        ensure_java8(ssh_client)
+
+        for service in services:
+            service.install(
+                ssh_client=ssh_client,
+                cluster=cluster)
+    finally:
+        ssh_check_output(
+            client=ssh_client,
+            command="""
+                rm -f {m}
+            """.format(m=shlex.quote(pending_marker_path)))
 
 
 def provision_cluster(
@@ -687,7 +1123,8 @@ def provision_node(
         user=user,
         host=host,
         identity_file=identity_file,
-        wait=True)
+        wait=True,
+        stop_waiting=functools.partial(cluster.is_unreachable, host))
 
     with client:
         setup_node(
@@ -718,7 +1155,8 @@ def start_node(
         user=user,
         host=host,
         identity_file=identity_file,
-        wait=True)
+        wait=True,
+        stop_waiting=functools.partial(cluster.is_unreachable, host))
 
     with ssh_client:
         # TODO: Consider consolidating ephemeral storage code under a dedicated
@@ -732,6 +1170,8 @@ def start_node(
                     u=user,
                     d=' '.join(cluster.storage_dirs.ephemeral)))
 
+        tune_os(ssh_client, cluster.storage_dirs.ephemeral or [])
+
         for service in services:
             service.configure(
                 ssh_client=ssh_client,
@@ -759,7 +1199,8 @@ def add_slaves_node(
         user=user,
         host=host,
         identity_file=identity_file,
-        wait=is_new_host)
+        wait=is_new_host,
+        stop_waiting=functools.partial(cluster.is_unreachable, host))
 
     with client:
         if is_new_host:
@@ -767,6 +1208,9 @@ def add_slaves_node(
                 ssh_client=client,
                 services=services,
                 cluster=cluster)
+        else:
+            # The new nodes may get their artifacts from this node.
+            start_artifact_server(client, cluster)
 
         for service in services:
             service.configure(
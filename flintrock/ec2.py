@@ -1,6 +1,11 @@
+import concurrent.futures
+import contextlib
 import functools
+import json
+import random
 import string
 import sys
+import threading
 import time
 import urllib.request
 import base64
@@ -11,10 +16,13 @@ from datetime import datetime
 # External modules
 import boto3
 import botocore
+import botocore.config
 import click
 
 # Flintrock modules
 from .core import FlintrockCluster
+from .core import NodeTopology
+from .core import prepare_image_node
 from .core import provision_cluster
 from .exceptions import (
     Error,
@@ -24,11 +32,183 @@ from .exceptions import (
     InterruptedEC2Operation,
     NothingToDo,
 )
-from .ssh import generate_ssh_key_pair
+from .ssh import generate_ssh_key_pair, get_ssh_client
 
 
 logger = logging.getLogger('flintrock.ec2')
 
+# This should be at least as large as the number of threads we call AWS from
+# at once, so that those threads don't wait on each other for connections.
+MAX_POOL_CONNECTIONS = 50
+
+_sessions = {}
+_clients = {}
+_sessions_lock = threading.Lock()
+
+
+def _get_session(region: str) -> boto3.session.Session:
+    """
+    Get the boto3 session for a region.
+
+    Sessions aren't safe to use from multiple threads at once, so callers
+    must hold _sessions_lock.
+    """
+    if region not in _sessions:
+        _sessions[region] = boto3.session.Session(region_name=region)
+    return _sessions[region]
+
+
+def _get_config() -> botocore.config.Config:
+    return botocore.config.Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+
+
+def get_resource(service_name: str, *, region: str):
+    """
+    Get a new boto3 resource for a service in a region.
+
+    Unlike clients, resources aren't thread-safe, so each thread that needs one
+    should get its own. We create them from one session per region, which
+    saves loading the service models and credentials each time.
+    """
+    with _sessions_lock:
+        return _get_session(region).resource(service_name=service_name, config=_get_config())
+
+
+def get_client(service_name: str, *, region: str):
+    """
+    Get a boto3 client for a service in a region.
+
+    Clients are thread-safe, so we create one per region and share it across
+    the whole run.
+    """
+    key = (service_name, region)
+    with _sessions_lock:
+        if key not in _clients:
+            _clients[key] = _get_session(region).client(
+                service_name=service_name,
+                config=_get_config())
+        return _clients[key]
+
+
+# EC2 accepts at most 200 values per filter, so we describe and act on large
+# clusters in batches of this many instances, several batches at a time.
+INSTANCE_BATCH_SIZE = 200
+INSTANCE_BATCH_CONCURRENCY = 8
+
+
+def _map_instance_batches(func, instance_ids: list, *, batch_size: int=INSTANCE_BATCH_SIZE) -> list:
+    """
+    Call func concurrently on batches of the provided instance IDs and return
+    the concatenation of the lists it returns.
+    """
+    batches = [
+        instance_ids[i:i + batch_size]
+        for i in range(0, len(instance_ids), batch_size)]
+    if not batches:
+        return []
+
+    with concurrent.futures.ThreadPoolExecutor(
+            min(len(batches), INSTANCE_BATCH_CONCURRENCY)) as executor:
+        return [
+            result
+            for batch_results in executor.map(func, batches)
+            for result in batch_results]
+
+
+def _filter_instances(ec2, instance_ids: list):
+    # NOTE: We use Filters instead of InstanceIds to avoid
+    #       the issue described here: https://github.com/boto/boto3/issues/479
+    return ec2.instances.filter(
+        Filters=[
+            {'Name': 'instance-id', 'Values': instance_ids}
+        ])
+
+
+def describe_instances(*, instance_ids: list, region: str) -> list:
+    """
+    Get up-to-date metadata for the provided instances.
+
+    Instances that EC2 doesn't know about (yet, or anymore) are left out.
+    """
+    return _map_instance_batches(
+        lambda batch: list(_filter_instances(get_resource('ec2', region=region), batch)),
+        instance_ids)
+
+
+# EC2 throttles API calls per account, so we limit how many calls we make at
+# once for calls we have to make per instance, and back off when throttled.
+THROTTLING_ERROR_CODES = ['RequestLimitExceeded', 'Throttling']
+MAX_THROTTLING_RETRIES = 8
+PER_INSTANCE_CALL_CONCURRENCY = 10
+
+
+def _call_with_backoff(func, **kwargs):
+    """
+    Call an AWS API function, backing off exponentially and retrying if AWS
+    throttles the call.
+    """
+    for attempt in range(MAX_THROTTLING_RETRIES + 1):
+        try:
+            return func(**kwargs)
+        except botocore.exceptions.ClientError as e:
+            if (e.response['Error']['Code'] not in THROTTLING_ERROR_CODES or
+                    attempt == MAX_THROTTLING_RETRIES):
+                raise
+            logger.debug("AWS throttled {f}. Backing off...".format(f=func.__name__))
+            # Jitter keeps the threads we got throttled on from retrying in lockstep.
+            time.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1))
+
+
+def set_security_groups(*, instance_ids: list, region: str, group_ids: list):
+    """
+    Replace the security groups assigned to the provided instances.
+
+    EC2 has no bulk call for this, so we make the per-instance calls
+    concurrently.
+    """
+    client = get_client('ec2', region=region)
+    if not instance_ids:
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(
+            min(len(instance_ids), PER_INSTANCE_CALL_CONCURRENCY)) as executor:
+        list(executor.map(
+            lambda instance_id: _call_with_backoff(
+                client.modify_instance_attribute,
+                InstanceId=instance_id,
+                Groups=group_ids),
+            instance_ids))
+
+
+# DescribeInstanceStatus accepts at most 100 instance IDs per call.
+INSTANCE_STATUS_BATCH_SIZE = 100
+
+
+def get_instance_statuses(*, instance_ids: list, region: str) -> dict:
+    """
+    Get the EC2 status checks for the provided instances, keyed by instance ID.
+    """
+    client = get_client('ec2', region=region)
+    statuses = _map_instance_batches(
+        lambda batch: client.describe_instance_status(
+            InstanceIds=batch,
+            IncludeAllInstances=True)['InstanceStatuses'],
+        instance_ids,
+        batch_size=INSTANCE_STATUS_BATCH_SIZE)
+    return {status['InstanceId']: status for status in statuses}
+
+
+def act_on_instances(*, instance_ids: list, region: str, action: str, **kwargs):
+    """
+    Call an action like 'start' or 'create_tags' on the provided instances.
+    """
+    def act_on_batch(batch):
+        ec2 = get_resource('ec2', region=region)
+        getattr(_filter_instances(ec2, batch), action)(**kwargs)
+        return []
+
+    _map_instance_batches(act_on_batch, instance_ids)
+
 
 class NoDefaultVPC(Error):
     def __init__(self, *, region: str):
@@ -57,6 +237,11 @@ def timeit(func):
     return wrapper
 
 
+# How long to wait between polls for instance state, in seconds.
+WAIT_MIN_INTERVAL = 1
+WAIT_MAX_INTERVAL = 15
+
+
 class EC2Cluster(FlintrockCluster):
     def __init__(
             self,
@@ -71,6 +256,7 @@ class EC2Cluster(FlintrockCluster):
         self.vpc_id = vpc_id
         self.master_instance = master_instance
         self.slave_instances = slave_instances
+        self.impaired_instance_ids = set()
 
     @property
     def instances(self):
@@ -87,14 +273,44 @@ class EC2Cluster(FlintrockCluster):
     def master_host(self):
         return self.master_instance.public_dns_name
 
+    @property
+    def master_private_ip(self):
+        return self.master_instance.private_ip_address
+
     @property
     def slave_ips(self):
         return [i.public_ip_address for i in self.slave_instances]
 
+    @property
+    def slave_private_ips(self):
+        return [i.private_ip_address for i in self.slave_instances]
+
     @property
     def slave_hosts(self):
         return [i.public_dns_name for i in self.slave_instances]
 
+    @property
+    def topology(self):
+        topology = {}
+        for instance in self.instances:
+            node_topology = NodeTopology(
+                zone=instance.placement['AvailabilityZone'],
+                placement_group=instance.placement.get('GroupName') or None,
+                partition=instance.placement.get('PartitionNumber'))
+            addresses = [
+                instance.public_ip_address,
+                instance.public_dns_name,
+                instance.private_ip_address,
+                instance.private_dns_name,
+            ]
+            if instance.private_dns_name:
+                # e.g. ip-10-0-0-1 from ip-10-0-0-1.ec2.internal
+                addresses.append(instance.private_dns_name.split('.')[0])
+            for address in addresses:
+                if address:
+                    topology[address] = node_topology
+        return topology
+
     @property
     def num_masters(self):
         return 1 if self.master_instance else 0
@@ -121,30 +337,119 @@ class EC2Cluster(FlintrockCluster):
         This method updates the cluster's instance metadata and
         master and slave IP addresses and hostnames.
         """
-        ec2 = boto3.resource(service_name='ec2', region_name=self.region)
+        instances = {i.id: i for i in self.instances}
+        pending_ids = [i.id for i in self.instances if i.state['Name'] != state]
+        interval = WAIT_MIN_INTERVAL
 
-        while any([i.state['Name'] != state for i in self.instances]):
+        while pending_ids:
             if logger.isEnabledFor(logging.DEBUG):
-                waiting_instances = [i for i in self.instances if i.state['Name'] != state]
-                sample = ', '.join(["'{}'".format(i.id) for i in waiting_instances][:3])
-                logger.debug("{size} instances not in state '{state}': {sample}, ...".format(size=len(waiting_instances), state=state, sample=sample))
-            time.sleep(3)
-            # Update metadata for all instances in one shot. We don't want
-            # to make a call to AWS for each of potentially hundreds of
-            # instances.
-            instances = list(
-                ec2.instances.filter(
-                    # NOTE: We use Filters instead of InstanceIds to avoid
-                    #       the issue described here: https://github.com/boto/boto3/issues/479
-                    Filters=[
-                        {'Name': 'instance-id', 'Values': [i.id for i in self.instances]}
-                    ]))
-            (self.master_instance, self.slave_instances) = _get_cluster_master_slaves(instances)
+                sample = ', '.join(["'{}'".format(i) for i in pending_ids][:3])
+                logger.debug("{size} instances not in state '{state}': {sample}, ...".format(size=len(pending_ids), state=state, sample=sample))
+            time.sleep(interval)
+            # Only re-query the instances that haven't reached the state yet,
+            # and do it in as few calls to AWS as we can.
+            for instance in describe_instances(instance_ids=pending_ids, region=self.region):
+                instances[instance.id] = instance
+            still_pending_ids = [i for i in pending_ids if instances[i].state['Name'] != state]
+            # Poll quickly while instances are changing state, and back off
+            # while we're waiting on stragglers.
+            if len(still_pending_ids) < len(pending_ids):
+                interval = WAIT_MIN_INTERVAL
+            else:
+                interval = min(interval * 2, WAIT_MAX_INTERVAL)
+            pending_ids = still_pending_ids
+
+        self.master_instance = instances[self.master_instance.id]
+        self.slave_instances = [instances[i.id] for i in self.slave_instances]
+
+    def is_unreachable(self, host: str) -> bool:
+        return any(
+            host in [i.public_ip_address, i.public_dns_name, i.private_ip_address]
+            for i in self.instances
+            if i.id in self.impaired_instance_ids)
+
+    def _poll_status_checks(self, instance_ids: list, stop: threading.Event):
+        """
+        Poll the EC2 status checks of the provided instances until each one's
+        reachability checks have passed or failed, and note the instances that
+        failed in self.impaired_instance_ids.
+        """
+        pending_ids = list(instance_ids)
+        interval = WAIT_MIN_INTERVAL
+
+        while pending_ids and not stop.is_set():
+            try:
+                statuses = get_instance_statuses(instance_ids=pending_ids, region=self.region)
+            except botocore.exceptions.ClientError as e:
+                # Not knowing the status checks just means we wait on SSH as usual.
+                logger.debug("Could not get EC2 status checks: {e}".format(e=e))
+                statuses = {}
+
+            still_pending_ids = []
+            for instance_id in pending_ids:
+                status = statuses.get(instance_id)
+                if not status:
+                    still_pending_ids.append(instance_id)
+                    continue
+                reachability = [
+                    status['SystemStatus']['Status'],
+                    status['InstanceStatus']['Status']]
+                if 'impaired' in reachability:
+                    logger.warning(
+                        "Instance {i} failed its EC2 status checks. "
+                        "Giving up on it.".format(i=instance_id))
+                    self.impaired_instance_ids.add(instance_id)
+                elif reachability != ['ok', 'ok']:
+                    still_pending_ids.append(instance_id)
+
+            logger.debug("{size} instances still being checked by EC2.".format(size=len(still_pending_ids)))
+            if len(still_pending_ids) < len(pending_ids):
+                interval = WAIT_MIN_INTERVAL
+            else:
+                interval = min(interval * 2, WAIT_MAX_INTERVAL)
+            pending_ids = still_pending_ids
+            stop.wait(interval)
+
+    @contextlib.contextmanager
+    def watch_status_checks(self, instances: list=None):
+        """
+        Watch the EC2 status checks of the provided instances, which default to all
+        of the cluster's instances, while we wait for SSH to come up on them.
+
+        Instances get to state 'running' well before they boot, and their status
+        checks only pass a few minutes after they start accepting SSH connections,
+        so we don't wait for the checks to pass. But once an instance fails its
+        reachability checks, SSH will never come up on it, so we stop waiting on it
+        (see is_unreachable()) and report it so it can be replaced.
+        """
+        if instances is None:
+            instances = self.instances
+        stop = threading.Event()
+        watcher = threading.Thread(
+            target=self._poll_status_checks,
+            args=([i.id for i in instances], stop))
+        watcher.daemon = True
+        watcher.start()
+
+        try:
+            yield
+        except Exception as e:
+            stop.set()
+            watcher.join()
+            if self.impaired_instance_ids:
+                raise Error(
+                    "The following instances failed their EC2 status checks and "
+                    "need to be replaced: {i}".format(
+                        i=', '.join(sorted(self.impaired_instance_ids)))) from e
+            raise
+        finally:
+            stop.set()
+            watcher.join()
 
     def destroy(self):
         self.destroy_check()
         super().destroy()
-        ec2 = boto3.resource(service_name='ec2', region_name=self.region)
+        ec2 = get_resource('ec2', region=self.region)
 
         # TODO: Centralize logic to get Flintrock base security group. (?)
         flintrock_base_group = list(
@@ -158,11 +463,10 @@ class EC2Cluster(FlintrockCluster):
         # 'flintrock-clustername' group) so that we can immediately delete it once
         # the instances are terminated. If we don't do this, we get dependency
         # violations for a couple of minutes before we can actually delete the group.
-        # TODO: Is there a way to do this in one call for all instances?
-        #       Do we need to throttle these calls?
-        for instance in self.instances:
-            instance.modify_attribute(
-                Groups=[flintrock_base_group.id])
+        set_security_groups(
+            instance_ids=[i.id for i in self.instances],
+            region=self.region,
+            group_ids=[flintrock_base_group.id])
 
         # TODO: Centralize logic to get cluster security group name from cluster name.
         cluster_group = list(
@@ -173,12 +477,14 @@ class EC2Cluster(FlintrockCluster):
                 ]))[0]
         cluster_group.delete()
 
-        (ec2.instances
-            .filter(
-                Filters=[
-                    {'Name': 'instance-id', 'Values': [i.id for i in self.instances]}
-                ])
-            .terminate())
+        act_on_instances(
+            instance_ids=[i.id for i in self.instances],
+            region=self.region,
+            action='terminate')
+
+        delete_launch_template(
+            name=get_launch_template_name(cluster_name=self.name, vpc_id=self.vpc_id),
+            region=self.region)
 
     def start_check(self):
         if self.state == 'running':
@@ -192,18 +498,16 @@ class EC2Cluster(FlintrockCluster):
     def start(self, *, user: str, identity_file: str):
         # TODO: Do these _check() methods make sense here?
         self.start_check()
-        ec2 = boto3.resource(service_name='ec2', region_name=self.region)
-        (ec2.instances
-            .filter(
-                Filters=[
-                    {'Name': 'instance-id', 'Values': [i.id for i in self.instances]}
-                ])
-            .start())
+        act_on_instances(
+            instance_ids=[i.id for i in self.instances],
+            region=self.region,
+            action='start')
         self.wait_for_state('running')
 
-        super().start(
-            user=user,
-            identity_file=identity_file)
+        with self.watch_status_checks():
+            super().start(
+                user=user,
+                identity_file=identity_file)
 
     def stop_check(self):
         if self.state == 'stopped':
@@ -218,13 +522,10 @@ class EC2Cluster(FlintrockCluster):
         self.stop_check()
         super().stop()
 
-        ec2 = boto3.resource(service_name='ec2', region_name=self.region)
-        (ec2.instances
-            .filter(
-                Filters=[
-                    {'Name': 'instance-id', 'Values': [i.id for i in self.instances]}
-                ])
-            .stop())
+        act_on_instances(
+            instance_ids=[i.id for i in self.instances],
+            region=self.region,
+            action='stop')
         self.wait_for_state('stopped')
 
     def add_slaves_check(self):
@@ -233,17 +534,18 @@ class EC2Cluster(FlintrockCluster):
                 attempted_command='add-slaves',
                 state=self.state)
 
-    @timeit
-    def add_slaves(
+    def _create_instances_like_master(
             self,
             *,
-            user: str,
-            identity_file: str,
-            num_slaves: int,
+            num_instances: int,
             spot_price: float,
             min_root_ebs_size_gb: int,
             tags: list,
-            assume_yes: bool):
+            assume_yes: bool) -> 'List[boto3.resources.factory.ec2.Instance]':
+        """
+        Create instances with the same settings as the master, which we have
+        to look up.
+        """
         security_group_ids = [
             group['GroupId']
             for group in self.master_instance.security_groups]
@@ -253,8 +555,7 @@ class EC2Cluster(FlintrockCluster):
             region=self.region)
         availability_zone = self.master_instance.placement['AvailabilityZone']
 
-        ec2 = boto3.resource(service_name='ec2', region_name=self.region)
-        client = ec2.meta.client
+        client = get_client('ec2', region=self.region)
 
         response = client.describe_instance_attribute(
             InstanceId=self.master_instance.id,
@@ -269,45 +570,78 @@ class EC2Cluster(FlintrockCluster):
         if not response['UserData']:
             user_data = ''
         else:
-            user_data = response['UserData']['Value']
+            # EC2 gives us the user data base64-encoded, but boto3 encodes
+            # whatever user data we give it.
+            user_data = base64.b64decode(response['UserData']['Value']).decode('utf-8')
 
         if not self.master_instance.iam_instance_profile:
             instance_profile_arn = ''
         else:
             instance_profile_arn = self.master_instance.iam_instance_profile['Arn']
 
+        return _create_instances(
+            num_instances=num_instances,
+            region=self.region,
+            spot_price=spot_price,
+            ami=self.master_instance.image_id,
+            assume_yes=assume_yes,
+            key_name=self.master_instance.key_name,
+            instance_type=self.master_instance.instance_type,
+            block_device_mappings=block_device_mappings,
+            availability_zone=availability_zone,
+            placement_group=self.master_instance.placement['GroupName'],
+            tenancy=self.master_instance.placement['Tenancy'],
+            security_group_ids=security_group_ids,
+            subnet_id=self.master_instance.subnet_id,
+            instance_profile_arn=instance_profile_arn,
+            ebs_optimized=self.master_instance.ebs_optimized,
+            instance_initiated_shutdown_behavior=instance_initiated_shutdown_behavior,
+            user_data=user_data,
+            tags=tags)
+
+    @timeit
+    def add_slaves(
+            self,
+            *,
+            user: str,
+            identity_file: str,
+            num_slaves: int,
+            spot_price: float,
+            min_root_ebs_size_gb: int,
+            tags: list,
+            assume_yes: bool):
+        slave_tags = [
+            {'Key': 'flintrock-role', 'Value': 'slave'},
+            {'Key': 'Name', 'Value': '{c}-slave'.format(c=self.name)}]
+        slave_tags += tags
+
         self.add_slaves_check()
+        launch_template_name = get_launch_template_name(
+            cluster_name=self.name,
+            vpc_id=self.vpc_id)
+        new_slave_instances = []
         try:
-            new_slave_instances = _create_instances(
+            new_slave_instances = _create_instances_from_launch_template(
+                launch_template_name=launch_template_name,
                 num_instances=num_slaves,
                 region=self.region,
                 spot_price=spot_price,
-                ami=self.master_instance.image_id,
-                assume_yes=assume_yes,
-                key_name=self.master_instance.key_name,
-                instance_type=self.master_instance.instance_type,
-                block_device_mappings=block_device_mappings,
-                availability_zone=availability_zone,
-                placement_group=self.master_instance.placement['GroupName'],
-                tenancy=self.master_instance.placement['Tenancy'],
-                security_group_ids=security_group_ids,
+                placement=self.master_instance.placement,
                 subnet_id=self.master_instance.subnet_id,
-                instance_profile_arn=instance_profile_arn,
-                ebs_optimized=self.master_instance.ebs_optimized,
-                instance_initiated_shutdown_behavior=instance_initiated_shutdown_behavior,
-                user_data=user_data)
-
-            slave_tags = [
-                {'Key': 'flintrock-role', 'Value': 'slave'},
-                {'Key': 'Name', 'Value': '{c}-slave'.format(c=self.name)}]
-            slave_tags += tags
-
-            (ec2.instances
-                .filter(
-                    Filters=[
-                        {'Name': 'instance-id', 'Values': [i.id for i in new_slave_instances]}
-                    ])
-                .create_tags(Tags=slave_tags))
+                tags=slave_tags,
+                block_device_mappings=get_resized_launch_template_block_device_mappings(
+                    name=launch_template_name,
+                    region=self.region,
+                    min_root_ebs_size_gb=min_root_ebs_size_gb))
+            if new_slave_instances is None:
+                # Clusters launched by older versions of Flintrock don't have
+                # a launch template.
+                new_slave_instances = self._create_instances_like_master(
+                    num_instances=num_slaves,
+                    spot_price=spot_price,
+                    min_root_ebs_size_gb=min_root_ebs_size_gb,
+                    tags=slave_tags,
+                    assume_yes=assume_yes)
 
             existing_slaves = {i.public_ip_address for i in self.slave_instances}
 
@@ -316,10 +650,11 @@ class EC2Cluster(FlintrockCluster):
 
             new_slaves = {i.public_ip_address for i in self.slave_instances} - existing_slaves
 
-            super().add_slaves(
-                user=user,
-                identity_file=identity_file,
-                new_hosts=new_slaves)
+            with self.watch_status_checks(new_slave_instances):
+                super().add_slaves(
+                    user=user,
+                    identity_file=identity_file,
+                    new_hosts=new_slaves)
         except (Exception, KeyboardInterrupt) as e:
             if isinstance(e, InterruptedEC2Operation):
                 cleanup_instances = e.instances
@@ -334,7 +669,7 @@ class EC2Cluster(FlintrockCluster):
 
     @timeit
     def remove_slaves(self, *, user: str, identity_file: str, num_slaves: int):
-        ec2 = boto3.resource(service_name='ec2', region_name=self.region)
+        ec2 = get_resource('ec2', region=self.region)
 
         # self.remove_slaves_check() (?)
 
@@ -357,17 +692,15 @@ class EC2Cluster(FlintrockCluster):
                     {'Name': 'vpc-id', 'Values': [self.vpc_id]},
                 ]))[0]
 
-        # TODO: Is there a way to do this in one call for all instances?
-        for instance in removed_slave_instances:
-            instance.modify_attribute(
-                Groups=[flintrock_base_group.id])
+        set_security_groups(
+            instance_ids=[i.id for i in removed_slave_instances],
+            region=self.region,
+            group_ids=[flintrock_base_group.id])
 
-        (ec2.instances
-            .filter(
-                Filters=[
-                    {'Name': 'instance-id', 'Values': [i.id for i in removed_slave_instances]}
-                ])
-            .terminate())
+        act_on_instances(
+            instance_ids=[i.id for i in removed_slave_instances],
+            region=self.region,
+            action='terminate')
 
     def run_command_check(self):
         if self.state != 'running':
@@ -425,7 +758,7 @@ def get_default_vpc(region: str) -> 'boto3.resources.factory.ec2.Vpc':
     """
     Get the user's default VPC in the provided region.
     """
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
+    ec2 = get_resource('ec2', region=region)
 
     default_vpc = list(
         ec2.vpcs.filter(
@@ -444,7 +777,7 @@ def check_network_config(*, region_name: str, vpc_id: str, subnet_id: str):
 
     Currently, Flintrock requires DNS names and public IPs to be enabled.
     """
-    ec2 = boto3.resource(service_name='ec2', region_name=region_name)
+    ec2 = get_resource('ec2', region=region_name)
 
     if not ec2.Vpc(vpc_id).describe_attribute(Attribute='enableDnsHostnames')['EnableDnsHostnames']['Value']:
         raise ConfigurationNotSupported(
@@ -467,7 +800,7 @@ def get_security_groups(
         vpc_id,
         region,
         security_group_names) -> "List[boto3.resource('ec2').SecurityGroup]":
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
+    ec2 = get_resource('ec2', region=region)
 
     groups = list(
         ec2.security_groups.filter(
@@ -488,24 +821,85 @@ def get_security_groups(
     return groups
 
 
+SecurityGroupRule = namedtuple(
+    'SecurityGroupRule', [
+        'ip_protocol',
+        'from_port',
+        'to_port',
+        'src_group',
+        'cidr_ip'])
+
+
+def _get_rule_ip_permission(rule: SecurityGroupRule) -> dict:
+    ip_permission = {
+        'IpProtocol': rule.ip_protocol,
+        'FromPort': rule.from_port,
+        'ToPort': rule.to_port,
+    }
+    if rule.cidr_ip:
+        ip_permission['IpRanges'] = [{'CidrIp': rule.cidr_ip}]
+    if rule.src_group:
+        ip_permission['UserIdGroupPairs'] = [{'GroupId': rule.src_group}]
+    return ip_permission
+
+
+def get_missing_rules(*, ip_permissions: list, rules: list) -> list:
+    """
+    Get the rules that a security group with the provided IpPermissions
+    doesn't have yet.
+    """
+    existing_rules = set()
+    for ip_permission in ip_permissions:
+        # Rules that cover all protocols don't come with ports.
+        base_rule = SecurityGroupRule(
+            ip_protocol=ip_permission['IpProtocol'],
+            from_port=ip_permission.get('FromPort', -1),
+            to_port=ip_permission.get('ToPort', -1),
+            src_group=None,
+            cidr_ip=None)
+        for ip_range in ip_permission.get('IpRanges', []):
+            existing_rules.add(base_rule._replace(cidr_ip=ip_range['CidrIp']))
+        for group_pair in ip_permission.get('UserIdGroupPairs', []):
+            existing_rules.add(base_rule._replace(src_group=group_pair['GroupId']))
+
+    return [rule for rule in rules if rule not in existing_rules]
+
+
+def _authorize_ingress(group: 'boto3.resources.factory.ec2.SecurityGroup', rules: list):
+    """
+    Authorize any of the provided rules that the group doesn't have yet, in one call.
+    """
+    # Another launch may add some of the same rules between our reading the
+    # group's rules and adding the missing ones, so we try twice.
+    for attempt in range(2):
+        missing_rules = get_missing_rules(
+            ip_permissions=group.ip_permissions,
+            rules=rules)
+        if not missing_rules:
+            return
+        try:
+            group.authorize_ingress(
+                IpPermissions=[_get_rule_ip_permission(r) for r in missing_rules])
+            return
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidPermission.Duplicate' or attempt > 0:
+                raise Exception(
+                    "Error adding rules to group {g}: {r}"
+                    .format(g=group.group_name, r=missing_rules)) from e
+            group.reload()
+
+
 def get_or_create_flintrock_security_groups(
         *,
         cluster_name,
         vpc_id,
-        region) -> "List[boto3.resource('ec2').SecurityGroup]":
+        region,
+        services: list) -> "List[boto3.resource('ec2').SecurityGroup]":
     """
     If they do not already exist, create all the security groups needed for a
-    Flintrock cluster.
+    Flintrock cluster, and make sure they allow access to the provided services.
     """
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
-
-    SecurityGroupRule = namedtuple(
-        'SecurityGroupRule', [
-            'ip_protocol',
-            'from_port',
-            'to_port',
-            'src_group',
-            'cidr_ip'])
+    ec2 = get_resource('ec2', region=region)
 
     # TODO: Make these into methods, since we need this logic (though simple)
     #       in multiple places. (?)
@@ -544,62 +938,19 @@ def get_or_create_flintrock_security_groups(
         .read().decode('utf-8').strip())
     flintrock_client_cidr = '{ip}/32'.format(ip=flintrock_client_ip)
 
-    # TODO: Services should be responsible for registering what ports they want exposed.
+    client_ports = [(22, 22)]  # SSH
+    for service in services:
+        client_ports += service.client_ports
     client_rules = [
-        # SSH
-        SecurityGroupRule(
-            ip_protocol='tcp',
-            from_port=22,
-            to_port=22,
-            cidr_ip=flintrock_client_cidr,
-            src_group=None),
-        # HDFS
-        SecurityGroupRule(
-            ip_protocol='tcp',
-            from_port=50070,
-            to_port=50070,
-            cidr_ip=flintrock_client_cidr,
-            src_group=None),
-        # Spark
         SecurityGroupRule(
             ip_protocol='tcp',
-            from_port=8080,
-            to_port=8081,
-            cidr_ip=flintrock_client_cidr,
-            src_group=None),
-        SecurityGroupRule(
-            ip_protocol='tcp',
-            from_port=4040,
-            to_port=4050,
-            cidr_ip=flintrock_client_cidr,
-            src_group=None),
-        SecurityGroupRule(
-            ip_protocol='tcp',
-            from_port=7077,
-            to_port=7077,
-            cidr_ip=flintrock_client_cidr,
-            src_group=None),
-        # Spark REST Server
-        SecurityGroupRule(
-            ip_protocol='tcp',
-            from_port=6066,
-            to_port=6066,
+            from_port=from_port,
+            to_port=to_port,
             cidr_ip=flintrock_client_cidr,
             src_group=None)
-    ]
+        for (from_port, to_port) in client_ports]
 
-    # TODO: Don't try adding rules that already exist.
-    # TODO: Add rules in one shot.
-    for rule in client_rules:
-        try:
-            flintrock_group.authorize_ingress(
-                IpProtocol=rule.ip_protocol,
-                FromPort=rule.from_port,
-                ToPort=rule.to_port,
-                CidrIp=rule.cidr_ip)
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] != 'InvalidPermission.Duplicate':
-                raise Exception("Error adding rule: {r}".format(r=rule))
+    _authorize_ingress(flintrock_group, client_rules)
 
     # Rules for internal cluster communication.
     if not cluster_group:
@@ -608,18 +959,14 @@ def get_or_create_flintrock_security_groups(
             Description="Flintrock cluster group",
             VpcId=vpc_id)
 
-    try:
-        cluster_group.authorize_ingress(
-            IpPermissions=[
-                {
-                    'IpProtocol': '-1',  # -1 means all
-                    'FromPort': -1,
-                    'ToPort': -1,
-                    'UserIdGroupPairs': [{'GroupId': cluster_group.id}]
-                }])
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] != 'InvalidPermission.Duplicate':
-            raise Exception("Error authorizing cluster ingress to self.") from e
+    _authorize_ingress(
+        cluster_group, [
+            SecurityGroupRule(
+                ip_protocol='-1',  # -1 means all
+                from_port=-1,
+                to_port=-1,
+                src_group=cluster_group.id,
+                cidr_ip=None)])
 
     return [flintrock_group, cluster_group]
 
@@ -634,7 +981,7 @@ def get_ec2_block_device_mappings(
 
     This is how we configure storage on the instance.
     """
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
+    ec2 = get_resource('ec2', region=region)
     block_device_mappings = []
 
     try:
@@ -693,117 +1040,517 @@ def _create_instances(
         instance_profile_arn,
         ebs_optimized,
         instance_initiated_shutdown_behavior,
-        user_data) -> 'List[boto3.resources.factory.ec2.Instance]':
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
+        user_data,
+        tags) -> 'List[boto3.resources.factory.ec2.Instance]':
+    """
+    Create instances with the provided tags.
 
-    cluster_instances = []
-    spot_requests = []
+    We tag instances as part of creating them so that they are never visible to
+    Flintrock without their cluster role.
+    """
+    ec2 = get_resource('ec2', region=region)
+
+    if num_instances == 0:
+        return []
+
+    market_options = {}
+    if spot_price:
+        logger.info("Requesting {c} spot instance{s} at a max price of ${p}...".format(
+            c=num_instances,
+            s='' if num_instances == 1 else 's',
+            p=spot_price))
+        market_options['InstanceMarketOptions'] = {
+            'MarketType': 'spot',
+            'SpotOptions': {
+                'MaxPrice': str(spot_price),
+                'SpotInstanceType': 'one-time',
+                'InstanceInterruptionBehavior': 'terminate'}}
+        # One-time spot instances can't be stopped.
+        instance_initiated_shutdown_behavior = 'terminate'
+    else:
+        # Move this to flintrock.py?
+        logger.info("Launching {c} instance{s}...".format(
+            c=num_instances,
+            s='' if num_instances == 1 else 's'))
 
     try:
-        if spot_price:
-            user_data = base64.b64encode(user_data.encode('utf-8')).decode()
-            logger.info("Requesting {c} spot instances at a max price of ${p}...".format(
-                c=num_instances, p=spot_price))
-            client = ec2.meta.client
-            spot_requests = client.request_spot_instances(
-                SpotPrice=str(spot_price),
-                InstanceCount=num_instances,
-                LaunchSpecification={
-                    'ImageId': ami,
-                    'KeyName': key_name,
-                    'InstanceType': instance_type,
-                    'BlockDeviceMappings': block_device_mappings,
-                    'Placement': {
-                        'AvailabilityZone': availability_zone,
-                        'GroupName': placement_group},
-                    'SecurityGroupIds': security_group_ids,
-                    'SubnetId': subnet_id,
-                    'IamInstanceProfile': {
-                        'Arn': instance_profile_arn},
-                    'EbsOptimized': ebs_optimized,
-                    'UserData': user_data})['SpotInstanceRequests']
-
-            request_ids = [r['SpotInstanceRequestId'] for r in spot_requests]
-            pending_request_ids = request_ids
-
-            while pending_request_ids:
-                logger.info("{grant} of {req} instances granted. Waiting...".format(
-                    grant=num_instances - len(pending_request_ids),
-                    req=num_instances))
-                time.sleep(30)
-                spot_requests = client.describe_spot_instance_requests(
-                    SpotInstanceRequestIds=request_ids)['SpotInstanceRequests']
-
-                failed_requests = [r for r in spot_requests if r['State'] == 'failed']
-                if failed_requests:
-                    failure_reasons = {r['Status']['Code'] for r in failed_requests}
-                    raise Error(
-                        "The spot request failed for the following reason{s}: {reasons}"
-                        .format(
-                            s='' if len(failure_reasons) == 1 else 's',
-                            reasons=', '.join(failure_reasons)))
-
-                pending_request_ids = [
-                    r['SpotInstanceRequestId'] for r in spot_requests
-                    if r['State'] == 'open']
-
-            logger.info("All {c} instances granted.".format(c=num_instances))
-
-            cluster_instances = list(
-                ec2.instances.filter(
-                    Filters=[
-                        {'Name': 'instance-id', 'Values': [r['InstanceId'] for r in spot_requests]}
-                    ]))
-        else:
-            # Move this to flintrock.py?
-            logger.info("Launching {c} instance{s}...".format(
-                c=num_instances,
-                s='' if num_instances == 1 else 's'))
-
-            # TODO: If an exception is raised in here, some instances may be
-            #       left stranded.
-            cluster_instances = ec2.create_instances(
-                MinCount=num_instances,
-                MaxCount=num_instances,
-                ImageId=ami,
-                KeyName=key_name,
-                InstanceType=instance_type,
-                BlockDeviceMappings=block_device_mappings,
-                Placement={
-                    'AvailabilityZone': availability_zone,
-                    'Tenancy': tenancy,
-                    'GroupName': placement_group},
-                SecurityGroupIds=security_group_ids,
-                SubnetId=subnet_id,
-                IamInstanceProfile={
-                    'Arn': instance_profile_arn},
-                EbsOptimized=ebs_optimized,
-                InstanceInitiatedShutdownBehavior=instance_initiated_shutdown_behavior,
-                UserData=user_data)
-        time.sleep(10)  # AWS metadata eventual consistency tax.
-        return cluster_instances
+        # TODO: If we're interrupted while this call is in flight, the
+        #       instances it creates will be left stranded.
+        return ec2.create_instances(
+            MinCount=num_instances,
+            MaxCount=num_instances,
+            ImageId=ami,
+            KeyName=key_name,
+            InstanceType=instance_type,
+            BlockDeviceMappings=block_device_mappings,
+            Placement={
+                'AvailabilityZone': availability_zone,
+                'Tenancy': tenancy,
+                'GroupName': placement_group},
+            SecurityGroupIds=security_group_ids,
+            SubnetId=subnet_id,
+            IamInstanceProfile={
+                'Arn': instance_profile_arn},
+            EbsOptimized=ebs_optimized,
+            InstanceInitiatedShutdownBehavior=instance_initiated_shutdown_behavior,
+            UserData=user_data,
+            TagSpecifications=[
+                {
+                    'ResourceType': 'instance',
+                    'Tags': tags,
+                }],
+            **market_options)
     except (Exception, KeyboardInterrupt) as e:
         if not isinstance(e, KeyboardInterrupt):
             print(e, file=sys.stderr)
-        if spot_requests:
-            request_ids = [r['SpotInstanceRequestId'] for r in spot_requests]
-            if any([r['State'] != 'active' for r in spot_requests]):
-                print("Canceling spot instance requests...", file=sys.stderr)
-                client.cancel_spot_instance_requests(
-                    SpotInstanceRequestIds=request_ids)
-            # Make sure we have the latest information on any launched spot instances.
-            spot_requests = client.describe_spot_instance_requests(
-                SpotInstanceRequestIds=request_ids)['SpotInstanceRequests']
-            instance_ids = [
-                r['InstanceId'] for r in spot_requests
-                if 'InstanceId' in r]
-            if instance_ids:
-                cluster_instances = list(
-                    ec2.instances.filter(
-                        Filters=[
-                            {'Name': 'instance-id', 'Values': instance_ids}
-                        ]))
-        raise InterruptedEC2Operation(instances=cluster_instances) from e
+        # EC2 creates either all of the requested instances or none of them.
+        raise InterruptedEC2Operation(instances=[]) from e
+
+
+# AWS publishes how often spot instances of each type get interrupted, along
+# with how many cores each type has, for its Spot Instance Advisor.
+SPOT_ADVISOR_URL = 'https://spot-bid-advisor.s3.amazonaws.com/spot-advisor-data.json'
+# Spot Advisor interruption frequency ranges go from 0 (<5%) to 4 (>20%).
+MAX_SPOT_INTERRUPTION_RANGE = 1
+
+SpotOption = namedtuple(
+    'SpotOption', [
+        'instance_type',
+        'availability_zone',
+        'price',
+        'cores',
+        'interruption_range'])
+
+
+def get_spot_advisor_data() -> dict:
+    """
+    Get the Spot Instance Advisor's data, or an empty dict if we can't.
+    """
+    try:
+        with urllib.request.urlopen(SPOT_ADVISOR_URL, timeout=10) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except Exception as e:
+        logger.warning(
+            "Could not get spot interruption frequencies. "
+            "Choosing spot instances by price alone. ({e})".format(e=e))
+        return {}
+
+
+def get_spot_prices(*, instance_types: list, region: str) -> dict:
+    """
+    Get the current spot price of each of the provided instance types in each
+    availability zone, keyed by (instance_type, availability_zone).
+    """
+    client = get_client('ec2', region=region)
+
+    def get_instance_type_prices(instance_type):
+        # Asking for prices starting now gets us the current price in each zone.
+        response = client.describe_spot_price_history(
+            InstanceTypes=[instance_type],
+            ProductDescriptions=['Linux/UNIX'],
+            StartTime=datetime.utcnow())
+        return [
+            ((price['InstanceType'], price['AvailabilityZone']), float(price['SpotPrice']))
+            for price in response['SpotPriceHistory']]
+
+    with concurrent.futures.ThreadPoolExecutor(len(instance_types)) as executor:
+        return dict(
+            price
+            for instance_type_prices in executor.map(get_instance_type_prices, instance_types)
+            for price in instance_type_prices)
+
+
+def rank_spot_options(
+        *,
+        spot_prices: dict,
+        spot_advisor_data: dict,
+        region: str,
+        max_price: float) -> list:
+    """
+    Rank the spot options we can afford and that are not interrupted too
+    often, from most to fewest cores per dollar.
+
+    If we don't know how many cores some of the instance types have, e.g. because
+    they're too new for the Spot Instance Advisor, we rank by price alone so that
+    we compare like with like.
+    """
+    instance_type_info = spot_advisor_data.get('instance_types', {})
+    interruption_info = spot_advisor_data.get('spot_advisor', {}).get(region, {}).get('Linux', {})
+
+    spot_options = []
+    for ((instance_type, availability_zone), price) in spot_prices.items():
+        spot_option = SpotOption(
+            instance_type=instance_type,
+            availability_zone=availability_zone,
+            price=price,
+            cores=instance_type_info.get(instance_type, {}).get('cores'),
+            interruption_range=interruption_info.get(instance_type, {}).get('r'))
+        if spot_option.price > max_price:
+            continue
+        if (spot_option.interruption_range is not None and
+                spot_option.interruption_range > MAX_SPOT_INTERRUPTION_RANGE):
+            continue
+        spot_options.append(spot_option)
+
+    if all(o.cores for o in spot_options):
+        return sorted(
+            spot_options,
+            key=lambda o: (o.price / o.cores, o.instance_type, o.availability_zone))
+    else:
+        return sorted(
+            spot_options,
+            key=lambda o: (o.price, o.instance_type, o.availability_zone))
+
+
+def choose_spot_option(*, instance_types: list, region: str, max_price: float) -> SpotOption:
+    """
+    Choose the instance type and availability zone that give us the most cores
+    per dollar for spot instances, with an acceptable risk of interruption.
+    Return None if no option fits.
+    """
+    spot_prices = get_spot_prices(instance_types=instance_types, region=region)
+    spot_advisor_data = get_spot_advisor_data()
+    spot_options = rank_spot_options(
+        spot_prices=spot_prices,
+        spot_advisor_data=spot_advisor_data,
+        region=region,
+        max_price=max_price)
+
+    if not spot_options:
+        logger.warning(
+            "None of the spot options for {t} are under ${p} with an acceptable "
+            "interruption frequency. Leaving the choice of availability zone to EC2."
+            .format(t=', '.join(instance_types), p=max_price))
+        return None
+
+    interruption_labels = {
+        r['index']: r['label']
+        for r in spot_advisor_data.get('ranges', [])}
+    for spot_option in spot_options[1:]:
+        logger.debug("Passed over spot option: {o}".format(o=spot_option))
+    spot_option = spot_options[0]
+    num_over_max_price = len([p for p in spot_prices.values() if p > max_price])
+    num_interrupted_too_often = len(spot_prices) - len(spot_options) - num_over_max_price
+    logger.info(
+        "Picked {t} in {z} for spot instances: ${p}/hour for {c} cores, "
+        "interruption frequency {i}. Passed over {n} option{s} that cost more{per_core}. "
+        "Left out {m} option{ms} over ${max_price} and {r} that get interrupted too often."
+        .format(
+            t=spot_option.instance_type,
+            z=spot_option.availability_zone,
+            p=spot_option.price,
+            c=spot_option.cores or 'unknown',
+            i=interruption_labels.get(spot_option.interruption_range, 'unknown'),
+            n=len(spot_options) - 1,
+            s='' if len(spot_options) == 2 else 's',
+            per_core=' per core' if all(o.cores for o in spot_options) else '',
+            m=num_over_max_price,
+            ms='' if num_over_max_price == 1 else 's',
+            max_price=max_price,
+            r=num_interrupted_too_often))
+    return spot_option
+
+
+def _get_launch_template_data(
+        *,
+        ami,
+        key_name,
+        instance_type,
+        block_device_mappings,
+        placement_group,
+        tenancy,
+        security_group_ids,
+        instance_profile_arn,
+        ebs_optimized,
+        instance_initiated_shutdown_behavior,
+        user_data,
+        tags) -> dict:
+    """
+    Get the launch template data equivalent to the provided instance settings.
+    """
+    launch_template_data = {
+        'ImageId': ami,
+        'KeyName': key_name,
+        'InstanceType': instance_type,
+        'BlockDeviceMappings': block_device_mappings,
+        'Placement': {'Tenancy': tenancy},
+        'SecurityGroupIds': security_group_ids,
+        'EbsOptimized': ebs_optimized,
+        'InstanceInitiatedShutdownBehavior': instance_initiated_shutdown_behavior,
+        # Unlike create_instances(), launch templates don't encode user data for us.
+        'UserData': base64.b64encode(user_data.encode('utf-8')).decode('utf-8'),
+        'TagSpecifications': [
+            {
+                'ResourceType': 'instance',
+                'Tags': tags,
+            }],
+    }
+    if placement_group:
+        launch_template_data['Placement']['GroupName'] = placement_group
+    if instance_profile_arn:
+        launch_template_data['IamInstanceProfile'] = {'Arn': instance_profile_arn}
+    return launch_template_data
+
+
+def get_launch_template_name(*, cluster_name: str, vpc_id: str) -> str:
+    """
+    Get the name of the launch template that holds the settings for a cluster's
+    slaves. Cluster names are only unique within a VPC.
+    """
+    return 'flintrock-{c}-{v}'.format(c=cluster_name, v=vpc_id)
+
+
+def create_launch_template(*, name: str, launch_template_data: dict, region: str):
+    client = get_client('ec2', region=region)
+    # A launch that failed badly enough may have left its template behind.
+    delete_launch_template(name=name, region=region)
+    client.create_launch_template(
+        LaunchTemplateName=name,
+        LaunchTemplateData=launch_template_data)
+
+
+def delete_launch_template(*, name: str, region: str):
+    client = get_client('ec2', region=region)
+    try:
+        client.delete_launch_template(LaunchTemplateName=name)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidLaunchTemplateName.NotFoundException':
+            raise
+
+
+def get_resized_launch_template_block_device_mappings(
+        *,
+        name: str,
+        region: str,
+        min_root_ebs_size_gb: int) -> 'List[dict]':
+    """
+    Get the block device mappings of the provided launch template with the root
+    EBS volume grown to the provided minimum size.
+
+    Return None if the template's root volume is already big enough, or if there
+    is no launch template with the provided name.
+    """
+    client = get_client('ec2', region=region)
+    try:
+        response = client.describe_launch_template_versions(
+            LaunchTemplateName=name,
+            Versions=['$Latest'])
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidLaunchTemplateName.NotFoundException':
+            return None
+        raise
+
+    block_device_mappings = (
+        response['LaunchTemplateVersions'][0]['LaunchTemplateData']
+        .get('BlockDeviceMappings', []))
+    root_devices = [device for device in block_device_mappings if 'Ebs' in device]
+    if not root_devices or root_devices[0]['Ebs']['VolumeSize'] >= min_root_ebs_size_gb:
+        return None
+
+    root_devices[0]['Ebs'].update({
+        'VolumeSize': min_root_ebs_size_gb,
+        'VolumeType': 'gp2'})
+    return block_device_mappings
+
+
+def _create_instances_from_launch_template(
+        *,
+        launch_template_name: str,
+        num_instances: int,
+        region: str,
+        spot_price: float,
+        placement: dict,
+        subnet_id: str,
+        tags: list,
+        block_device_mappings: list=None) -> 'List[boto3.resources.factory.ec2.Instance]':
+    """
+    Create instances from a launch template in one call, overriding only the
+    settings that can change over the life of a cluster.
+
+    Return None if there is no launch template with the provided name.
+    """
+    ec2 = get_resource('ec2', region=region)
+
+    options = {}
+    if block_device_mappings:
+        options['BlockDeviceMappings'] = block_device_mappings
+    if spot_price:
+        options['InstanceMarketOptions'] = {
+            'MarketType': 'spot',
+            'SpotOptions': {
+                'MaxPrice': str(spot_price),
+                'SpotInstanceType': 'one-time',
+                'InstanceInterruptionBehavior': 'terminate'}}
+        # One-time spot instances can't be stopped.
+        options['InstanceInitiatedShutdownBehavior'] = 'terminate'
+    if subnet_id:
+        options['SubnetId'] = subnet_id
+
+    logger.info("Launching {c} instance{s}{spot}...".format(
+        c=num_instances,
+        s='' if num_instances == 1 else 's',
+        spot=' as spot instances' if spot_price else ''))
+
+    try:
+        return ec2.create_instances(
+            LaunchTemplate={
+                'LaunchTemplateName': launch_template_name,
+                'Version': '$Latest',
+            },
+            MinCount=num_instances,
+            MaxCount=num_instances,
+            # Settings we pass here replace the launch template's settings
+            # wholesale, so we pass the whole placement.
+            Placement={
+                k: v for (k, v) in placement.items()
+                if k in ['AvailabilityZone', 'GroupName', 'Tenancy']},
+            TagSpecifications=[
+                {
+                    'ResourceType': 'instance',
+                    'Tags': tags,
+                }],
+            **options)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidLaunchTemplateName.NotFoundException':
+            return None
+        print(e, file=sys.stderr)
+        raise InterruptedEC2Operation(instances=[]) from e
+    except KeyboardInterrupt as e:
+        raise InterruptedEC2Operation(instances=[]) from e
+
+
+def _create_fleet_instances(
+        *,
+        num_units: int,
+        region: str,
+        spot_price: float,
+        fleet_instance_types: list,
+        fleet_subnet_ids: list,
+        availability_zone: str,
+        subnet_id: str,
+        launch_template_data: dict) -> 'List[boto3.resources.factory.ec2.Instance]':
+    """
+    Get spot instances adding up to the provided number of units of capacity from
+    an EC2 Fleet that can choose among several instance types and subnets.
+
+    fleet_instance_types is a list of (instance_type, weight) pairs, where the
+    weight is how many units of capacity an instance of that type counts as.
+    spot_price is the max price we'll pay per unit.
+    """
+    client = get_client('ec2', region=region)
+
+    if fleet_subnet_ids:
+        placements = [{'SubnetId': s} for s in fleet_subnet_ids]
+    elif subnet_id:
+        placements = [{'SubnetId': subnet_id}]
+    elif availability_zone:
+        placements = [{'AvailabilityZone': availability_zone}]
+    else:
+        placements = [{}]
+
+    weights = dict(fleet_instance_types)
+    overrides = [
+        dict(
+            placement,
+            InstanceType=instance_type,
+            WeightedCapacity=float(weight),
+            MaxPrice=str(spot_price * weight))
+        for (instance_type, weight) in fleet_instance_types
+        for placement in placements]
+
+    logger.info(
+        "Requesting {u} units of spot capacity across {t} from an EC2 Fleet...".format(
+            u=num_units,
+            t=', '.join(instance_type for (instance_type, _) in fleet_instance_types)))
+
+    # EC2 Fleet only takes instance settings through a launch template.
+    launch_template = client.create_launch_template(
+        LaunchTemplateName='flintrock-fleet-{t}'.format(t=int(time.time() * 1000)),
+        LaunchTemplateData=launch_template_data)['LaunchTemplate']
+
+    instance_ids = []
+    try:
+        response = client.create_fleet(
+            Type='instant',
+            LaunchTemplateConfigs=[
+                {
+                    'LaunchTemplateSpecification': {
+                        'LaunchTemplateId': launch_template['LaunchTemplateId'],
+                        'Version': '$Latest',
+                    },
+                    'Overrides': overrides,
+                }],
+            TargetCapacitySpecification={
+                'TotalTargetCapacity': num_units,
+                'DefaultTargetCapacityType': 'spot',
+            },
+            SpotOptions={
+                # Pick the pools least likely to be interrupted.
+                'AllocationStrategy': 'capacity-optimized',
+            })
+
+        fulfilled_units = 0
+        for fleet_instances in response.get('Instances', []):
+            instance_ids += fleet_instances['InstanceIds']
+            fulfilled_units += (
+                weights[fleet_instances['LaunchTemplateAndOverrides']['Overrides']['InstanceType']] *
+                len(fleet_instances['InstanceIds']))
+
+        if fulfilled_units < num_units:
+            error_messages = sorted({e['ErrorMessage'] for e in response.get('Errors', [])})
+            raise Error(
+                "The fleet could only provide {f} of {n} units of capacity. {e}".format(
+                    f=fulfilled_units,
+                    n=num_units,
+                    e=' '.join(error_messages)))
+
+        logger.info("Got {c} instances from the fleet.".format(c=len(instance_ids)))
+        return _get_new_instances(instance_ids=instance_ids, region=region)
+    except (Exception, KeyboardInterrupt) as e:
+        if not isinstance(e, KeyboardInterrupt):
+            print(e, file=sys.stderr)
+        raise InterruptedEC2Operation(
+            instances=_get_new_instances(instance_ids=instance_ids, region=region)) from e
+    finally:
+        client.delete_launch_template(LaunchTemplateId=launch_template['LaunchTemplateId'])
+
+
+def _get_new_instances(*, instance_ids: list, region: str) -> list:
+    """
+    Get instances we just created by ID. It can take a few seconds for new
+    instances to show up when you describe them.
+    """
+    instances = []
+    for _ in range(10):
+        instances = describe_instances(instance_ids=instance_ids, region=region)
+        if len(instances) == len(instance_ids):
+            break
+        time.sleep(2)
+    return instances
+
+
+def cli_validate_fleet_instance_types(ctx, param, value):
+    try:
+        return validate_fleet_instance_types(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def validate_fleet_instance_types(value) -> list:
+    """
+    Parse instance types given as 'type' or 'type:weight' into
+    (instance_type, weight) pairs. The weight defaults to 1.
+    """
+    fleet_instance_types = []
+    for fleet_instance_type in value:
+        instance_type, separator, weight = fleet_instance_type.partition(':')
+        if not instance_type or (separator and not weight.isdigit()) or weight == '0':
+            raise ValueError(
+                "Fleet instance types need to be specified as 'type' or 'type:weight', "
+                "where the weight is a positive whole number. Got: {t}"
+                .format(t=fleet_instance_type))
+        fleet_instance_types.append((instance_type, int(weight or 1)))
+    return fleet_instance_types
 
 
 @timeit
@@ -831,9 +1578,20 @@ def launch(
         ebs_optimized=False,
         instance_initiated_shutdown_behavior='stop',
         user_data,
-        tags):
+        tags,
+        fleet_instance_types: list=[],
+        fleet_subnet_ids: list=[],
+        candidate_instance_types: list=[]):
     """
     Launch a cluster.
+
+    If fleet_instance_types is provided, we get the slaves as spot instances from
+    an EC2 Fleet instead, and num_slaves counts units of capacity. See
+    _create_fleet_instances().
+
+    For spot instances, if no availability zone or subnet is provided, we pick
+    the availability zone and, among instance_type and candidate_instance_types,
+    the instance type that give us the most cores per dollar.
     """
     if not vpc_id:
         vpc_id = get_default_vpc(region=region).id
@@ -859,10 +1617,20 @@ def launch(
                 r=region,
                 v=vpc_id))
 
+    if spot_price and not (availability_zone or subnet_id or fleet_instance_types):
+        spot_option = choose_spot_option(
+            instance_types=[instance_type] + list(candidate_instance_types),
+            region=region,
+            max_price=spot_price)
+        if spot_option:
+            instance_type = spot_option.instance_type
+            availability_zone = spot_option.availability_zone
+
     flintrock_security_groups = get_or_create_flintrock_security_groups(
         cluster_name=cluster_name,
         vpc_id=vpc_id,
-        region=region)
+        region=region,
+        services=services)
     user_security_groups = get_security_groups(
         vpc_id=vpc_id,
         region=region,
@@ -873,8 +1641,7 @@ def launch(
         ami=ami,
         region=region)
 
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
-    iam = boto3.resource(service_name='iam', region_name=region)
+    iam = get_resource('iam', region=region)
 
     # We use IAM profile ARNs internally because AWS's API prefers that in
     # a few places.
@@ -884,58 +1651,98 @@ def launch(
     else:
         instance_profile_arn = ''
 
-    num_instances = num_slaves + 1
     if user_data is not None:
         user_data = user_data.read()
     else:
         user_data = ''
 
-    try:
-        cluster_instances = _create_instances(
-            num_instances=num_instances,
-            region=region,
-            spot_price=spot_price,
-            ami=ami,
-            assume_yes=assume_yes,
-            key_name=key_name,
-            instance_type=instance_type,
-            block_device_mappings=block_device_mappings,
-            availability_zone=availability_zone,
-            placement_group=placement_group,
-            tenancy=tenancy,
-            security_group_ids=security_group_ids,
-            subnet_id=subnet_id,
-            instance_profile_arn=instance_profile_arn,
-            ebs_optimized=ebs_optimized,
-            instance_initiated_shutdown_behavior=instance_initiated_shutdown_behavior,
-            user_data=user_data)
-
-        master_instance = cluster_instances[0]
-        slave_instances = cluster_instances[1:]
-
-        master_tags = [
-            {'Key': 'flintrock-role', 'Value': 'master'},
-            {'Key': 'Name', 'Value': '{c}-master'.format(c=cluster_name)}]
-        master_tags += tags
-
-        (ec2.instances
-            .filter(
-                Filters=[
-                    {'Name': 'instance-id', 'Values': [master_instance.id]}
-                ])
-            .create_tags(Tags=master_tags))
+    master_tags = [
+        {'Key': 'flintrock-role', 'Value': 'master'},
+        {'Key': 'Name', 'Value': '{c}-master'.format(c=cluster_name)}]
+    master_tags += tags
 
-        slave_tags = [
-            {'Key': 'flintrock-role', 'Value': 'slave'},
-            {'Key': 'Name', 'Value': '{c}-slave'.format(c=cluster_name)}]
-        slave_tags += tags
+    slave_tags = [
+        {'Key': 'flintrock-role', 'Value': 'slave'},
+        {'Key': 'Name', 'Value': '{c}-slave'.format(c=cluster_name)}]
+    slave_tags += tags
 
-        (ec2.instances
-            .filter(
-                Filters=[
-                    {'Name': 'instance-id', 'Values': [i.id for i in slave_instances]}
-                ])
-            .create_tags(Tags=slave_tags))
+    create_instances = functools.partial(
+        _create_instances,
+        region=region,
+        spot_price=spot_price,
+        ami=ami,
+        assume_yes=assume_yes,
+        key_name=key_name,
+        instance_type=instance_type,
+        block_device_mappings=block_device_mappings,
+        availability_zone=availability_zone,
+        placement_group=placement_group,
+        tenancy=tenancy,
+        security_group_ids=security_group_ids,
+        subnet_id=subnet_id,
+        instance_profile_arn=instance_profile_arn,
+        ebs_optimized=ebs_optimized,
+        instance_initiated_shutdown_behavior=instance_initiated_shutdown_behavior,
+        user_data=user_data)
+
+    launch_template_name = get_launch_template_name(cluster_name=cluster_name, vpc_id=vpc_id)
+    cluster_instances = []
+    try:
+        # We keep the settings for the cluster's slaves in a launch template, so
+        # that adding slaves later doesn't have to work them out again.
+        create_launch_template(
+            name=launch_template_name,
+            launch_template_data=_get_launch_template_data(
+                ami=ami,
+                key_name=key_name,
+                instance_type=instance_type,
+                block_device_mappings=block_device_mappings,
+                placement_group=placement_group,
+                tenancy=tenancy,
+                security_group_ids=security_group_ids,
+                instance_profile_arn=instance_profile_arn,
+                ebs_optimized=ebs_optimized,
+                instance_initiated_shutdown_behavior=instance_initiated_shutdown_behavior,
+                user_data=user_data,
+                tags=slave_tags),
+            region=region)
+
+        # The master and slaves get different tags, so we create them separately.
+        (master_instance,) = create_instances(num_instances=1, tags=master_tags)
+        cluster_instances += [master_instance]
+        # Unless told otherwise, EC2 picks a default subnet for each call on its
+        # own, so we put the slaves in the master's subnet to keep the cluster in
+        # one availability zone.
+        subnet_id = master_instance.subnet_id
+        if fleet_instance_types:
+            slave_instances = _create_fleet_instances(
+                num_units=num_slaves,
+                region=region,
+                spot_price=spot_price,
+                fleet_instance_types=fleet_instance_types,
+                fleet_subnet_ids=fleet_subnet_ids,
+                availability_zone=availability_zone,
+                subnet_id=subnet_id,
+                launch_template_data=_get_launch_template_data(
+                    ami=ami,
+                    key_name=key_name,
+                    instance_type=instance_type,
+                    block_device_mappings=block_device_mappings,
+                    placement_group=placement_group,
+                    tenancy=tenancy,
+                    security_group_ids=security_group_ids,
+                    instance_profile_arn=instance_profile_arn,
+                    ebs_optimized=ebs_optimized,
+                    # Spot instances from a fleet can't be stopped.
+                    instance_initiated_shutdown_behavior='terminate',
+                    user_data=user_data,
+                    tags=slave_tags))
+        else:
+            slave_instances = create_instances(
+                num_instances=num_slaves,
+                subnet_id=subnet_id,
+                tags=slave_tags)
+        cluster_instances += slave_instances
 
         cluster = EC2Cluster(
             name=cluster_name,
@@ -947,29 +1754,103 @@ def launch(
 
         cluster.wait_for_state('running')
 
-        provision_cluster(
-            cluster=cluster,
-            services=services,
-            user=user,
-            identity_file=identity_file)
+        with cluster.watch_status_checks():
+            provision_cluster(
+                cluster=cluster,
+                services=services,
+                user=user,
+                identity_file=identity_file)
 
         return cluster
     except (Exception, KeyboardInterrupt) as e:
+        cleanup_instances = cluster_instances
         if isinstance(e, InterruptedEC2Operation):
-            cleanup_instances = e.instances
-        else:
-            # TODO: There is no guarantee that cluster_instances is
-            #       defined.
-            # See: https://github.com/nchammas/flintrock/issues/183
-            cleanup_instances = cluster_instances
+            cleanup_instances += e.instances
         _cleanup_instances(
             instances=cleanup_instances,
             assume_yes=assume_yes,
             region=region,
         )
+        delete_launch_template(name=launch_template_name, region=region)
         raise
 
 
+def build_image(
+        *,
+        image_name,
+        services,
+        assume_yes,
+        key_name,
+        identity_file,
+        instance_type,
+        region,
+        availability_zone,
+        ami,
+        user,
+        security_groups,
+        min_root_ebs_size_gb,
+        vpc_id,
+        subnet_id,
+        instance_profile_name,
+        tags) -> str:
+    """
+    Build an AMI with the provided services pre-installed, and return its ID.
+
+    We launch a single-node cluster from the base AMI, install the services on
+    it, image it, and then destroy it.
+    """
+    cluster = launch(
+        cluster_name='image-builder-{t}'.format(t=int(time.time())),
+        num_slaves=0,
+        services=[],
+        assume_yes=assume_yes,
+        key_name=key_name,
+        identity_file=identity_file,
+        instance_type=instance_type,
+        region=region,
+        availability_zone=availability_zone,
+        ami=ami,
+        user=user,
+        security_groups=security_groups,
+        min_root_ebs_size_gb=min_root_ebs_size_gb,
+        vpc_id=vpc_id,
+        subnet_id=subnet_id,
+        instance_profile_name=instance_profile_name,
+        placement_group='',
+        user_data=None,
+        tags=tags)
+
+    try:
+        ssh_client = get_ssh_client(
+            user=user,
+            host=cluster.master_ip,
+            identity_file=identity_file)
+        with ssh_client:
+            prepare_image_node(
+                ssh_client=ssh_client,
+                services=services,
+                cluster=cluster)
+
+        logger.info("Creating image {n}...".format(n=image_name))
+        image = cluster.master_instance.create_image(
+            Name=image_name,
+            Description="Flintrock image with {s} pre-installed.".format(
+                s=', '.join(type(s).__name__ for s in services) or "no services"))
+        ec2 = get_client('ec2', region=region)
+        ec2.get_waiter('image_available').wait(
+            ImageIds=[image.id],
+            WaiterConfig={
+                'Delay': 15,
+                'MaxAttempts': 80,
+            })
+        image.create_tags(
+            Tags=[{'Key': 'flintrock-image', 'Value': image_name}] + tags)
+
+        return image.id
+    finally:
+        cluster.destroy()
+
+
 def get_cluster(*, cluster_name: str, region: str, vpc_id: str) -> EC2Cluster:
     """
     Get an existing EC2 cluster.
@@ -989,7 +1870,7 @@ def get_clusters(*, cluster_names: list=[], region: str, vpc_id: str) -> list:
     regardless of how many clusters we have to look up. That's because querying
     AWS -- a network operation -- is by far the slowest step.
     """
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
+    ec2 = get_resource('ec2', region=region)
     if not vpc_id:
         vpc_id = get_default_vpc(region=region).id
 
@@ -1031,6 +1912,46 @@ def cli_validate_tags(ctx, param, value):
     return validate_tags(value)
 
 
+def get_regions() -> list:
+    """
+    Get all the regions available to the user.
+    """
+    # We have to ask some region for the list of regions.
+    client = get_client('ec2', region='us-east-1')
+    return sorted(r['RegionName'] for r in client.describe_regions()['Regions'])
+
+
+RegionClusters = namedtuple('RegionClusters', ['region', 'clusters', 'duration'])
+
+
+def get_clusters_in_regions(*, cluster_name: str=None, regions: list):
+    """
+    Get the named cluster, or all clusters if no name is given, in the default
+    VPC of each of the provided regions.
+
+    We query the regions concurrently and yield a RegionClusters for each region
+    as soon as we have its clusters.
+    """
+    def get_region_clusters(region):
+        start = time.time()
+        try:
+            clusters = get_clusters(
+                cluster_names=[cluster_name] if cluster_name else [],
+                region=region,
+                vpc_id='')
+        except (ClusterNotFound, NoDefaultVPC):
+            clusters = []
+        return RegionClusters(
+            region=region,
+            clusters=clusters,
+            duration=time.time() - start)
+
+    with concurrent.futures.ThreadPoolExecutor(len(regions)) as executor:
+        futures = [executor.submit(get_region_clusters, region) for region in regions]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
 def validate_tags(value):
     """
     Validate and parse optional EC2 tags.
@@ -1114,7 +2035,6 @@ def _compose_cluster(*, name: str, region: str, vpc_id: str, instances: list) ->
 
 
 def _cleanup_instances(*, instances: list, assume_yes: bool, region: str):
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
     if instances:
         if not assume_yes:
             yes = click.confirm(
@@ -1125,9 +2045,7 @@ def _cleanup_instances(*, instances: list, assume_yes: bool, region: str):
 
         if assume_yes or yes:
             print("Terminating instances...", file=sys.stderr)
-            (ec2.instances
-                .filter(
-                    Filters=[
-                        {'Name': 'instance-id', 'Values': [i.id for i in instances]}
-                    ])
-                .terminate())
+            act_on_instances(
+                instance_ids=[i.id for i in instances],
+                region=region,
+                action='terminate')
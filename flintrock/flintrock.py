@@ -27,6 +27,7 @@ from .exceptions import (
     UsageError,
     UnsupportedProviderError,
     NothingToDo,
+    ClusterNotFound,
     Error)
 from flintrock import __version__
 from .services import HDFS, Spark  # TODO: Remove this dependency.
@@ -151,6 +152,28 @@ def mutually_exclusive(*, options: list, scope: dict):
                 value2=scope[bad_option2]))
 
 
+def cli_validate_properties(ctx, param, value):
+    return validate_properties(value)
+
+
+def validate_properties(value) -> dict:
+    """
+    Validate and parse configuration properties specified as 'name=value' pairs.
+    """
+    err_msg = ("Properties need to be specified as 'name=value' pairs. "
+               "Name cannot be empty or be made up entirely of whitespace.")
+    result = {}
+    for prop in value:
+        if '=' not in prop:
+            raise click.BadParameter(err_msg)
+        name, value = [word.strip() for word in prop.split('=', maxsplit=1)]
+        if not name:
+            raise click.BadParameter(err_msg)
+        result[name] = value
+
+    return result
+
+
 def get_config_file() -> str:
     """
     Get the path to Flintrock's default configuration file.
@@ -204,39 +227,135 @@ def cli(cli_context, config, provider, debug):
     configure_log(debug=debug)
 
 
+def service_options(func):
+    """
+    Add the options that describe which services to install on cluster nodes.
+    """
+    options = [
+        click.option('--install-hdfs/--no-install-hdfs', default=False),
+        click.option('--hdfs-version',
+                     # Don't set a default here because it may conflict with
+                     # the config file.
+                     # See: https://github.com/nchammas/flintrock/issues/190
+                     # default=
+                     ),
+        click.option('--hdfs-download-source',
+                     help="URL to download Hadoop from.",
+                     default='http://www.apache.org/dyn/closer.lua/hadoop/common/hadoop-{v}/hadoop-{v}.tar.gz?as_json',
+                     show_default=True),
+        click.option('--hdfs-property', 'hdfs_properties',
+                     callback=cli_validate_properties,
+                     multiple=True,
+                     help="Hadoop configuration property (e.g. 'dfs.replication=2') that "
+                          "overrides the value Flintrock picks for your cluster. "
+                          "You can specify this option multiple times."),
+        click.option('--install-spark/--no-install-spark', default=True),
+        click.option('--spark-version',
+                     # Don't set a default here because it may conflict with
+                     # the config file.
+                     # See: https://github.com/nchammas/flintrock/issues/190
+                     # default=,
+                     help="Spark release version to install."),
+        click.option('--spark-download-source',
+                     help="URL to download a release of Spark from.",
+                     default='https://s3.amazonaws.com/spark-related-packages/spark-{v}-bin-hadoop2.6.tgz',
+                     show_default=True),
+        click.option('--spark-git-commit',
+                     help="Git commit to build Spark from. "
+                          "Set to 'latest' to build Spark from the latest commit on the "
+                          "repository's default branch."),
+        click.option('--spark-git-repository',
+                     help="Git repository to clone Spark from.",
+                     default='https://github.com/apache/spark',
+                     show_default=True),
+        click.option('--spark-build-cache',
+                     help="Where to cache Spark builds from source, so that launching "
+                          "the same commit again skips the build. Either an S3 URL "
+                          "(e.g. s3://bucket/prefix) or a local directory."),
+        click.option('--spark-build-cache-endpoint-url',
+                     help="Endpoint URL of an S3-compatible store, like MinIO, to use "
+                          "for an S3 build cache."),
+        click.option('--spark-build-cache-m2/--no-spark-build-cache-m2', default=False,
+                     help="Also cache the Maven repository that Spark builds download "
+                          "their dependencies into."),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def get_services(
+        *,
+        install_hdfs,
+        hdfs_version,
+        hdfs_download_source,
+        hdfs_properties,
+        install_spark,
+        spark_version,
+        spark_git_commit,
+        spark_git_repository,
+        spark_build_cache,
+        spark_build_cache_endpoint_url,
+        spark_build_cache_m2,
+        spark_download_source) -> list:
+    """
+    Validate the service options and get the services they describe.
+    """
+    services = []
+
+    option_requires(
+        option='--install-hdfs',
+        requires_all=['--hdfs-version'],
+        scope=locals())
+    option_requires(
+        option='--install-spark',
+        requires_any=[
+            '--spark-version',
+            '--spark-git-commit'],
+        scope=locals())
+    mutually_exclusive(
+        options=[
+            '--spark-version',
+            '--spark-git-commit'],
+        scope=locals())
+
+    if install_hdfs:
+        hdfs = HDFS(
+            version=hdfs_version,
+            download_source=hdfs_download_source,
+            properties=hdfs_properties)
+        services += [hdfs]
+    if install_spark:
+        if spark_version:
+            spark = Spark(
+                version=spark_version,
+                hadoop_version=hdfs_version,
+                download_source=spark_download_source,
+            )
+        elif spark_git_commit:
+            logger.warning(
+                "Warning: Building Spark takes a long time. "
+                "e.g. 15-20 minutes on an m3.xlarge instance on EC2.")
+            if spark_git_commit == 'latest':
+                spark_git_commit = get_latest_commit(spark_git_repository)
+                logger.info("Building Spark at latest commit: {c}".format(c=spark_git_commit))
+            spark = Spark(
+                git_commit=spark_git_commit,
+                git_repository=spark_git_repository,
+                hadoop_version=hdfs_version,
+                build_cache=spark_build_cache,
+                build_cache_endpoint_url=spark_build_cache_endpoint_url,
+                build_cache_m2=spark_build_cache_m2,
+            )
+        services += [spark]
+
+    return services
+
+
 @cli.command()
 @click.argument('cluster-name')
 @click.option('--num-slaves', type=click.IntRange(min=1), required=True)
-@click.option('--install-hdfs/--no-install-hdfs', default=False)
-@click.option('--hdfs-version',
-              # Don't set a default here because it may conflict with
-              # the config file.
-              # See: https://github.com/nchammas/flintrock/issues/190
-              # default=
-              )
-@click.option('--hdfs-download-source',
-              help="URL to download Hadoop from.",
-              default='http://www.apache.org/dyn/closer.lua/hadoop/common/hadoop-{v}/hadoop-{v}.tar.gz?as_json',
-              show_default=True)
-@click.option('--install-spark/--no-install-spark', default=True)
-@click.option('--spark-version',
-              # Don't set a default here because it may conflict with
-              # the config file.
-              # See: https://github.com/nchammas/flintrock/issues/190
-              # default=,
-              help="Spark release version to install.")
-@click.option('--spark-download-source',
-              help="URL to download a release of Spark from.",
-              default='https://s3.amazonaws.com/spark-related-packages/spark-{v}-bin-hadoop2.6.tgz',
-              show_default=True)
-@click.option('--spark-git-commit',
-              help="Git commit to build Spark from. "
-                   "Set to 'latest' to build Spark from the latest commit on the "
-                   "repository's default branch.")
-@click.option('--spark-git-repository',
-              help="Git repository to clone Spark from.",
-              default='https://github.com/apache/spark',
-              show_default=True)
+@service_options
 @click.option('--assume-yes/--no-assume-yes', default=False)
 @click.option('--ec2-key-name')
 @click.option('--ec2-identity-file',
@@ -254,6 +373,12 @@ def cli(cli_context, config, provider, debug):
               help="Additional security groups names to assign to the instances. "
                    "You can specify this option multiple times.")
 @click.option('--ec2-spot-price', type=float)
+@click.option('--ec2-candidate-instance-type', 'ec2_candidate_instance_types',
+              multiple=True,
+              help="Instance type that Flintrock may launch spot instances as instead "
+                   "of --ec2-instance-type, if it gives more cores per dollar in some "
+                   "availability zone. Applies only when no availability zone or "
+                   "subnet is set. You can specify this option multiple times.")
 @click.option('--ec2-min-root-ebs-size-gb', type=int, default=30)
 @click.option('--ec2-vpc-id', default='', help="Leave empty for default VPC.")
 @click.option('--ec2-subnet-id', default='')
@@ -271,6 +396,19 @@ def cli(cli_context, config, provider, debug):
               multiple=True,
               help="Additional tags (e.g. 'Key,Value') to assign to the instances. "
                    "You can specify this option multiple times.")
+@click.option('--ec2-fleet-instance-type', 'ec2_fleet_instance_types',
+              callback=ec2.cli_validate_fleet_instance_types,
+              multiple=True,
+              help="Instance type (e.g. 'm5.2xlarge:2') that an EC2 Fleet may launch "
+                   "slaves as. The optional weight says how many slaves' worth of "
+                   "capacity an instance of the type provides; --num-slaves and "
+                   "--ec2-spot-price then count units of capacity. Slaves become spot "
+                   "instances from the pools least likely to be interrupted. "
+                   "You can specify this option multiple times.")
+@click.option('--ec2-fleet-subnet-id', 'ec2_fleet_subnet_ids',
+              multiple=True,
+              help="Subnet that an EC2 Fleet may launch slaves in. "
+                   "You can specify this option multiple times.")
 @click.pass_context
 def launch(
         cli_context,
@@ -279,10 +417,14 @@ def launch(
         install_hdfs,
         hdfs_version,
         hdfs_download_source,
+        hdfs_properties,
         install_spark,
         spark_version,
         spark_git_commit,
         spark_git_repository,
+        spark_build_cache,
+        spark_build_cache_endpoint_url,
+        spark_build_cache_m2,
         spark_download_source,
         assume_yes,
         ec2_key_name,
@@ -294,6 +436,7 @@ def launch(
         ec2_user,
         ec2_security_groups,
         ec2_spot_price,
+        ec2_candidate_instance_types,
         ec2_min_root_ebs_size_gb,
         ec2_vpc_id,
         ec2_subnet_id,
@@ -303,28 +446,14 @@ def launch(
         ec2_ebs_optimized,
         ec2_instance_initiated_shutdown_behavior,
         ec2_user_data,
-        ec2_tags):
+        ec2_tags,
+        ec2_fleet_instance_types,
+        ec2_fleet_subnet_ids):
     """
     Launch a new cluster.
     """
     provider = cli_context.obj['provider']
-    services = []
 
-    option_requires(
-        option='--install-hdfs',
-        requires_all=['--hdfs-version'],
-        scope=locals())
-    option_requires(
-        option='--install-spark',
-        requires_any=[
-            '--spark-version',
-            '--spark-git-commit'],
-        scope=locals())
-    mutually_exclusive(
-        options=[
-            '--spark-version',
-            '--spark-git-commit'],
-        scope=locals())
     option_requires(
         option='--provider',
         conditional_value='ec2',
@@ -345,31 +474,26 @@ def launch(
         requires_all=['--ec2-subnet-id'],
         scope=locals())
 
+    if ec2_fleet_instance_types and not ec2_spot_price:
+        raise UsageError(
+            "Error: Missing option \"--ec2-spot-price\" is required by "
+            "\"--ec2-fleet-instance-type\".")
+
     check_external_dependency('ssh-keygen')
 
-    if install_hdfs:
-        hdfs = HDFS(version=hdfs_version, download_source=hdfs_download_source)
-        services += [hdfs]
-    if install_spark:
-        if spark_version:
-            spark = Spark(
-                version=spark_version,
-                hadoop_version=hdfs_version,
-                download_source=spark_download_source,
-            )
-        elif spark_git_commit:
-            logger.warning(
-                "Warning: Building Spark takes a long time. "
-                "e.g. 15-20 minutes on an m3.xlarge instance on EC2.")
-            if spark_git_commit == 'latest':
-                spark_git_commit = get_latest_commit(spark_git_repository)
-                logger.info("Building Spark at latest commit: {c}".format(c=spark_git_commit))
-            spark = Spark(
-                git_commit=spark_git_commit,
-                git_repository=spark_git_repository,
-                hadoop_version=hdfs_version,
-            )
-        services += [spark]
+    services = get_services(
+        install_hdfs=install_hdfs,
+        hdfs_version=hdfs_version,
+        hdfs_download_source=hdfs_download_source,
+        hdfs_properties=hdfs_properties,
+        install_spark=install_spark,
+        spark_version=spark_version,
+        spark_git_commit=spark_git_commit,
+        spark_git_repository=spark_git_repository,
+        spark_build_cache=spark_build_cache,
+        spark_build_cache_endpoint_url=spark_build_cache_endpoint_url,
+        spark_build_cache_m2=spark_build_cache_m2,
+        spark_download_source=spark_download_source)
 
     if provider == 'ec2':
         cluster = ec2.launch(
@@ -395,7 +519,10 @@ def launch(
             ebs_optimized=ec2_ebs_optimized,
             instance_initiated_shutdown_behavior=ec2_instance_initiated_shutdown_behavior,
             user_data=ec2_user_data,
-            tags=ec2_tags)
+            tags=ec2_tags,
+            fleet_instance_types=ec2_fleet_instance_types,
+            fleet_subnet_ids=ec2_fleet_subnet_ids,
+            candidate_instance_types=ec2_candidate_instance_types)
     else:
         raise UnsupportedProviderError(provider)
 
@@ -403,6 +530,127 @@ def launch(
     print("Login with: flintrock login {}".format(cluster.name))
 
 
+@cli.command(name='build-image')
+@click.argument('image-name')
+@service_options
+@click.option('--assume-yes/--no-assume-yes', default=False)
+@click.option('--ec2-key-name')
+@click.option('--ec2-identity-file',
+              type=click.Path(exists=True, dir_okay=False),
+              help="Path to SSH .pem file for accessing nodes.")
+@click.option('--ec2-instance-type', default='m3.medium', show_default=True)
+@click.option('--ec2-region', default='us-east-1', show_default=True)
+@click.option('--ec2-availability-zone', default='')
+@click.option('--ec2-ami', help="The base AMI to build the image from.")
+@click.option('--ec2-user')
+@click.option('--ec2-security-group', 'ec2_security_groups',
+              multiple=True,
+              help="Additional security groups names to assign to the instance. "
+                   "You can specify this option multiple times.")
+@click.option('--ec2-min-root-ebs-size-gb', type=int, default=30)
+@click.option('--ec2-vpc-id', default='', help="Leave empty for default VPC.")
+@click.option('--ec2-subnet-id', default='')
+@click.option('--ec2-instance-profile-name', default='')
+@click.option('--ec2-tag', 'ec2_tags',
+              callback=ec2.cli_validate_tags,
+              multiple=True,
+              help="Additional tags (e.g. 'Key,Value') to assign to the instance "
+                   "and the image. You can specify this option multiple times.")
+@click.pass_context
+def build_image(
+        cli_context,
+        image_name,
+        install_hdfs,
+        hdfs_version,
+        hdfs_download_source,
+        hdfs_properties,
+        install_spark,
+        spark_version,
+        spark_git_commit,
+        spark_git_repository,
+        spark_build_cache,
+        spark_build_cache_endpoint_url,
+        spark_build_cache_m2,
+        spark_download_source,
+        assume_yes,
+        ec2_key_name,
+        ec2_identity_file,
+        ec2_instance_type,
+        ec2_region,
+        ec2_availability_zone,
+        ec2_ami,
+        ec2_user,
+        ec2_security_groups,
+        ec2_min_root_ebs_size_gb,
+        ec2_vpc_id,
+        ec2_subnet_id,
+        ec2_instance_profile_name,
+        ec2_tags):
+    """
+    Build an image with services pre-installed.
+
+    Clusters launched from the image skip installing the services, as long as
+    they are configured with the same services the image was built with.
+    """
+    provider = cli_context.obj['provider']
+
+    option_requires(
+        option='--provider',
+        conditional_value='ec2',
+        requires_all=[
+            '--ec2-key-name',
+            '--ec2-identity-file',
+            '--ec2-instance-type',
+            '--ec2-region',
+            '--ec2-ami',
+            '--ec2-user'],
+        scope=locals())
+    option_requires(
+        option='--ec2-vpc-id',
+        requires_all=['--ec2-subnet-id'],
+        scope=locals())
+
+    check_external_dependency('ssh-keygen')
+
+    services = get_services(
+        install_hdfs=install_hdfs,
+        hdfs_version=hdfs_version,
+        hdfs_download_source=hdfs_download_source,
+        hdfs_properties=hdfs_properties,
+        install_spark=install_spark,
+        spark_version=spark_version,
+        spark_git_commit=spark_git_commit,
+        spark_git_repository=spark_git_repository,
+        spark_build_cache=spark_build_cache,
+        spark_build_cache_endpoint_url=spark_build_cache_endpoint_url,
+        spark_build_cache_m2=spark_build_cache_m2,
+        spark_download_source=spark_download_source)
+
+    if provider == 'ec2':
+        image_id = ec2.build_image(
+            image_name=image_name,
+            services=services,
+            assume_yes=assume_yes,
+            key_name=ec2_key_name,
+            identity_file=ec2_identity_file,
+            instance_type=ec2_instance_type,
+            region=ec2_region,
+            availability_zone=ec2_availability_zone,
+            ami=ec2_ami,
+            user=ec2_user,
+            security_groups=ec2_security_groups,
+            min_root_ebs_size_gb=ec2_min_root_ebs_size_gb,
+            vpc_id=ec2_vpc_id,
+            subnet_id=ec2_subnet_id,
+            instance_profile_name=ec2_instance_profile_name,
+            tags=ec2_tags)
+    else:
+        raise UnsupportedProviderError(provider)
+
+    print("Image: {}".format(image_id))
+    print("Launch clusters from it with: flintrock launch --ec2-ami {} ...".format(image_id))
+
+
 def get_latest_commit(github_repository: str):
     """
     Get the latest commit on the default branch of a repository hosted on GitHub.
@@ -463,10 +711,42 @@ def destroy(cli_context, cluster_name, assume_yes, ec2_region, ec2_vpc_id):
     cluster.destroy()
 
 
+def print_clusters(
+        *,
+        clusters: list,
+        cluster_name: str,
+        master_hostname_only: bool,
+        search_area: str):
+    if cluster_name:
+        cluster = clusters[0]
+        if master_hostname_only:
+            logger.info(cluster.master_host)
+        else:
+            cluster.print()
+    else:
+        if master_hostname_only:
+            for cluster in sorted(clusters, key=lambda x: x.name):
+                logger.info("{c}: {h}".format(c=cluster.name, h=cluster.master_host))
+        else:
+            logger.info("Found {n} cluster{s}{space}{search_area}.".format(
+                n=len(clusters),
+                s='' if len(clusters) == 1 else 's',
+                space=' ' if search_area else '',
+                search_area=search_area))
+            if clusters:
+                logger.info('---')
+                for cluster in sorted(clusters, key=lambda x: x.name):
+                    cluster.print()
+
+
 @cli.command()
 @click.argument('cluster-name', required=False)
 @click.option('--master-hostname-only', is_flag=True, default=False)
-@click.option('--ec2-region', default='us-east-1', show_default=True)
+@click.option('--ec2-region', default='us-east-1', show_default=True,
+              help="Region to search. Separate several regions with commas "
+                   "to search them all at once.")
+@click.option('--ec2-all-regions', is_flag=True, default=False,
+              help="Search every region.")
 @click.option('--ec2-vpc-id', default='', help="Leave empty for default VPC.")
 @click.pass_context
 def describe(
@@ -474,6 +754,7 @@ def describe(
         cluster_name,
         master_hostname_only,
         ec2_region,
+        ec2_all_regions,
         ec2_vpc_id):
     """
     Describe an existing cluster.
@@ -498,34 +779,65 @@ def describe(
         cluster_names = []
 
     if provider == 'ec2':
-        search_area = "in region {r}".format(r=ec2_region)
+        if ec2_all_regions:
+            regions = ec2.get_regions()
+        else:
+            regions = [r.strip() for r in ec2_region.split(',') if r.strip()]
+
+        if len(regions) > 1:
+            # VPC IDs are specific to a region.
+            if ec2_vpc_id:
+                raise UsageError(
+                    "Error: \"--ec2-vpc-id\" can only be used with a single region.")
+            describe_regions(
+                cluster_name=cluster_name,
+                master_hostname_only=master_hostname_only,
+                regions=regions)
+            return
+
+        search_area = "in region {r}".format(r=regions[0])
         clusters = ec2.get_clusters(
             cluster_names=cluster_names,
-            region=ec2_region,
+            region=regions[0],
             vpc_id=ec2_vpc_id)
     else:
         raise UnsupportedProviderError(provider)
 
-    if cluster_name:
-        cluster = clusters[0]
-        if master_hostname_only:
-            logger.info(cluster.master_host)
-        else:
-            cluster.print()
-    else:
-        if master_hostname_only:
-            for cluster in sorted(clusters, key=lambda x: x.name):
-                logger.info(cluster.name + ':', cluster.master_host)
-        else:
-            logger.info("Found {n} cluster{s}{space}{search_area}.".format(
-                n=len(clusters),
-                s='' if len(clusters) == 1 else 's',
-                space=' ' if search_area else '',
-                search_area=search_area))
-            if clusters:
-                logger.info('---')
-                for cluster in sorted(clusters, key=lambda x: x.name):
-                    cluster.print()
+    print_clusters(
+        clusters=clusters,
+        cluster_name=cluster_name,
+        master_hostname_only=master_hostname_only,
+        search_area=search_area)
+
+
+def describe_regions(*, cluster_name: str, master_hostname_only: bool, regions: list):
+    """
+    Describe clusters across several EC2 regions, printing each region's clusters
+    as soon as we have them.
+    """
+    found_cluster = False
+    for region_clusters in ec2.get_clusters_in_regions(
+            cluster_name=cluster_name,
+            regions=regions):
+        logger.debug("Searched region {r} in {t:.2f} seconds.".format(
+            r=region_clusters.region,
+            t=region_clusters.duration))
+        if cluster_name and not region_clusters.clusters:
+            continue
+        found_cluster = found_cluster or bool(region_clusters.clusters)
+        print_clusters(
+            clusters=region_clusters.clusters,
+            cluster_name=cluster_name,
+            master_hostname_only=master_hostname_only,
+            search_area="in region {r} ({t:.2f}s)".format(
+                r=region_clusters.region,
+                t=region_clusters.duration))
+
+    if cluster_name and not found_cluster:
+        raise ClusterNotFound(
+            "No cluster {c} in regions {r}.".format(
+                c=cluster_name,
+                r=', '.join(regions)))
 
 
 # TODO: Provide different command or option for going straight to Spark Shell. (?)
@@ -1004,6 +1316,9 @@ def config_to_click(config: dict) -> dict:
             list(config['launch'].items()) +
             list(ec2_configs.items()) +
             list(service_configs.items())),
+        'build-image': dict(
+            list(ec2_configs.items()) +
+            list(service_configs.items())),
         'describe': ec2_configs,
         'destroy': ec2_configs,
         'login': ec2_configs,
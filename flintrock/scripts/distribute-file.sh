@@ -0,0 +1,60 @@
+#!/bin/bash
+
+# Copy a file from this node to the same path on each of the provided hosts.
+#
+# Every host that already has the file copies it to a host that doesn't,
+# so the number of hosts with the file doubles in each round and the whole
+# copy takes a logarithmic number of rounds.
+
+set -e
+
+path="$1"
+shift
+pending_hosts=("$@")
+
+# An empty holder means this node.
+holders=("")
+
+ssh_opts=(-o StrictHostKeyChecking=no -o BatchMode=yes)
+
+copy_file() {
+    local holder="$1"
+    local target="$2"
+    local quoted_path
+    quoted_path="$(printf '%q' "$path")"
+
+    if ! ssh "${ssh_opts[@]}" "$target" test -d "$(printf '%q' "$(dirname "$path")")"; then
+        echo "Remote directory does not exist on $target: $(dirname "$path")" >&2
+        return 1
+    fi
+
+    if [ -z "$holder" ]; then
+        scp "${ssh_opts[@]}" -q "$path" "$target:$quoted_path"
+    else
+        ssh "${ssh_opts[@]}" "$holder" \
+            scp "${ssh_opts[*]}" -q "$quoted_path" "$target:$quoted_path"
+    fi
+}
+
+while (( ${#pending_hosts[@]} > 0 )); do
+    pids=()
+    targets=()
+
+    for holder in "${holders[@]}"; do
+        if (( ${#pending_hosts[@]} == 0 )); then
+            break
+        fi
+        target="${pending_hosts[0]}"
+        pending_hosts=("${pending_hosts[@]:1}")
+
+        copy_file "$holder" "$target" &
+        pids+=($!)
+        targets+=("$target")
+    done
+
+    for pid in "${pids[@]}"; do
+        wait "$pid"
+    done
+
+    holders+=("${targets[@]}")
+done
@@ -0,0 +1,554 @@
+"""
+Fetch an artifact, like a Spark or Hadoop tarball, into a local directory
+and optionally extract it.
+
+The cluster master fetches artifacts from their original source and serves
+them to the rest of the cluster over the private network. Other nodes fetch
+artifacts from a seed node and fall back to the original source if the seed
+can't provide them.
+
+Downloads are checked against the SHA-512 checksum that Apache publishes
+alongside each release. Each node looks for the checksum in its own
+<name>.sha512, then on its seed, and only then at Apache, and saves it as
+<name>.sha512 for the nodes that fetch from it. So usually only the master
+fetches the checksum from Apache.
+
+If the download fails, we leave a <name>.failed marker in the artifacts
+directory so that nodes waiting on us know to stop waiting. Nodes also stop
+waiting on a seed that has neither the artifact nor a partial download of it,
+unless the seed is still being set up.
+"""
+from __future__ import print_function
+
+import argparse
+import functools
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+if sys.version_info < (3, 0):
+    from httplib import HTTPException
+    from urllib2 import urlopen, HTTPError, Request
+else:
+    from http.client import HTTPException
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+
+# How long nodes wait for their seed to make an artifact available before
+# going to the original source themselves.
+SEED_TIMEOUT = 15 * 60
+SEED_POLL_INTERVAL = 5
+
+# Flintrock leaves this marker in a node's artifacts directory while it sets the
+# node up, since the node may not have started fetching its artifacts yet.
+PENDING_MARKER_NAME = '.pending'
+
+CHUNK_SIZE = 1024 * 1024
+
+# When the server supports range requests, we download files in pieces of
+# this size over several connections at once. A single TCP stream from a
+# distant mirror is often limited to a few MB/s.
+PIECE_SIZE = 16 * 1024 * 1024
+CONNECTIONS = 4
+
+# When downloading from Apache's mirrors, we time a short download from a few
+# of them and go with the fastest instead of trusting the preferred mirror.
+MIRROR_CANDIDATES = 5
+PROBE_SIZE = 512 * 1024
+PROBE_TIMEOUT = 10
+
+
+class CorruptDownloadError(IOError):
+    pass
+
+
+def start_unpacker(extract_dir):
+    """
+    Start a process that extracts a gzipped tarball from its stdin into the
+    provided directory. Since gzip checks the CRC of what it decompresses,
+    the process fails if the stream is corrupt.
+    """
+    if os.path.exists(extract_dir):
+        shutil.rmtree(extract_dir)
+    os.makedirs(extract_dir)
+    # strip-components puts the files in the root of the extraction directory.
+    return subprocess.Popen(
+        ['tar', 'xz', '-C', extract_dir, '--strip-components=1'],
+        stdin=subprocess.PIPE)
+
+
+def parse_sha512(text):
+    """
+    Parse a published SHA-512 checksum. Apache projects publish these either
+    in the format sha512sum uses or in the format `gpg --print-md` uses, which
+    puts the file name first and splits the digest into groups.
+    """
+    tokens = text.split()
+    if tokens and tokens[0].endswith(':'):
+        digest = ''.join(tokens[1:])
+    else:
+        digest = tokens[0] if tokens else ''
+    if re.match(r'^[0-9a-fA-F]{128}$', digest):
+        return digest.lower()
+    else:
+        return None
+
+
+def get_expected_sha512(checksum_path, seed_url, checksum_urls):
+    """
+    Get the SHA-512 checksum the artifact should have, or None if no checksum
+    is published for it.
+
+    We look for the checksum on this node, then on the seed, and finally at the
+    provided URLs. Whatever we find gets saved on this node so that nodes
+    fetching from us can check their downloads too.
+    """
+    if os.path.exists(checksum_path):
+        with open(checksum_path) as f:
+            return parse_sha512(f.read())
+
+    urls = []
+    if seed_url:
+        urls.append(seed_url + '/' + os.path.basename(checksum_path))
+    urls += checksum_urls
+
+    for url in urls:
+        try:
+            sha512 = parse_sha512(urlopen(url, timeout=60).read().decode('utf-8'))
+        except (IOError, HTTPException, UnicodeDecodeError):
+            continue
+        if sha512:
+            with open(checksum_path + '.tmp', 'w') as f:
+                f.write(sha512 + '\n')
+            os.rename(checksum_path + '.tmp', checksum_path)
+            return sha512
+
+    print("No published SHA-512 checksum found.", file=sys.stderr)
+    return None
+
+
+def open_range(url, start, end, timeout=60):
+    """
+    Request the bytes from start up to and including end. Servers that don't
+    support range requests send the whole file instead.
+    """
+    request = Request(url, headers={'Range': 'bytes={s}-{e}'.format(s=start, e=end)})
+    return urlopen(request, timeout=timeout)
+
+
+def probe_mirror(url):
+    """
+    Get the speed in bytes per second at which a mirror serves the start of
+    the file at the provided URL, or 0 if the mirror doesn't serve it at all.
+    """
+    try:
+        start_time = time.time()
+        data = open_range(url, 0, PROBE_SIZE - 1, timeout=PROBE_TIMEOUT).read(PROBE_SIZE)
+        return len(data) / max(time.time() - start_time, 0.001)
+    except (IOError, HTTPException):
+        return 0
+
+
+def rank_mirrors(mirror_info):
+    """
+    Probe the preferred mirror along with a few others from the provided
+    closer.lua mirror info in parallel, and return the URLs of the file on
+    the mirrors that served it, fastest first.
+    """
+    preferred_mirror = mirror_info['preferred']
+    other_mirrors = [
+        m for m in set(mirror_info.get('http', []) + mirror_info.get('backup', []))
+        if m != preferred_mirror]
+    mirrors = [preferred_mirror] + random.sample(
+        other_mirrors,
+        min(len(other_mirrors), MIRROR_CANDIDATES - 1))
+    urls = [m + mirror_info['path_info'] for m in mirrors]
+
+    speeds = {}
+
+    def probe(url):
+        speeds[url] = probe_mirror(url)
+
+    threads = [threading.Thread(target=probe, args=(url,)) for url in urls]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(PROBE_TIMEOUT * 2)
+
+    ranked_urls = sorted(
+        (url for url in urls if speeds.get(url)),
+        key=lambda url: speeds[url],
+        reverse=True)
+    for url in ranked_urls:
+        print("{s:.1f} MB/s from: {u}".format(s=speeds[url] / 1024 / 1024, u=url), file=sys.stderr)
+
+    # If none of the mirrors came through, we may as well try the preferred one.
+    return ranked_urls or urls[:1]
+
+
+def get_seed_mirror_urls(seed_url, mirrors_path):
+    """
+    Get the mirror ranking that the seed saved, if any.
+    """
+    try:
+        return urlopen(
+            seed_url + '/' + os.path.basename(mirrors_path),
+            timeout=60).read().decode('utf-8').split()
+    except (IOError, HTTPException):
+        return []
+
+
+def save_mirror_urls(mirrors_path, mirror_urls):
+    with open(mirrors_path + '.tmp', 'w') as f:
+        f.write('\n'.join(mirror_urls) + '\n')
+    os.rename(mirrors_path + '.tmp', mirrors_path)
+
+
+def get_source_urls(url, mirrors_path, seed_url):
+    """
+    Get the URLs to download the artifact from, best first.
+
+    Choosing a mirror takes a moment, so only the first node to need a mirror
+    ranks them. It saves the ranking alongside the artifact, and nodes that
+    fetch from it reuse that ranking.
+    """
+    if not url.endswith('?as_json'):
+        return [url]
+
+    if os.path.exists(mirrors_path):
+        with open(mirrors_path) as f:
+            return f.read().split()
+
+    mirror_urls = get_seed_mirror_urls(seed_url, mirrors_path) if seed_url else []
+    if not mirror_urls:
+        mirror_info = json.loads(urlopen(url, timeout=60).read().decode('utf-8'))
+        mirror_urls = rank_mirrors(mirror_info)
+
+    save_mirror_urls(mirrors_path, mirror_urls)
+    return mirror_urls
+
+
+def get_range_size(response):
+    """
+    Get the full size of the file from a response to a range request, or None
+    if the server ignored the range.
+    """
+    content_range = response.info().get('Content-Range') or ''
+    size = content_range.split('/')[-1]
+    if response.getcode() == 206 and size.isdigit():
+        return int(size)
+    else:
+        return None
+
+
+def fetch_piece(url, start, end, tries=3):
+    """
+    Fetch the bytes from start up to but not including end, retrying just
+    this piece if the connection fails.
+    """
+    for attempt in range(1, tries + 1):
+        try:
+            data = open_range(url, start, end - 1).read()
+            if len(data) != end - start:
+                raise IOError(
+                    "Got {g} bytes instead of {e} at offset {s}."
+                    .format(g=len(data), e=end - start, s=start))
+            return data
+        except (IOError, HTTPException):
+            if attempt == tries:
+                raise
+            time.sleep(1)
+
+
+def download_pieces(url, size, offset, sinks):
+    """
+    Download the file from offset onwards in pieces over several connections
+    and pass the pieces to the sinks in order.
+
+    We only let connections get a few pieces ahead of the sinks so that we
+    don't end up holding the whole file in memory.
+    """
+    pieces = [
+        (start, min(start + PIECE_SIZE, size))
+        for start in range(offset, size, PIECE_SIZE)]
+    results = [None] * len(pieces)
+    ready = [threading.Event() for _ in pieces]
+    window = threading.Semaphore(CONNECTIONS * 2)
+    lock = threading.Lock()
+    unclaimed = iter(range(len(pieces)))
+    cancelled = threading.Event()
+
+    def worker():
+        while True:
+            window.acquire()
+            with lock:
+                i = next(unclaimed, None)
+            if i is None or cancelled.is_set():
+                return
+            try:
+                results[i] = fetch_piece(url, *pieces[i])
+            except Exception as e:
+                results[i] = e
+            ready[i].set()
+
+    for _ in range(CONNECTIONS):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for i in range(len(pieces)):
+            ready[i].wait()
+            if isinstance(results[i], Exception):
+                raise results[i]
+            for sink in sinks:
+                sink(results[i])
+            results[i] = None
+            window.release()
+    finally:
+        cancelled.set()
+        # Wake up any connections waiting on the window so they can exit.
+        for _ in range(CONNECTIONS):
+            window.release()
+
+
+def download(url, path, extract_dir=None, get_expected_sha512=None):
+    """
+    Download the gzipped tarball at the provided URL, extracting it and
+    computing its checksum as it streams in, and move it into place only once
+    we know it's intact.
+
+    This way we read the download only once, no matter how many things we
+    need to do with it.
+
+    We only ask for the expected checksum once the download is complete, since
+    the seed we're fetching from may not have had it when we started.
+
+    If an earlier attempt left a partial download behind and the server
+    supports range requests, we pick up where that attempt left off.
+    """
+    partial_path = path + '.part'
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+
+    try:
+        response = open_range(url, offset, offset + PIECE_SIZE - 1)
+    except HTTPError as e:
+        if e.code != 416 or not offset:
+            raise
+        # The partial download is no good for resuming, so start over.
+        os.remove(partial_path)
+        offset = 0
+        response = open_range(url, offset, PIECE_SIZE - 1)
+
+    size = get_range_size(response)
+    if size is None:
+        offset = 0
+
+    sha512 = hashlib.sha512()
+    unpacker = start_unpacker(extract_dir) if extract_dir else None
+    sinks = [sha512.update] + ([unpacker.stdin.write] if unpacker else [])
+
+    try:
+        with open(partial_path, 'ab' if offset else 'wb') as f:
+            if offset:
+                print("Resuming download at byte {o}.".format(o=offset), file=sys.stderr)
+                with open(partial_path, 'rb') as partial_file:
+                    for chunk in iter(lambda: partial_file.read(CHUNK_SIZE), b''):
+                        for sink in sinks:
+                            sink(chunk)
+
+            sinks.append(f.write)
+            if size is not None:
+                first_piece = response.read()
+                for sink in sinks:
+                    sink(first_piece)
+                download_pieces(url, size, offset + len(first_piece), sinks)
+            else:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                    for sink in sinks:
+                        sink(chunk)
+        if unpacker:
+            unpacker.stdin.close()
+            if unpacker.wait() != 0:
+                raise CorruptDownloadError("Corrupt download from: {u}".format(u=url))
+    except CorruptDownloadError:
+        os.remove(partial_path)
+        raise
+    except Exception:
+        if unpacker and unpacker.poll() is not None:
+            # The unpacker gave up on what we fed it.
+            os.remove(partial_path)
+            raise CorruptDownloadError("Corrupt download from: {u}".format(u=url))
+        # We keep the partial download around so the next attempt can resume it.
+        if unpacker:
+            unpacker.kill()
+            unpacker.wait()
+        raise
+
+    expected_sha512 = get_expected_sha512() if get_expected_sha512 else None
+    if expected_sha512 and sha512.hexdigest() != expected_sha512:
+        os.remove(partial_path)
+        raise CorruptDownloadError("SHA-512 mismatch for download from: {u}".format(u=url))
+
+    os.rename(partial_path, path)
+
+
+def unpack(path, extract_dir):
+    unpacker = start_unpacker(extract_dir)
+    with open(path, 'rb') as f:
+        shutil.copyfileobj(f, unpacker.stdin, CHUNK_SIZE)
+    unpacker.stdin.close()
+    if unpacker.wait() != 0:
+        raise CorruptDownloadError("Corrupt artifact: {p}".format(p=path))
+
+
+def fetch_from_source(url, path, extract_dir, get_expected_sha512, seed_url='', tries=3):
+    """
+    Fetch the artifact from its original source. If there are several mirrors
+    to choose from, each attempt goes to the next best one.
+    """
+    source_urls = []
+    for attempt in range(1, tries + 1):
+        try:
+            if not source_urls:
+                source_urls = get_source_urls(url, path + '.mirrors', seed_url)
+            file_url = source_urls[(attempt - 1) % len(source_urls)]
+            print("Downloading file at:", file_url, file=sys.stderr)
+            download(file_url, path, extract_dir, get_expected_sha512)
+            return True
+        except (IOError, HTTPException, ValueError) as e:
+            print("Download attempt {a} failed: {e}".format(a=attempt, e=e), file=sys.stderr)
+            time.sleep(1)
+    return False
+
+
+def seed_has(url):
+    """
+    Check whether the seed has the file at the provided URL. We ask for just the
+    first byte so we don't transfer the whole file.
+    """
+    try:
+        open_range(url, 0, 0).close()
+        return True
+    except HTTPError as e:
+        # Empty files can't satisfy the range, but they're there all the same.
+        return e.code != 404
+    except (IOError, HTTPException):
+        # The seed may not be serving yet.
+        return True
+
+
+def fetch_from_seed(seed_url, name, path, extract_dir, get_expected_sha512, timeout=SEED_TIMEOUT):
+    """
+    Wait for the seed to make the artifact available and then fetch it.
+
+    Return False if the seed failed to get the artifact itself, if it isn't
+    getting the artifact at all, or if it didn't come through in time.
+    """
+    artifact_url = seed_url + '/' + name
+    deadline = time.time() + timeout
+    corrupt_downloads = 0
+
+    while time.time() < deadline:
+        try:
+            download(artifact_url, path, extract_dir, get_expected_sha512)
+            return True
+        except CorruptDownloadError as e:
+            print(e, file=sys.stderr)
+            corrupt_downloads += 1
+            if corrupt_downloads >= 3:
+                return False
+            continue
+        except HTTPError as e:
+            if e.code != 404:
+                return False
+            try:
+                urlopen(artifact_url + '.failed', timeout=60)
+                return False
+            except IOError:
+                pass
+            # Nodes that were already in the cluster when we were added may not
+            # have the artifact at all, e.g. if they predate the artifact server.
+            if not (seed_has(artifact_url + '.part') or
+                    seed_has(seed_url + '/' + PENDING_MARKER_NAME)):
+                print("The seed doesn't have {n}.".format(n=name), file=sys.stderr)
+                return False
+        except (IOError, HTTPException):
+            # The seed may not be serving yet, or the transfer got cut off.
+            pass
+        time.sleep(SEED_POLL_INTERVAL)
+
+    return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        'url',
+        help="The original source of the artifact. Leave this empty for artifacts "
+             "that only the cluster master can produce, like Spark builds.")
+    parser.add_argument('artifacts_dir')
+    parser.add_argument('name', help="The artifact's file name within the artifacts directory.")
+    parser.add_argument('--seed-url', default='', help="The base URL of a node serving artifacts.")
+    parser.add_argument(
+        '--fallback-seed-url', default='',
+        help="The base URL of a node to fetch the artifact from if the seed "
+             "can't provide it.")
+    parser.add_argument(
+        '--seed-timeout', type=int, default=SEED_TIMEOUT,
+        help="How many seconds to wait for the seed to make the artifact available.")
+    parser.add_argument('--extract-to', default='', help="Where to extract the artifact to.")
+    parser.add_argument(
+        '--checksum-url', dest='checksum_urls', action='append', default=[],
+        help="Where the artifact's SHA-512 checksum is published. "
+             "You can specify this option multiple times.")
+    args = parser.parse_args()
+
+    path = os.path.join(args.artifacts_dir, args.name)
+    failed_marker_path = path + '.failed'
+    expected_sha512 = functools.partial(
+        get_expected_sha512,
+        path + '.sha512',
+        args.seed_url,
+        args.checksum_urls)
+
+    if not os.path.isdir(args.artifacts_dir):
+        os.makedirs(args.artifacts_dir)
+    if os.path.exists(failed_marker_path):
+        os.remove(failed_marker_path)
+
+    if os.path.exists(path):
+        if args.extract_to:
+            unpack(path, args.extract_to)
+        sys.exit(0)
+
+    seed_urls = [args.seed_url] if args.seed_url else []
+    if args.fallback_seed_url and args.fallback_seed_url != args.seed_url:
+        seed_urls.append(args.fallback_seed_url)
+
+    for seed_url in seed_urls:
+        print("Fetching {n} from: {s}".format(n=args.name, s=seed_url), file=sys.stderr)
+        if fetch_from_seed(
+                seed_url, args.name, path, args.extract_to, expected_sha512,
+                timeout=args.seed_timeout):
+            # Pass the seed's mirror ranking on to the nodes that fetch from us,
+            # in case they end up needing it.
+            mirror_urls = get_seed_mirror_urls(seed_url, path + '.mirrors')
+            if mirror_urls:
+                save_mirror_urls(path + '.mirrors', mirror_urls)
+            sys.exit(0)
+        print("Could not fetch {n} from: {s}".format(n=args.name, s=seed_url), file=sys.stderr)
+
+    if args.url and fetch_from_source(args.url, path, args.extract_to, expected_sha512, args.seed_url):
+        sys.exit(0)
+
+    open(failed_marker_path, 'w').close()
+    sys.exit(1)
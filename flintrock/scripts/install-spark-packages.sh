@@ -0,0 +1,62 @@
+#!/bin/bash
+
+# Resolve Spark packages (e.g. org.apache.hadoop:hadoop-aws:2.7.3) once on the
+# master and point spark.jars at the resulting jars. This saves every Spark
+# application from resolving the same packages against Maven Central when it
+# starts up. Executors get the jars from the driver, so the slaves don't need
+# copies of their own.
+#
+# We keep only the jars that Spark doesn't already ship: the packages
+# themselves and the AWS SDK. Their other dependencies (hadoop-common, old
+# Jackson and Guava releases, etc.) are already on Spark's classpath, and
+# older copies of them break Spark.
+#
+# Usage: install-spark-packages.sh <packages-dir> <packages>
+#   where <packages> is a comma-separated list of Maven coordinates.
+
+set -e
+
+packages_dir="$1"
+packages="$2"
+
+spark_defaults="spark/conf/spark-defaults.conf"
+
+if [ ! -d "$packages_dir" ]; then
+    echo "Resolving Spark packages..."
+
+    tmp_dir="$(mktemp -d)"
+    trap 'rm -rf "$tmp_dir"' EXIT
+
+    cat > "$tmp_dir/ivysettings.xml" <<SETTINGS
+<ivysettings>
+  <settings defaultResolver="central"/>
+  <resolvers>
+    <ibiblio name="central" m2compatible="true" root="https://repo1.maven.org/maven2/"/>
+  </resolvers>
+</ivysettings>
+SETTINGS
+
+    mkdir "$tmp_dir/jars"
+    IFS=',' read -ra coordinates <<< "$packages"
+    for coordinate in "${coordinates[@]}"; do
+        IFS=':' read -r group artifact version <<< "$coordinate"
+        # Spark ships with Ivy, either as a separate jar (Spark 2+) or as part
+        # of its assembly jar (Spark 1.x).
+        java -cp "spark/jars/*:spark/lib/*" org.apache.ivy.Main \
+            -settings "$tmp_dir/ivysettings.xml" \
+            -cache "$tmp_dir/cache" \
+            -dependency "$group" "$artifact" "$version" \
+            -types jar \
+            -retrieve "$tmp_dir/retrieved/[organisation]-[artifact]-[revision](-[classifier]).[ext]" \
+            > /dev/null
+        mv "$tmp_dir/retrieved/$group-$artifact-"*.jar "$tmp_dir/jars/"
+    done
+    mv "$tmp_dir/retrieved/com.amazonaws-"*.jar "$tmp_dir/jars/" 2> /dev/null || true
+
+    mv "$tmp_dir/jars" "$packages_dir"
+fi
+
+# spark.jars adds these jars after Spark's own, unlike extraClassPath.
+jars="$(ls -1 "$packages_dir"/*.jar | paste -sd ',' -)"
+sed -i '/^spark\.jars /d' "$spark_defaults"
+echo "spark.jars    $jars" >> "$spark_defaults"
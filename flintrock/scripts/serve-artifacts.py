@@ -0,0 +1,117 @@
+"""
+Serve the files in a directory over HTTP so that other cluster nodes can
+fetch artifacts from this node instead of from the internet.
+
+usage: serve-artifacts.py <artifacts-dir> <port>
+
+The server supports simple range requests, so nodes can fetch artifacts over
+several connections and resume interrupted transfers. It shuts itself down
+once it has gone a while without serving anything.
+"""
+from __future__ import print_function
+
+import os
+import re
+import sys
+import threading
+import time
+
+if sys.version_info < (3, 0):
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+else:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+IDLE_TIMEOUT = 15 * 60
+
+
+class ArtifactServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.lock = threading.Lock()
+        self.active_requests = 0
+        self.last_request_time = time.time()
+
+    def is_idle(self):
+        with self.lock:
+            return (
+                self.active_requests == 0 and
+                time.time() - self.last_request_time > IDLE_TIMEOUT)
+
+
+class ArtifactRequestHandler(SimpleHTTPRequestHandler):
+    range_length = None
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        range_match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+
+        if not range_match or not os.path.isfile(path):
+            return SimpleHTTPRequestHandler.send_head(self)
+
+        size = os.path.getsize(path)
+        start = int(range_match.group(1))
+        end = min(int(range_match.group(2) or size - 1), size - 1)
+        if start > end:
+            self.send_error(416, "Requested range not satisfiable")
+            return None
+
+        f = open(path, 'rb')
+        f.seek(start)
+        self.range_length = end - start + 1
+
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Range', 'bytes {s}-{e}/{n}'.format(s=start, e=end, n=size))
+        self.send_header('Content-Length', str(self.range_length))
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        if self.range_length is None:
+            SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+        else:
+            remaining = self.range_length
+            while remaining > 0:
+                chunk = source.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                outputfile.write(chunk)
+                remaining -= len(chunk)
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.active_requests += 1
+        try:
+            SimpleHTTPRequestHandler.do_GET(self)
+        finally:
+            with self.server.lock:
+                self.server.active_requests -= 1
+                self.server.last_request_time = time.time()
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    artifacts_dir = sys.argv[1]
+    port = int(sys.argv[2])
+
+    if not os.path.isdir(artifacts_dir):
+        os.makedirs(artifacts_dir)
+    os.chdir(artifacts_dir)
+
+    server = ArtifactServer(('', port), ArtifactRequestHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    while not server.is_idle():
+        time.sleep(10)
+
+    server.shutdown()
@@ -1,10 +1,14 @@
 import json
+import math
 import os
 import shlex
 import sys
 import textwrap
+import urllib.parse
 import urllib.request
 import logging
+import posixpath
+from collections import namedtuple
 
 # External modules
 import paramiko
@@ -12,10 +16,19 @@ import paramiko
 # Flintrock modules
 from .core import (
     FlintrockCluster,
+    fetch_artifact,
     generate_template_mapping,
+    get_artifacts_dir,
     get_formatted_template,
 )
+from .build_cache import (
+    BuildCache,
+    get_build_cache,
+    get_build_cache_key,
+    get_m2_cache_key,
+)
 from .ssh import ssh_check_output
+from .exceptions import SSHError
 
 FROZEN = getattr(sys, 'frozen', False)
 
@@ -29,6 +42,74 @@ SCRIPTS_DIR = os.path.join(THIS_DIR, 'scripts')
 
 logger = logging.getLogger('flintrock.services')
 
+# Executor heaps beyond ~32 GB lose compressed object pointers and tend to
+# suffer long GC pauses, so we keep each worker's memory comfortably below that.
+SPARK_MAX_WORKER_MEMORY_MB = 30 * 1024
+
+SparkWorkerLayout = namedtuple(
+    'SparkWorkerLayout', [
+        'instances',
+        'cores',
+        'memory_mb'])
+
+
+def get_spark_worker_layout(
+        *,
+        cores: int,
+        memory_mb: int,
+        max_worker_memory_mb: int=SPARK_MAX_WORKER_MEMORY_MB) -> SparkWorkerLayout:
+    """
+    Split a node's cores and memory across as few Spark workers as possible
+    such that no worker gets more than max_worker_memory_mb of memory.
+
+    We set aside some memory for the OS and the worker daemons themselves,
+    and we pick a worker count that divides the node's cores evenly so that
+    no cores sit idle.
+    """
+    reserved_memory_mb = max(1024, memory_mb // 10)
+    usable_memory_mb = max(memory_mb - reserved_memory_mb, 512)
+
+    min_instances = min(cores, math.ceil(usable_memory_mb / max_worker_memory_mb))
+    instances = next(
+        n for n in range(max(min_instances, 1), cores + 1)
+        if cores % n == 0)
+
+    return SparkWorkerLayout(
+        instances=instances,
+        cores=cores // instances,
+        memory_mb=usable_memory_mb // instances)
+
+
+HDFS_DOMAIN_SOCKET_DIR = '/var/lib/hadoop-hdfs'
+
+# How long nodes wait for the master to build Spark from source.
+SPARK_BUILD_TIMEOUT = 2 * 60 * 60
+
+APACHE_ARCHIVE_URL = 'https://archive.apache.org/dist/'
+# The Spark project mirrors its release binaries, but not their checksums, here.
+SPARK_RELATED_PACKAGES_URL = 'https://s3.amazonaws.com/spark-related-packages/'
+
+
+def get_hdfs_profile(*, num_slaves: int) -> dict:
+    """
+    Get HDFS configuration properties with sensible values for a cluster with
+    the provided number of slaves (i.e. DataNodes).
+
+    Hadoop's defaults are tuned for small clusters running on modest hardware,
+    so we bump up handler counts and transfer threads as the cluster grows and
+    enable short-circuit local reads.
+    """
+    return {
+        'dfs.replication': max(1, min(3, num_slaves)),
+        # This follows the common rule of thumb of 20 * ln(number of DataNodes).
+        'dfs.namenode.handler.count': max(10, int(20 * math.log(max(num_slaves, 1)))),
+        'dfs.datanode.handler.count': min(64, 10 + num_slaves // 10),
+        'dfs.datanode.max.transfer.threads': 16384,
+        'dfs.client.read.shortcircuit': 'true',
+        'dfs.domain.socket.path': HDFS_DOMAIN_SOCKET_DIR + '/dn_socket',
+        'io.file.buffer.size': 131072,
+    }
+
 
 class FlintrockService:
     """
@@ -36,6 +117,10 @@ class FlintrockService:
     required to fully install and manage services like Spark on Flintrock clusters.
     """
 
+    # The TCP port ranges, as (from_port, to_port) pairs, that the service needs
+    # open to clients outside the cluster, like web UIs.
+    client_ports = []
+
     def __init__(self):
         """
         This is the only method signature that implementations don't have to follow.
@@ -107,10 +192,35 @@ class FlintrockService:
 
 
 class HDFS(FlintrockService):
-    def __init__(self, *, version, download_source):
+    client_ports = [
+        (50070, 50070),  # NameNode web UI
+    ]
+
+    def __init__(self, *, version, download_source, properties: dict=None):
+        """
+        properties: Hadoop configuration properties that override the values
+                    Flintrock would otherwise pick for the cluster.
+        """
         self.version = version
         self.download_source = download_source
-        self.manifest = {'version': version, 'download_source': download_source}
+        self.properties = properties or {}
+        self.manifest = {
+            'version': version,
+            'download_source': download_source,
+            'properties': self.properties}
+
+    @property
+    def checksum_urls(self) -> list:
+        """
+        Where to look for the published SHA-512 checksum of the Hadoop release
+        we download.
+        """
+        url = self.download_source.format(v=self.version)
+        if '/closer.lua/' in url and url.endswith('?as_json'):
+            path = url.split('/closer.lua/', 1)[1][:-len('?as_json')]
+            return [APACHE_ARCHIVE_URL + path + '.sha512']
+        else:
+            return [url + '.sha512']
 
     def install(
             self,
@@ -119,34 +229,33 @@ class HDFS(FlintrockService):
         logger.info("[{h}] Installing HDFS...".format(
             h=ssh_client.get_transport().getpeername()[0]))
 
-        with ssh_client.open_sftp() as sftp:
-            sftp.put(
-                localpath=os.path.join(SCRIPTS_DIR, 'download-hadoop.py'),
-                remotepath='/tmp/download-hadoop.py')
+        fetch_artifact(
+            client=ssh_client,
+            cluster=cluster,
+            url=self.download_source.format(v=self.version),
+            name='hadoop-{v}.tar.gz'.format(v=self.version),
+            extract_dir='hadoop',
+            checksum_urls=self.checksum_urls)
 
         ssh_check_output(
             client=ssh_client,
             command="""
                 set -e
 
-                python /tmp/download-hadoop.py "{version}" "{download_source}"
-
-                mkdir "hadoop"
                 mkdir "hadoop/conf"
 
-                tar xzf "hadoop-{version}.tar.gz" -C "hadoop" --strip-components=1
-                rm "hadoop-{version}.tar.gz"
-
                 for f in $(find hadoop/bin -type f -executable -not -name '*.cmd'); do
                     sudo ln -s "$(pwd)/$f" "/usr/local/bin/$(basename $f)"
                 done
                 echo "export HADOOP_LIBEXEC_DIR='$(pwd)/hadoop/libexec'" >> .bashrc
-            """.format(version=self.version, download_source=self.download_source))
+            """)
 
     def configure(
             self,
             ssh_client: paramiko.client.SSHClient,
             cluster: FlintrockCluster):
+        host = ssh_client.get_transport().getpeername()[0]
+
         # TODO: os.walk() through these files.
         template_paths = [
             'hadoop/conf/masters',
@@ -154,8 +263,23 @@ class HDFS(FlintrockService):
             'hadoop/conf/hadoop-env.sh',
             'hadoop/conf/core-site.xml',
             'hadoop/conf/hdfs-site.xml',
+            'hadoop/conf/topology.data',
+            'hadoop/conf/topology.sh',
         ]
 
+        hdfs_properties = get_hdfs_profile(num_slaves=cluster.num_slaves)
+        hdfs_properties.update(self.properties)
+
+        # The DataNode refuses to create its domain socket in a directory that
+        # other users can write to.
+        ssh_check_output(
+            client=ssh_client,
+            command="""
+                sudo mkdir -p {d}
+                sudo chown "$(whoami):$(whoami)" {d}
+                sudo chmod 755 {d}
+            """.format(d=shlex.quote(HDFS_DOMAIN_SOCKET_DIR)))
+
         for template_path in template_paths:
             ssh_check_output(
                 client=ssh_client,
@@ -167,13 +291,21 @@ class HDFS(FlintrockService):
                             path=os.path.join(THIS_DIR, "templates", template_path),
                             mapping=generate_template_mapping(
                                 cluster=cluster,
+                                node_ip=host,
                                 hadoop_version=self.version,
                                 # Hadoop doesn't need to know what
                                 # Spark version we're using.
                                 spark_version='',
+                                hdfs_properties=hdfs_properties,
                             ))),
                     p=shlex.quote(template_path)))
 
+        ssh_check_output(
+            client=ssh_client,
+            command="""
+                chmod 755 hadoop/conf/topology.sh
+            """)
+
     # TODO: Convert this into start_master() and split master- or slave-specific
     #       stuff out of configure() into configure_master() and configure_slave().
     def configure_master(
@@ -209,6 +341,13 @@ class HDFS(FlintrockService):
 
 
 class Spark(FlintrockService):
+    client_ports = [
+        (8080, 8081),  # Master and worker web UIs
+        (4040, 4050),  # Application web UIs
+        (7077, 7077),  # Master
+        (6066, 6066),  # REST server
+    ]
+
     def __init__(
         self,
         *,
@@ -216,8 +355,19 @@ class Spark(FlintrockService):
         hadoop_version: str,
         download_source: str=None,
         git_commit: str=None,
-        git_repository: str=None
+        git_repository: str=None,
+        build_cache: str=None,
+        build_cache_endpoint_url: str=None,
+        build_cache_m2: bool=False
     ):
+        """
+        build_cache: Where to cache Spark builds from source. Either an S3 URL
+                     like s3://bucket/prefix or a local directory.
+        build_cache_endpoint_url: The endpoint of an S3-compatible store, like
+                                  MinIO, to use for an S3 build cache.
+        build_cache_m2: Whether to also cache the Maven repository that builds
+                        download their dependencies into.
+        """
         # TODO: Convert these checks into something that throws a proper exception.
         #       Perhaps reuse logic from CLI.
         assert bool(version) ^ bool(git_commit)
@@ -229,13 +379,52 @@ class Spark(FlintrockService):
         self.download_source = download_source
         self.git_commit = git_commit
         self.git_repository = git_repository
+        self.build_cache = build_cache
+        self.build_cache_endpoint_url = build_cache_endpoint_url
+        self.build_cache_m2 = build_cache_m2
 
         self.manifest = {
             'version': version,
             'hadoop_version': hadoop_version,
             'download_source': download_source,
             'git_commit': git_commit,
-            'git_repository': git_repository}
+            'git_repository': git_repository,
+            'build_cache': build_cache,
+            'build_cache_endpoint_url': build_cache_endpoint_url,
+            'build_cache_m2': build_cache_m2}
+
+    @property
+    def packages(self) -> list:
+        """
+        Maven coordinates of the packages that Spark applications on the cluster
+        get on their classpath by default.
+        """
+        return ['org.apache.hadoop:hadoop-aws:{v}'.format(v=self.hadoop_version)]
+
+    @property
+    def build_name(self) -> str:
+        """
+        The file name of the Spark distribution we build from source.
+        """
+        return 'spark-{c}-hadoop{v}.tgz'.format(
+            c=self.git_commit,
+            v='.'.join(self.hadoop_version.split('.')[:2]))
+
+    @property
+    def checksum_urls(self) -> list:
+        """
+        Where to look for the published SHA-512 checksum of the Spark release
+        we download.
+        """
+        url = self.download_source.format(v=self.version)
+        checksum_urls = [url + '.sha512']
+        if url.startswith(SPARK_RELATED_PACKAGES_URL):
+            checksum_urls.append(
+                '{a}spark/spark-{v}/{f}.sha512'.format(
+                    a=APACHE_ARCHIVE_URL,
+                    v=self.version,
+                    f=posixpath.basename(url)))
+        return checksum_urls
 
     def install(
             self,
@@ -247,44 +436,26 @@ class Spark(FlintrockService):
 
         try:
             if self.version:
-                with ssh_client.open_sftp() as sftp:
-                    sftp.put(
-                        localpath=os.path.join(SCRIPTS_DIR, 'install-spark.sh'),
-                        remotepath='/tmp/install-spark.sh')
-                    sftp.chmod(path='/tmp/install-spark.sh', mode=0o755)
                 url = self.download_source.format(v=self.version)
-                ssh_check_output(
+                fetch_artifact(
                     client=ssh_client,
-                    command="""
-                        set -e
-                        /tmp/install-spark.sh {url}
-                        rm -f /tmp/install-spark.sh
-                    """.format(url=shlex.quote(url)))
+                    cluster=cluster,
+                    url=url,
+                    name=posixpath.basename(urllib.parse.urlparse(url).path),
+                    extract_dir='spark',
+                    checksum_urls=self.checksum_urls)
             else:
-                ssh_check_output(
+                # Only the master builds Spark. The rest of the cluster waits for
+                # the build and gets it like any other artifact.
+                if ssh_client.get_transport().getpeername()[0] == cluster.master_ip:
+                    self.build(ssh_client=ssh_client, cluster=cluster)
+                fetch_artifact(
                     client=ssh_client,
-                    command="""
-                        set -e
-                        sudo yum install -y git
-                        sudo yum install -y java-devel
-                        """)
-                ssh_check_output(
-                    client=ssh_client,
-                    command="""
-                        set -e
-                        git clone {repo} spark
-                        cd spark
-                        git reset --hard {commit}
-                        if [ -e "make-distribution.sh" ]; then
-                            ./make-distribution.sh -Phadoop-{hadoop_short_version}
-                        else
-                            ./dev/make-distribution.sh -Phadoop-{hadoop_short_version}
-                        fi
-                    """.format(
-                        repo=shlex.quote(self.git_repository),
-                        commit=shlex.quote(self.git_commit),
-                        hadoop_short_version='.'.join(self.hadoop_version.split('.')[:2]),
-                    ))
+                    cluster=cluster,
+                    url='',
+                    name=self.build_name,
+                    extract_dir='spark',
+                    seed_timeout=SPARK_BUILD_TIMEOUT)
             ssh_check_output(
                 client=ssh_client,
                 command="""
@@ -300,10 +471,175 @@ class Spark(FlintrockService):
             print(e, file=sys.stderr)
             raise
 
+    def build(
+            self,
+            ssh_client: paramiko.client.SSHClient,
+            cluster: FlintrockCluster):
+        """
+        Build a Spark distribution from source and pack it into the node's
+        artifacts directory, along with its checksum, so it can be served to
+        the rest of the cluster.
+
+        If there is a build cache, we check it before building and store the
+        build in it afterwards.
+        """
+        host = ssh_client.get_transport().getpeername()[0]
+        artifact_path = posixpath.join(get_artifacts_dir(cluster), self.build_name)
+
+        if self.build_cache:
+            build_cache = get_build_cache(
+                self.build_cache,
+                endpoint_url=self.build_cache_endpoint_url)
+            build_cache_key = posixpath.join(
+                get_build_cache_key(
+                    repository=self.git_repository,
+                    commit=self.git_commit,
+                    hadoop_version=self.hadoop_version),
+                self.build_name)
+        else:
+            build_cache = None
+
+        try:
+            ssh_check_output(
+                client=ssh_client,
+                command="""
+                    mkdir -p {d}
+                """.format(d=shlex.quote(get_artifacts_dir(cluster))))
+
+            if build_cache and build_cache.restore(
+                    client=ssh_client,
+                    key=build_cache_key,
+                    remote_path=artifact_path + '.part'):
+                logger.info("[{h}] Using cached Spark build.".format(h=host))
+            else:
+                logger.info("[{h}] Building Spark...".format(h=host))
+                self._build_from_source(
+                    ssh_client=ssh_client,
+                    build_cache=build_cache,
+                    artifact_path=artifact_path)
+
+            ssh_check_output(
+                client=ssh_client,
+                command="""
+                    set -e
+                    sha512sum {p}.part | cut -d ' ' -f 1 > {p}.sha512
+                    mv {p}.part {p}
+                """.format(p=shlex.quote(artifact_path)))
+        except Exception:
+            # Let the nodes waiting on this build know that it failed.
+            ssh_check_output(
+                client=ssh_client,
+                command="""
+                    touch {p}.failed
+                """.format(p=shlex.quote(artifact_path)))
+            raise
+
+        if build_cache:
+            try:
+                build_cache.store(
+                    client=ssh_client,
+                    key=build_cache_key,
+                    remote_path=artifact_path)
+            except Exception as e:
+                logger.warning(
+                    "[{h}] Could not cache Spark build: {e}".format(h=host, e=e))
+
+    def _build_from_source(
+            self,
+            *,
+            ssh_client: paramiko.client.SSHClient,
+            build_cache: BuildCache,
+            artifact_path: str):
+        """
+        Build Spark and pack the distribution into a partial file next to
+        artifact_path.
+        """
+        host = ssh_client.get_transport().getpeername()[0]
+        cache_m2 = build_cache and self.build_cache_m2
+        m2_cache_key = get_m2_cache_key(repository=self.git_repository)
+
+        ssh_check_output(
+            client=ssh_client,
+            command="""
+                set -e
+                sudo yum install -y git
+                sudo yum install -y java-devel
+                """)
+
+        if cache_m2 and build_cache.restore(
+                client=ssh_client,
+                key=m2_cache_key,
+                remote_path='/tmp/m2.tgz'):
+            ssh_check_output(
+                client=ssh_client,
+                command="""
+                    set -e
+                    mkdir -p .m2
+                    tar xzf /tmp/m2.tgz -C .m2
+                    rm -f /tmp/m2.tgz
+                """)
+
+        ssh_check_output(
+            client=ssh_client,
+            command="""
+                set -e
+
+                git clone {repo} spark-build
+                cd spark-build
+                git reset --hard {commit}
+                if [ -e "make-distribution.sh" ]; then
+                    ./make-distribution.sh -Phadoop-{hadoop_short_version}
+                else
+                    ./dev/make-distribution.sh -Phadoop-{hadoop_short_version}
+                fi
+                cd ..
+
+                tar czf {artifact_path}.part -C spark-build dist
+                rm -rf spark-build
+            """.format(
+                repo=shlex.quote(self.git_repository),
+                commit=shlex.quote(self.git_commit),
+                hadoop_short_version='.'.join(self.hadoop_version.split('.')[:2]),
+                artifact_path=shlex.quote(artifact_path),
+            ))
+
+        if cache_m2:
+            try:
+                ssh_check_output(
+                    client=ssh_client,
+                    command="""
+                        tar czf /tmp/m2.tgz -C .m2 .
+                    """)
+                build_cache.store(
+                    client=ssh_client,
+                    key=m2_cache_key,
+                    remote_path='/tmp/m2.tgz')
+            except Exception as e:
+                logger.warning(
+                    "[{h}] Could not cache Maven repository: {e}".format(h=host, e=e))
+            finally:
+                ssh_check_output(
+                    client=ssh_client,
+                    command="""
+                        rm -f /tmp/m2.tgz
+                    """)
+
     def configure(
             self,
             ssh_client: paramiko.client.SSHClient,
             cluster: FlintrockCluster):
+        host = ssh_client.get_transport().getpeername()[0]
+
+        node_cores, node_memory_kb = ssh_check_output(
+            client=ssh_client,
+            command="""
+                nproc
+                awk '/MemTotal/ {print $2}' /proc/meminfo
+            """).split()
+        worker_layout = get_spark_worker_layout(
+            cores=int(node_cores),
+            memory_mb=int(node_memory_kb) // 1024)
+
         template_paths = [
             'spark/conf/spark-env.sh',
             'spark/conf/slaves',
@@ -320,8 +656,10 @@ class Spark(FlintrockService):
                             path=os.path.join(THIS_DIR, "templates", template_path),
                             mapping=generate_template_mapping(
                                 cluster=cluster,
+                                node_ip=host,
                                 hadoop_version=self.hadoop_version,
                                 spark_version=self.version or self.git_commit,
+                                spark_worker_layout=worker_layout,
                             ))),
                     p=shlex.quote(template_path)))
 
@@ -336,6 +674,33 @@ class Spark(FlintrockService):
         host = ssh_client.get_transport().getpeername()[0]
         logger.info("[{h}] Configuring Spark master...".format(h=host))
 
+        # Resolving packages like hadoop-aws from Maven Central can add tens of
+        # seconds to every spark-submit, so we do it once here on the master.
+        with ssh_client.open_sftp() as sftp:
+            sftp.put(
+                localpath=os.path.join(SCRIPTS_DIR, 'install-spark-packages.sh'),
+                remotepath='/tmp/install-spark-packages.sh')
+            sftp.chmod(path='/tmp/install-spark-packages.sh', mode=0o755)
+        try:
+            ssh_check_output(
+                client=ssh_client,
+                command="""
+                    /tmp/install-spark-packages.sh {d} {p}
+                """.format(
+                    d=shlex.quote(posixpath.join(cluster.storage_dirs.root, 'spark-packages')),
+                    p=shlex.quote(','.join(self.packages))))
+        except SSHError as e:
+            # Maven Central may not be reachable, e.g. from a locked-down subnet.
+            # Spark still works; applications just have to bring their own jars.
+            logger.warning(
+                "[{h}] Could not install Spark packages: {e}".format(h=host, e=e))
+        finally:
+            ssh_check_output(
+                client=ssh_client,
+                command="""
+                    rm -f /tmp/install-spark-packages.sh
+                """)
+
         # TODO: Maybe move this shell script out to some separate file/folder
         #       for the Spark service.
         # TODO: Add some timeout for waiting on master UI to come up.
@@ -53,10 +53,14 @@ def get_ssh_client(
         host: str,
         identity_file: str,
         wait: bool=False,
-        print_status: bool=None) -> paramiko.client.SSHClient:
+        print_status: bool=None,
+        stop_waiting=None) -> paramiko.client.SSHClient:
     """
     Get an SSH client for the provided host, waiting as necessary for SSH to become
     available.
+
+    If provided, we call stop_waiting before each connection attempt, and give up
+    if it returns True, e.g. because the host is known to be unreachable.
     """
     if print_status is None:
         print_status = wait
@@ -72,6 +76,10 @@ def get_ssh_client(
         tries = 1
 
     while tries > 0:
+        if stop_waiting and stop_waiting():
+            raise SSHError(
+                host=host,
+                message="Gave up waiting for SSH.")
         try:
             tries -= 1
             client.connect(
@@ -0,0 +1,12 @@
+#!/usr/bin/env bash
+
+# Hadoop calls this script with one or more host names or IP addresses and
+# expects back one rack per argument, in order.
+# See: https://hadoop.apache.org/docs/r2.7.3/hadoop-project-dist/hadoop-common/RackAwareness.html
+
+topology_data="$(dirname "$0")/topology.data"
+
+for node in "$@"; do
+    rack="$(awk -v node="$node" '$1 == node {{ print $2; exit }}' "$topology_data")"
+    echo "${{rack:-/default-zone/default}}"
+done
@@ -4,18 +4,19 @@ export SPARK_LOCAL_DIRS="{spark_root_ephemeral_dirs}"
 
 # Standalone cluster options
 export SPARK_EXECUTOR_INSTANCES="1"
-export SPARK_WORKER_CORES="$(nproc)"
+{spark_worker_settings}
 
 export SPARK_MASTER_HOST="{master_host}"
 
 # TODO: Make this dependent on HDFS install.
 export HADOOP_CONF_DIR="$HOME/hadoop/conf"
 
-# TODO: Make this non-EC2-specific.
-# Bind Spark's web UIs to this machine's public EC2 hostname
-export SPARK_PUBLIC_DNS="$(curl --silent http://169.254.169.254/latest/meta-data/public-hostname)"
+# Bind Spark's web UIs to this machine's public hostname, and Spark itself
+# to this machine's private IP address.
+export SPARK_PUBLIC_DNS="{node_host}"
+export SPARK_LOCAL_IP="{node_private_ip}"
 
-# TODO: Set a high ulimit for large shuffles
-# Need to find a way to do this, since "sudo ulimit..." doesn't fly.
-# Probably need to edit some Linux config file.
-# ulimit -n 1000000
+# Flintrock raises the open files limit for large shuffles via limits.d.
+# Make sure we're actually using it in case this session started with a
+# lower soft limit.
+ulimit -n "$(ulimit -H -n)"
@@ -49,8 +49,8 @@ setuptools.setup(
     # totally break Flintrock.
     # For example: https://github.com/paramiko/paramiko/issues/615
     install_requires=[
-        'boto3 == 1.4.4',
-        'botocore == 1.5.10',
+        'boto3 == 1.9.253',
+        'botocore == 1.12.253',
         'click == 6.7',
         'paramiko == 2.1.1',
         'PyYAML == 3.12',
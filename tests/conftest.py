@@ -5,7 +5,7 @@ import uuid
 from collections import OrderedDict
 
 # Flintrock
-from flintrock.core import StorageDirs
+from flintrock.core import StorageDirs, NodeTopology
 
 # External
 import pytest
@@ -32,8 +32,14 @@ def dummy_cluster():
     cluster.storage_dirs = storage_dirs
     cluster.master_ip = '10.0.0.1'
     cluster.master_host = 'master.hostname'
+    cluster.master_private_ip = '172.16.0.1'
     cluster.slave_ips = ['10.0.0.2']
     cluster.slave_hosts = ['slave1.hostname']
+    cluster.slave_private_ips = ['172.16.0.2']
+    cluster.topology = {
+        '10.0.0.1': NodeTopology(zone='us-east-1a', placement_group=None, partition=None),
+        '10.0.0.2': NodeTopology(zone='us-east-1b', placement_group=None, partition=None),
+    }
 
     return cluster
 
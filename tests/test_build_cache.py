@@ -0,0 +1,42 @@
+import pytest
+
+# Flintrock modules
+from flintrock.build_cache import (
+    LocalBuildCache,
+    S3BuildCache,
+    get_build_cache,
+    get_build_cache_key,
+)
+
+
+def test_build_cache_key():
+    key = get_build_cache_key(
+        repository='https://github.com/apache/spark',
+        commit='0626b11147133b67b26a04b4819f61a33dd958d3',
+        hadoop_version='2.7.3')
+
+    assert key.endswith('/0626b11147133b67b26a04b4819f61a33dd958d3/hadoop2.7')
+    assert key != get_build_cache_key(
+        repository='https://github.com/example/spark',
+        commit='0626b11147133b67b26a04b4819f61a33dd958d3',
+        hadoop_version='2.7.3')
+    assert key != get_build_cache_key(
+        repository='https://github.com/apache/spark',
+        commit='0626b11147133b67b26a04b4819f61a33dd958d3',
+        hadoop_version='2.6.5')
+
+
+@pytest.mark.parametrize(
+    'location, cache_type', [
+        ('s3://bucket/spark-builds', S3BuildCache),
+        ('~/.flintrock/spark-builds', LocalBuildCache),
+    ])
+def test_get_build_cache(location, cache_type):
+    build_cache = get_build_cache(location, endpoint_url='http://localhost:9000')
+    assert isinstance(build_cache, cache_type)
+
+
+def test_s3_build_cache_object_key():
+    build_cache = get_build_cache('s3://bucket/spark-builds/', endpoint_url='http://localhost:9000')
+    assert build_cache.bucket == 'bucket'
+    assert build_cache.get_object_key('a/b.tgz') == 'spark-builds/a/b.tgz'
@@ -1,8 +1,12 @@
 import os
+import subprocess
 import pytest
 
 # Flintrock
+from flintrock.exceptions import Error
 from flintrock.core import (
+    NodeTopology,
+    check_image_services,
     generate_template_mapping,
     get_formatted_template,
 )
@@ -27,6 +31,7 @@ def test_templates(dummy_cluster, spark_version):
                 template_path = os.path.join(dirpath, filename)
                 mapping = generate_template_mapping(
                     cluster=dummy_cluster,
+                    node_ip=dummy_cluster.master_ip,
                     hadoop_version='',
                     spark_version=spark_version,
                 )
@@ -34,3 +39,82 @@ def test_templates(dummy_cluster, spark_version):
                     path=template_path,
                     mapping=mapping,
                 )
+
+
+def test_hdfs_properties_mapping(dummy_cluster):
+    mapping = generate_template_mapping(
+        cluster=dummy_cluster,
+        node_ip=dummy_cluster.master_ip,
+        hadoop_version='',
+        spark_version='',
+        hdfs_properties={
+            'dfs.replication': 2,
+            'io.file.buffer.size': 131072,
+        },
+    )
+    assert '<name>dfs.replication</name>' in mapping['hdfs_site_properties']
+    assert '<name>io.file.buffer.size</name>' in mapping['core_site_properties']
+    assert 'dfs.replication' not in mapping['core_site_properties']
+
+
+def test_node_topology_rack():
+    assert NodeTopology(zone='us-east-1a', placement_group=None, partition=None).rack == \
+        '/us-east-1a/default'
+    assert NodeTopology(zone='us-east-1a', placement_group='pg', partition=2).rack == \
+        '/us-east-1a/partition-2'
+
+
+def test_topology_script(dummy_cluster, tmpdir):
+    mapping = generate_template_mapping(
+        cluster=dummy_cluster,
+        node_ip=dummy_cluster.master_ip,
+        hadoop_version='',
+        spark_version='',
+    )
+    for filename in ['topology.sh', 'topology.data']:
+        tmpdir.join(filename).write(
+            get_formatted_template(
+                path=os.path.join(FLINTROCK_ROOT_DIR, 'flintrock', 'templates', 'hadoop', 'conf', filename),
+                mapping=mapping))
+
+    output = subprocess.check_output(
+        ['bash', str(tmpdir.join('topology.sh')), '10.0.0.2', '10.0.0.1', '10.0.0.9'])
+    assert output.decode('utf-8').split() == [
+        '/us-east-1b/default',
+        '/us-east-1a/default',
+        '/default-zone/default',
+    ]
+
+
+def test_node_specific_mapping(dummy_cluster):
+    mapping = generate_template_mapping(
+        cluster=dummy_cluster,
+        node_ip='10.0.0.2',
+        hadoop_version='',
+        spark_version='',
+    )
+    assert mapping['node_host'] == 'slave1.hostname'
+    assert mapping['node_private_ip'] == '172.16.0.2'
+
+
+def test_check_image_services():
+    from flintrock.services import HDFS, Spark
+
+    image_services = [
+        ['HDFS', HDFS(version='2.7.3', download_source='http://example.com/{v}').manifest],
+        ['Spark', Spark(version='2.1.1', hadoop_version='2.7.3', download_source='http://example.com/{v}').manifest],
+    ]
+
+    # Settings that only affect configuration don't need a new image.
+    check_image_services(
+        image_services=image_services,
+        services=[
+            HDFS(
+                version='2.7.3',
+                download_source='http://example.com/{v}',
+                properties={'dfs.replication': '2'})])
+
+    with pytest.raises(Error):
+        check_image_services(
+            image_services=image_services,
+            services=[Spark(version='2.2.0', hadoop_version='2.7.3', download_source='http://example.com/{v}')])
@@ -1,6 +1,29 @@
+import concurrent.futures
+import time
+from collections import namedtuple
+
+import botocore
 import pytest
 import click
-from flintrock.ec2 import validate_tags
+
+import flintrock.ec2
+from flintrock.exceptions import Error, InterruptedEC2Operation, SSHError
+from flintrock.ec2 import (
+    EC2Cluster,
+    SecurityGroupRule,
+    _create_fleet_instances,
+    _create_instances,
+    _create_instances_from_launch_template,
+    _map_instance_batches,
+    get_client,
+    get_launch_template_name,
+    get_missing_rules,
+    get_resource,
+    rank_spot_options,
+    set_security_groups,
+    validate_fleet_instance_types,
+    validate_tags,
+)
 
 
 def test_validate_tags():
@@ -30,3 +53,422 @@ def test_validate_tags():
     for test_case in negative_test_cases:
         with pytest.raises(click.BadParameter):
             validate_tags(test_case)
+
+
+def test_get_client_is_cached():
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        clients = list(executor.map(
+            lambda _: get_client('ec2', region='us-east-1'),
+            range(16)))
+
+    assert all(c is clients[0] for c in clients)
+    assert get_client('ec2', region='us-west-2') is not clients[0]
+    assert clients[0].meta.config.max_pool_connections > 10
+
+
+def test_get_resource_is_not_shared():
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        resources = list(executor.map(
+            lambda _: get_resource('ec2', region='us-east-1'),
+            range(4)))
+
+    assert len(set(id(r) for r in resources)) == len(resources)
+    assert all(r.meta.client.meta.region_name == 'us-east-1' for r in resources)
+
+
+def test_map_instance_batches():
+    instance_ids = ['i-{n}'.format(n=n) for n in range(450)]
+    batches = []
+
+    def describe_batch(batch):
+        batches.append(batch)
+        return batch
+
+    assert _map_instance_batches(describe_batch, instance_ids) == instance_ids
+    assert sorted(len(b) for b in batches) == [50, 200, 200]
+    assert _map_instance_batches(describe_batch, []) == []
+
+
+def test_get_instance_statuses_batch_size(monkeypatch):
+    instance_ids = ['i-{n}'.format(n=n) for n in range(250)]
+    batches = []
+
+    class FakeClient:
+        def describe_instance_status(self, *, InstanceIds, IncludeAllInstances):
+            batches.append(InstanceIds)
+            return {'InstanceStatuses': [{'InstanceId': i} for i in InstanceIds]}
+
+    monkeypatch.setattr(flintrock.ec2, 'get_client', lambda *args, **kwargs: FakeClient())
+
+    statuses = flintrock.ec2.get_instance_statuses(instance_ids=instance_ids, region='us-east-1')
+
+    assert sorted(statuses) == sorted(instance_ids)
+    assert sorted(len(b) for b in batches) == [50, 100, 100]
+
+
+def test_wait_for_state(monkeypatch):
+    FakeInstance = namedtuple('FakeInstance', ['id', 'state'])
+    states = {'i-1': ['running'], 'i-2': ['pending', 'pending', 'running']}
+    described_ids = []
+    sleeps = []
+
+    def describe_instances(*, instance_ids, region):
+        described_ids.append(instance_ids)
+        return [
+            FakeInstance(id=i, state={'Name': states[i].pop(0)})
+            for i in instance_ids]
+
+    monkeypatch.setattr(flintrock.ec2, 'describe_instances', describe_instances)
+    monkeypatch.setattr(flintrock.ec2.time, 'sleep', sleeps.append)
+
+    cluster = EC2Cluster(
+        name='test',
+        region='us-east-1',
+        vpc_id='vpc-1',
+        master_instance=FakeInstance(id='i-1', state={'Name': 'pending'}),
+        slave_instances=[FakeInstance(id='i-2', state={'Name': 'pending'})])
+    cluster.wait_for_state('running')
+
+    # Instances that reach the state aren't described again.
+    assert described_ids == [['i-1', 'i-2'], ['i-2'], ['i-2']]
+    # We back off while no instance makes progress.
+    assert sleeps == [1, 1, 2]
+    assert cluster.state == 'running'
+    assert cluster.master_instance.id == 'i-1'
+
+
+def get_instance_status(instance_id, status):
+    return {
+        'InstanceId': instance_id,
+        'SystemStatus': {'Status': status},
+        'InstanceStatus': {'Status': status}}
+
+
+def test_watch_status_checks(monkeypatch):
+    FakeInstance = namedtuple(
+        'FakeInstance',
+        ['id', 'state', 'public_ip_address', 'public_dns_name', 'private_ip_address'])
+    statuses = {
+        'i-1': ['initializing', 'ok'],
+        'i-2': ['insufficient-data', 'initializing', 'impaired'],
+    }
+    polled_ids = []
+
+    def get_instance_statuses(*, instance_ids, region):
+        polled_ids.append(sorted(instance_ids))
+        return {
+            i: get_instance_status(i, statuses[i].pop(0))
+            for i in instance_ids}
+
+    monkeypatch.setattr(flintrock.ec2, 'get_instance_statuses', get_instance_statuses)
+    monkeypatch.setattr(flintrock.ec2, 'WAIT_MIN_INTERVAL', 0)
+    monkeypatch.setattr(flintrock.ec2, 'WAIT_MAX_INTERVAL', 0)
+
+    cluster = EC2Cluster(
+        name='test',
+        region='us-east-1',
+        vpc_id='vpc-1',
+        master_instance=FakeInstance('i-1', {'Name': 'running'}, '1.1.1.1', 'master', '10.0.0.1'),
+        slave_instances=[
+            FakeInstance('i-2', {'Name': 'running'}, '1.1.1.2', 'slave', '10.0.0.2')])
+
+    with pytest.raises(Error) as e:
+        with cluster.watch_status_checks():
+            # Stand-in for waiting on SSH, which gives up on unreachable hosts.
+            while not cluster.is_unreachable('1.1.1.2'):
+                time.sleep(0.01)
+            raise SSHError(host='1.1.1.2', message="Gave up waiting for SSH.")
+
+    assert 'i-2' in str(e.value)
+    assert not cluster.is_unreachable('1.1.1.1')
+    # We stop polling instances once their status checks pass or fail.
+    assert polled_ids == [['i-1', 'i-2'], ['i-1', 'i-2'], ['i-2']]
+
+
+def test_set_security_groups_backs_off(monkeypatch):
+    calls = []
+
+    class FakeClient:
+        def modify_instance_attribute(self, *, InstanceId, Groups):
+            calls.append(InstanceId)
+            if calls.count(InstanceId) == 1:
+                raise botocore.exceptions.ClientError(
+                    {'Error': {'Code': 'RequestLimitExceeded', 'Message': 'Slow down.'}},
+                    'ModifyInstanceAttribute')
+
+    monkeypatch.setattr(flintrock.ec2, 'get_client', lambda *args, **kwargs: FakeClient())
+    monkeypatch.setattr(flintrock.ec2.time, 'sleep', lambda _: None)
+
+    instance_ids = ['i-{n}'.format(n=n) for n in range(25)]
+    set_security_groups(instance_ids=instance_ids, region='us-east-1', group_ids=['sg-1'])
+
+    assert sorted(calls) == sorted(instance_ids * 2)
+
+
+def test_get_missing_rules():
+    ip_permissions = [
+        {
+            'IpProtocol': 'tcp',
+            'FromPort': 22,
+            'ToPort': 22,
+            'IpRanges': [{'CidrIp': '1.2.3.4/32'}, {'CidrIp': '5.6.7.8/32'}],
+            'UserIdGroupPairs': [],
+        },
+        {
+            'IpProtocol': '-1',
+            'IpRanges': [],
+            'UserIdGroupPairs': [{'GroupId': 'sg-1', 'UserId': '1234'}],
+        },
+    ]
+    ssh_rule = SecurityGroupRule(
+        ip_protocol='tcp', from_port=22, to_port=22, src_group=None, cidr_ip='5.6.7.8/32')
+    hdfs_rule = ssh_rule._replace(from_port=50070, to_port=50070)
+    cluster_rule = SecurityGroupRule(
+        ip_protocol='-1', from_port=-1, to_port=-1, src_group='sg-1', cidr_ip=None)
+
+    assert get_missing_rules(
+        ip_permissions=ip_permissions,
+        rules=[ssh_rule, hdfs_rule, cluster_rule]) == [hdfs_rule]
+
+
+def test_create_instances_tags_on_create(monkeypatch):
+    create_calls = []
+
+    class FakeEC2:
+        def create_instances(self, **kwargs):
+            create_calls.append(kwargs)
+            return ['i-1']
+
+    monkeypatch.setattr(flintrock.ec2, 'get_resource', lambda *args, **kwargs: FakeEC2())
+
+    tags = [{'Key': 'flintrock-role', 'Value': 'slave'}]
+    instances = _create_instances(
+        num_instances=1,
+        region='us-east-1',
+        spot_price=0.1,
+        ami='ami-1',
+        assume_yes=True,
+        key_name='key',
+        instance_type='m3.medium',
+        block_device_mappings=[],
+        availability_zone='',
+        placement_group='',
+        tenancy='default',
+        security_group_ids=['sg-1'],
+        subnet_id='',
+        instance_profile_arn='',
+        ebs_optimized=False,
+        instance_initiated_shutdown_behavior='stop',
+        user_data='',
+        tags=tags)
+
+    assert instances == ['i-1']
+    (create_call,) = create_calls
+    assert create_call['TagSpecifications'] == [{'ResourceType': 'instance', 'Tags': tags}]
+    assert create_call['InstanceMarketOptions']['SpotOptions']['MaxPrice'] == '0.1'
+    assert create_call['InstanceInitiatedShutdownBehavior'] == 'terminate'
+
+
+def test_validate_fleet_instance_types():
+    assert validate_fleet_instance_types(['m5.xlarge', 'm5.2xlarge:2']) == [
+        ('m5.xlarge', 1),
+        ('m5.2xlarge', 2)]
+
+    for fleet_instance_type in ['m5.xlarge:', 'm5.xlarge:0', 'm5.xlarge:1.5', ':2']:
+        with pytest.raises(ValueError):
+            validate_fleet_instance_types([fleet_instance_type])
+
+
+def test_create_fleet_instances(monkeypatch):
+    fleet_requests = []
+    deleted_templates = []
+
+    class FakeClient:
+        def create_launch_template(self, *, LaunchTemplateName, LaunchTemplateData):
+            return {'LaunchTemplate': {'LaunchTemplateId': 'lt-1'}}
+
+        def delete_launch_template(self, *, LaunchTemplateId):
+            deleted_templates.append(LaunchTemplateId)
+
+        def create_fleet(self, **kwargs):
+            fleet_requests.append(kwargs)
+            return {
+                'Instances': [
+                    {
+                        'InstanceIds': ['i-1', 'i-2'],
+                        'LaunchTemplateAndOverrides': {'Overrides': {'InstanceType': 'm5.2xlarge'}},
+                    }],
+                'Errors': [
+                    {'ErrorMessage': 'There is no Spot capacity available.'}],
+            }
+
+    monkeypatch.setattr(flintrock.ec2, 'get_client', lambda *args, **kwargs: FakeClient())
+    monkeypatch.setattr(
+        flintrock.ec2, 'describe_instances',
+        lambda *, instance_ids, region: instance_ids)
+
+    def create_fleet_instances(num_units):
+        return _create_fleet_instances(
+            num_units=num_units,
+            region='us-east-1',
+            spot_price=0.1,
+            fleet_instance_types=[('m5.xlarge', 1), ('m5.2xlarge', 2)],
+            fleet_subnet_ids=['subnet-1', 'subnet-2'],
+            availability_zone='',
+            subnet_id='',
+            launch_template_data={})
+
+    assert create_fleet_instances(4) == ['i-1', 'i-2']
+    overrides = fleet_requests[0]['LaunchTemplateConfigs'][0]['Overrides']
+    assert len(overrides) == 4
+    assert {o['MaxPrice'] for o in overrides if o['InstanceType'] == 'm5.2xlarge'} == {'0.2'}
+
+    # Partial capacity isn't enough. We give back what we got so it can be
+    # cleaned up.
+    with pytest.raises(InterruptedEC2Operation) as e:
+        create_fleet_instances(6)
+    assert e.value.instances == ['i-1', 'i-2']
+    assert deleted_templates == ['lt-1', 'lt-1']
+
+
+def test_rank_spot_options():
+    spot_prices = {
+        ('m5.xlarge', 'us-east-1a'): 0.08,
+        ('m5.xlarge', 'us-east-1b'): 0.06,
+        ('m5.2xlarge', 'us-east-1a'): 0.10,
+        ('c5.2xlarge', 'us-east-1a'): 0.09,
+        ('r5.4xlarge', 'us-east-1a'): 0.50,
+    }
+    spot_advisor_data = {
+        'instance_types': {
+            'm5.xlarge': {'cores': 4},
+            'm5.2xlarge': {'cores': 8},
+            'c5.2xlarge': {'cores': 8},
+            'r5.4xlarge': {'cores': 16},
+        },
+        'spot_advisor': {
+            'us-east-1': {
+                'Linux': {
+                    'm5.xlarge': {'r': 0},
+                    'm5.2xlarge': {'r': 1},
+                    # Cheapest per core, but interrupted too often.
+                    'c5.2xlarge': {'r': 3},
+                },
+            },
+        },
+    }
+
+    spot_options = rank_spot_options(
+        spot_prices=spot_prices,
+        spot_advisor_data=spot_advisor_data,
+        region='us-east-1',
+        max_price=0.2)
+
+    assert [(o.instance_type, o.availability_zone) for o in spot_options] == [
+        ('m5.2xlarge', 'us-east-1a'),
+        ('m5.xlarge', 'us-east-1b'),
+        ('m5.xlarge', 'us-east-1a'),
+    ]
+
+
+def test_rank_spot_options_without_cores():
+    spot_prices = {
+        ('m5.4xlarge', 'us-east-1a'): 0.80,
+        # Too new for the Spot Instance Advisor data, so we don't know its cores.
+        ('m7i.4xlarge', 'us-east-1a'): 0.40,
+    }
+    spot_advisor_data = {
+        'instance_types': {
+            'm5.4xlarge': {'cores': 16},
+        },
+    }
+
+    spot_options = rank_spot_options(
+        spot_prices=spot_prices,
+        spot_advisor_data=spot_advisor_data,
+        region='us-east-1',
+        max_price=1)
+
+    # Without core counts for every option, we rank by price alone.
+    assert [o.instance_type for o in spot_options] == ['m7i.4xlarge', 'm5.4xlarge']
+
+
+def test_create_instances_from_launch_template(monkeypatch):
+    create_calls = []
+
+    class FakeEC2:
+        def create_instances(self, **kwargs):
+            create_calls.append(kwargs)
+            if kwargs['LaunchTemplate']['LaunchTemplateName'] != 'flintrock-test-vpc-1':
+                raise botocore.exceptions.ClientError(
+                    {'Error': {'Code': 'InvalidLaunchTemplateName.NotFoundException', 'Message': ''}},
+                    'RunInstances')
+            return ['i-1', 'i-2']
+
+    monkeypatch.setattr(flintrock.ec2, 'get_resource', lambda *args, **kwargs: FakeEC2())
+
+    def create_instances(cluster_name):
+        return _create_instances_from_launch_template(
+            launch_template_name=get_launch_template_name(cluster_name=cluster_name, vpc_id='vpc-1'),
+            num_instances=2,
+            region='us-east-1',
+            spot_price=None,
+            placement={'AvailabilityZone': 'us-east-1a', 'GroupName': '', 'Tenancy': 'default', 'HostId': ''},
+            subnet_id='subnet-1',
+            tags=[])
+
+    assert create_instances('test') == ['i-1', 'i-2']
+    assert create_calls[0]['Placement'] == {
+        'AvailabilityZone': 'us-east-1a', 'GroupName': '', 'Tenancy': 'default'}
+    assert create_calls[0]['SubnetId'] == 'subnet-1'
+    assert create_instances('older-cluster') is None
+
+
+def test_get_resized_launch_template_block_device_mappings(monkeypatch):
+    class FakeClient:
+        def describe_launch_template_versions(self, *, LaunchTemplateName, Versions):
+            if LaunchTemplateName != 'flintrock-test-vpc-1':
+                raise botocore.exceptions.ClientError(
+                    {'Error': {'Code': 'InvalidLaunchTemplateName.NotFoundException', 'Message': ''}},
+                    'DescribeLaunchTemplateVersions')
+            return {
+                'LaunchTemplateVersions': [{
+                    'LaunchTemplateData': {
+                        'BlockDeviceMappings': [
+                            {'DeviceName': '/dev/xvda', 'Ebs': {'VolumeSize': 30, 'VolumeType': 'gp2'}},
+                            {'DeviceName': '/dev/sdb', 'VirtualName': 'ephemeral0'}]}}]}
+
+    monkeypatch.setattr(flintrock.ec2, 'get_client', lambda *args, **kwargs: FakeClient())
+
+    def get_block_device_mappings(name, min_root_ebs_size_gb):
+        return flintrock.ec2.get_resized_launch_template_block_device_mappings(
+            name=name,
+            region='us-east-1',
+            min_root_ebs_size_gb=min_root_ebs_size_gb)
+
+    assert get_block_device_mappings('flintrock-test-vpc-1', 30) is None
+    assert get_block_device_mappings('flintrock-test-vpc-1', 100) == [
+        {'DeviceName': '/dev/xvda', 'Ebs': {'VolumeSize': 100, 'VolumeType': 'gp2'}},
+        {'DeviceName': '/dev/sdb', 'VirtualName': 'ephemeral0'}]
+    assert get_block_device_mappings('flintrock-older-cluster-vpc-1', 100) is None
+
+
+def test_get_clusters_in_regions(monkeypatch):
+    def fake_get_clusters(*, cluster_names, region, vpc_id):
+        if region == 'eu-west-1':
+            raise flintrock.ec2.ClusterNotFound("No such cluster.")
+        return [region + '-cluster']
+
+    monkeypatch.setattr(flintrock.ec2, 'get_clusters', fake_get_clusters)
+
+    region_clusters = list(flintrock.ec2.get_clusters_in_regions(
+        cluster_name='test',
+        regions=['us-east-1', 'eu-west-1', 'ap-south-1']))
+
+    assert sorted(
+        (rc.region, rc.clusters) for rc in region_clusters) == [
+        ('ap-south-1', ['ap-south-1-cluster']),
+        ('eu-west-1', []),
+        ('us-east-1', ['us-east-1-cluster']),
+    ]
+    assert all(rc.duration >= 0 for rc in region_clusters)
@@ -1,4 +1,5 @@
 # External modules
+import click
 import pytest
 
 # Flintrock modules
@@ -10,7 +11,8 @@ from flintrock.flintrock import (
     variable_name_to_option_name,
     option_requires,
     mutually_exclusive,
-    get_latest_commit
+    get_latest_commit,
+    validate_properties,
 )
 
 
@@ -138,3 +140,17 @@ def test_get_latest_commit():
 
     with pytest.raises(Exception):
         get_latest_commit("https://github.com/apache/nonexistent-repo")
+
+
+def test_validate_properties():
+    assert validate_properties(['dfs.replication=2', ' io.file.buffer.size = 65536 ']) == {
+        'dfs.replication': '2',
+        'io.file.buffer.size': '65536',
+    }
+    assert validate_properties(['fs.s3a.endpoint=s3.amazonaws.com?a=b']) == {
+        'fs.s3a.endpoint': 's3.amazonaws.com?a=b',
+    }
+
+    for test_case in [['dfs.replication'], ['=2'], [' =2']]:
+        with pytest.raises(click.BadParameter):
+            validate_properties(test_case)
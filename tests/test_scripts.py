@@ -0,0 +1,324 @@
+import hashlib
+import importlib.util
+import io
+import os
+import socket
+import subprocess
+import sys
+import tarfile
+import time
+
+import pytest
+
+FLINTROCK_ROOT_DIR = (
+    os.path.dirname(
+        os.path.dirname(
+            os.path.realpath(__file__))))
+
+SCRIPTS_DIR = os.path.join(FLINTROCK_ROOT_DIR, 'flintrock', 'scripts')
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def load_script(name):
+    spec = importlib.util.spec_from_file_location(
+        name.replace('-', '_'),
+        os.path.join(SCRIPTS_DIR, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_artifact(path, contents=b'spark'):
+    with tarfile.open(str(path), 'w:gz') as tar:
+        info = tarfile.TarInfo('spark-2.1.1/RELEASE')
+        info.size = len(contents)
+        tar.addfile(info, io.BytesIO(contents))
+
+
+def fetch_artifact(*args):
+    return subprocess.call(
+        [sys.executable, os.path.join(SCRIPTS_DIR, 'fetch-artifact.py')] +
+        [str(arg) for arg in args])
+
+
+@pytest.fixture
+def artifact_server(tmpdir):
+    served_dir = tmpdir.mkdir('served')
+    port = get_free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(SCRIPTS_DIR, 'serve-artifacts.py'), str(served_dir), str(port)])
+
+    for _ in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+
+    yield served_dir, 'http://127.0.0.1:{p}'.format(p=port)
+
+    server.terminate()
+    server.wait()
+
+
+def test_fetch_artifact_from_seed(tmpdir, artifact_server):
+    served_dir, seed_url = artifact_server
+    write_artifact(served_dir.join('spark.tgz'))
+    artifacts_dir = tmpdir.join('artifacts')
+
+    ret = fetch_artifact('file:///does/not/exist', artifacts_dir, 'spark.tgz', '--seed-url', seed_url)
+
+    assert ret == 0
+    assert artifacts_dir.join('spark.tgz').read_binary() == served_dir.join('spark.tgz').read_binary()
+
+
+def test_fetch_artifact_falls_back_to_source(tmpdir, artifact_server):
+    served_dir, seed_url = artifact_server
+    served_dir.join('spark.tgz.failed').write('')
+    source_path = tmpdir.join('source.tgz')
+    write_artifact(source_path)
+    artifacts_dir = tmpdir.join('artifacts')
+
+    ret = fetch_artifact('file://' + str(source_path), artifacts_dir, 'spark.tgz', '--seed-url', seed_url)
+
+    assert ret == 0
+    assert artifacts_dir.join('spark.tgz').read_binary() == source_path.read_binary()
+
+
+def test_fetch_artifact_skips_seed_without_artifact(tmpdir, artifact_server):
+    served_dir, seed_url = artifact_server
+    source_path = tmpdir.join('source.tgz')
+    write_artifact(source_path)
+    artifacts_dir = tmpdir.join('artifacts')
+
+    start_time = time.time()
+    ret = fetch_artifact('file://' + str(source_path), artifacts_dir, 'spark.tgz', '--seed-url', seed_url)
+
+    assert ret == 0
+    assert time.time() - start_time < 10
+    assert artifacts_dir.join('spark.tgz').read_binary() == source_path.read_binary()
+
+
+def test_fetch_artifact_waits_on_pending_seed(tmpdir, artifact_server):
+    served_dir, seed_url = artifact_server
+    served_dir.join('.pending').write('')
+    artifacts_dir = tmpdir.join('artifacts')
+
+    start_time = time.time()
+    ret = fetch_artifact(
+        '', artifacts_dir, 'spark.tgz',
+        '--seed-url', seed_url,
+        '--seed-timeout', 6)
+
+    assert ret == 1
+    assert time.time() - start_time >= 6
+    assert artifacts_dir.join('spark.tgz.failed').check()
+
+
+def test_fetch_artifact_from_fallback_seed(tmpdir, artifact_server):
+    served_dir, fallback_seed_url = artifact_server
+    write_artifact(served_dir.join('spark.tgz'))
+    seed_dir = tmpdir.mkdir('seed')
+    artifacts_dir = tmpdir.join('artifacts')
+
+    port = get_free_port()
+    seed = subprocess.Popen(
+        [sys.executable, os.path.join(SCRIPTS_DIR, 'serve-artifacts.py'), str(seed_dir), str(port)])
+    try:
+        time.sleep(1)
+        ret = fetch_artifact(
+            '', artifacts_dir, 'spark.tgz',
+            '--seed-url', 'http://127.0.0.1:{p}'.format(p=port),
+            '--fallback-seed-url', fallback_seed_url)
+    finally:
+        seed.terminate()
+        seed.wait()
+
+    assert ret == 0
+    assert artifacts_dir.join('spark.tgz').read_binary() == served_dir.join('spark.tgz').read_binary()
+
+
+def test_fetch_artifact_extracts_while_downloading(tmpdir, artifact_server):
+    served_dir, seed_url = artifact_server
+    write_artifact(served_dir.join('spark.tgz'), contents=b'Spark 2.1.1')
+    artifacts_dir = tmpdir.join('artifacts')
+    spark_dir = tmpdir.join('spark')
+
+    ret = fetch_artifact(
+        'file:///does/not/exist', artifacts_dir, 'spark.tgz',
+        '--seed-url', seed_url,
+        '--extract-to', spark_dir)
+
+    assert ret == 0
+    assert spark_dir.join('RELEASE').read_binary() == b'Spark 2.1.1'
+    assert artifacts_dir.join('spark.tgz').check()
+
+
+def test_fetch_artifact_rejects_corrupt_downloads(tmpdir, artifact_server):
+    served_dir, seed_url = artifact_server
+    served_dir.join('spark.tgz').write('not a tarball')
+    source_path = tmpdir.join('source.tgz')
+    write_artifact(source_path)
+    artifacts_dir = tmpdir.join('artifacts')
+
+    ret = fetch_artifact(
+        'file://' + str(source_path), artifacts_dir, 'spark.tgz',
+        '--seed-url', seed_url,
+        '--extract-to', tmpdir.join('spark'))
+
+    assert ret == 0
+    assert artifacts_dir.join('spark.tgz').read_binary() == source_path.read_binary()
+
+
+def test_download_in_pieces(tmpdir, artifact_server, monkeypatch):
+    fetch_artifact_module = load_script('fetch-artifact')
+    monkeypatch.setattr(fetch_artifact_module, 'PIECE_SIZE', 1000)
+
+    served_dir, seed_url = artifact_server
+    write_artifact(served_dir.join('spark.tgz'), contents=os.urandom(20000))
+    path = tmpdir.join('spark.tgz')
+
+    fetch_artifact_module.download(seed_url + '/spark.tgz', str(path))
+
+    assert path.read_binary() == served_dir.join('spark.tgz').read_binary()
+
+
+def test_download_resumes(tmpdir, artifact_server, monkeypatch, capsys):
+    fetch_artifact_module = load_script('fetch-artifact')
+    monkeypatch.setattr(fetch_artifact_module, 'PIECE_SIZE', 1000)
+
+    served_dir, seed_url = artifact_server
+    write_artifact(served_dir.join('spark.tgz'), contents=os.urandom(20000))
+    contents = served_dir.join('spark.tgz').read_binary()
+    path = tmpdir.join('spark.tgz')
+    tmpdir.join('spark.tgz.part').write_binary(contents[:5500])
+
+    fetch_artifact_module.download(seed_url + '/spark.tgz', str(path), str(tmpdir.join('spark')))
+
+    assert 'Resuming download at byte 5500.' in capsys.readouterr().err
+    assert path.read_binary() == contents
+    assert tmpdir.join('spark', 'RELEASE').size() == 20000
+
+
+def test_rank_mirrors(artifact_server):
+    fetch_artifact_module = load_script('fetch-artifact')
+    served_dir, seed_url = artifact_server
+    write_artifact(served_dir.join('hadoop.tgz'))
+    dead_mirror = 'http://127.0.0.1:{p}/'.format(p=get_free_port())
+
+    ranked_urls = fetch_artifact_module.rank_mirrors({
+        'preferred': dead_mirror,
+        'http': [dead_mirror, seed_url + '/'],
+        'path_info': 'hadoop.tgz',
+    })
+
+    assert ranked_urls == [seed_url + '/hadoop.tgz']
+
+
+def test_source_urls_come_from_seed(tmpdir, artifact_server):
+    fetch_artifact_module = load_script('fetch-artifact')
+    served_dir, seed_url = artifact_server
+    mirror_urls = ['http://fast.example.com/hadoop.tgz', 'http://slow.example.com/hadoop.tgz']
+    served_dir.join('hadoop.tgz.mirrors').write('\n'.join(mirror_urls))
+    mirrors_path = tmpdir.join('hadoop.tgz.mirrors')
+
+    source_urls = fetch_artifact_module.get_source_urls(
+        'http://closer.example.com/hadoop.tgz?as_json',
+        str(mirrors_path),
+        seed_url)
+
+    assert source_urls == mirror_urls
+    assert mirrors_path.read().split() == mirror_urls
+
+
+@pytest.mark.parametrize(
+    'text', [
+        '{d}  spark-2.3.1-bin-hadoop2.7.tgz\n',
+        'spark-2.3.1-bin-hadoop2.7.tgz: {gpg}\n',
+    ])
+def test_parse_sha512(text):
+    fetch_artifact_module = load_script('fetch-artifact')
+    digest = hashlib.sha512(b'spark').hexdigest()
+    gpg_digest = '\n'.join(
+        ' '.join(digest[i:i + 8] for i in range(j, j + 64, 8))
+        for j in range(0, 128, 64)).upper()
+
+    assert fetch_artifact_module.parse_sha512(text.format(d=digest, gpg=gpg_digest)) == digest
+
+
+def test_fetch_artifact_checks_sha512(tmpdir, artifact_server):
+    served_dir, seed_url = artifact_server
+    source_path = tmpdir.join('source.tgz')
+    write_artifact(source_path, contents=b'intact')
+    sha512 = hashlib.sha512(source_path.read_binary()).hexdigest()
+    # The seed's copy is a perfectly good tarball, but it's not the one the
+    # checksum is for.
+    write_artifact(served_dir.join('spark.tgz'), contents=b'tampered')
+    served_dir.join('spark.tgz.sha512').write(sha512)
+    artifacts_dir = tmpdir.join('artifacts')
+
+    ret = fetch_artifact(
+        'file://' + str(source_path), artifacts_dir, 'spark.tgz',
+        '--seed-url', seed_url,
+        '--extract-to', tmpdir.join('spark'))
+
+    assert ret == 0
+    assert artifacts_dir.join('spark.tgz').read_binary() == source_path.read_binary()
+    assert tmpdir.join('spark', 'RELEASE').read_binary() == b'intact'
+    assert artifacts_dir.join('spark.tgz.sha512').read().strip() == sha512
+
+
+def test_fetch_artifact_gets_published_sha512(tmpdir):
+    source_path = tmpdir.join('source.tgz')
+    write_artifact(source_path)
+    tmpdir.join('source.tgz.sha512').write(
+        '{d}  source.tgz\n'.format(d=hashlib.sha512(b'something else').hexdigest()))
+    artifacts_dir = tmpdir.join('artifacts')
+
+    ret = fetch_artifact(
+        'file://' + str(source_path), artifacts_dir, 'spark.tgz',
+        '--checksum-url', 'file://' + str(tmpdir.join('missing.sha512')),
+        '--checksum-url', 'file://' + str(tmpdir.join('source.tgz.sha512')))
+
+    assert ret != 0
+    assert not artifacts_dir.join('spark.tgz').check()
+
+
+def test_fetch_artifact_marks_failure(tmpdir):
+    artifacts_dir = tmpdir.join('artifacts')
+
+    ret = fetch_artifact('file:///does/not/exist', artifacts_dir, 'spark.tgz')
+
+    assert ret != 0
+    assert artifacts_dir.join('spark.tgz.failed').check()
+    assert not artifacts_dir.join('spark.tgz').check()
+
+
+def test_distribute_file(tmpdir):
+    # Stand in for ssh and scp so we can see who copies the file where.
+    bin_dir = tmpdir.mkdir('bin')
+    log_path = tmpdir.join('copies.log')
+    for command in ['ssh', 'scp']:
+        bin_dir.join(command).write(
+            '#!/bin/bash\n'
+            'echo "{c} $*" >> {l}\n'.format(c=command, l=log_path))
+        bin_dir.join(command).chmod(0o755)
+
+    hosts = ['10.0.0.{n}'.format(n=n) for n in range(2, 9)]
+    subprocess.check_call(
+        ['bash', os.path.join(SCRIPTS_DIR, 'distribute-file.sh'), '/tmp/file.txt'] + hosts,
+        env=dict(os.environ, PATH=str(bin_dir) + os.pathsep + os.environ['PATH']))
+
+    copies = [
+        line.split() for line in log_path.read().splitlines()
+        if 'test -d' not in line]
+    targets = [copy[-1].split(':')[0] for copy in copies]
+    assert sorted(targets) == hosts
+    # This node makes one copy per round. Hosts that already have the file
+    # take care of the rest, so 8 nodes need only 3 rounds.
+    assert sum(copy[0] == 'scp' for copy in copies) == 3
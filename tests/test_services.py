@@ -0,0 +1,52 @@
+import pytest
+
+# Flintrock modules
+from flintrock.services import (
+    HDFS,
+    Spark,
+    SPARK_MAX_WORKER_MEMORY_MB,
+    get_spark_worker_layout,
+    get_hdfs_profile,
+)
+
+
+@pytest.mark.parametrize(
+    'cores, memory_mb, expected_instances', [
+        (1, 3840, 1),     # m3.medium
+        (4, 15360, 1),    # m3.xlarge
+        (32, 249856, 8),  # r4.8xlarge
+        (96, 786432, 24),
+    ])
+def test_spark_worker_layout(cores, memory_mb, expected_instances):
+    layout = get_spark_worker_layout(cores=cores, memory_mb=memory_mb)
+
+    assert layout.instances == expected_instances
+    assert layout.instances * layout.cores == cores
+    assert layout.memory_mb <= SPARK_MAX_WORKER_MEMORY_MB
+    assert layout.instances * layout.memory_mb < memory_mb
+
+
+@pytest.mark.parametrize('num_slaves', [0, 1, 2, 10, 500])
+def test_hdfs_profile(num_slaves):
+    profile = get_hdfs_profile(num_slaves=num_slaves)
+
+    assert 1 <= profile['dfs.replication'] <= max(1, min(3, num_slaves))
+    assert profile['dfs.namenode.handler.count'] >= 10
+    assert profile['dfs.datanode.handler.count'] >= 10
+
+
+def test_checksum_urls():
+    hdfs = HDFS(
+        version='2.8.5',
+        download_source='http://www.apache.org/dyn/closer.lua/hadoop/common/hadoop-{v}/hadoop-{v}.tar.gz?as_json')
+    assert hdfs.checksum_urls == [
+        'https://archive.apache.org/dist/hadoop/common/hadoop-2.8.5/hadoop-2.8.5.tar.gz.sha512']
+
+    spark = Spark(
+        version='2.3.1',
+        hadoop_version='2.8.5',
+        download_source='https://s3.amazonaws.com/spark-related-packages/spark-{v}-bin-hadoop2.6.tgz')
+    assert spark.checksum_urls == [
+        'https://s3.amazonaws.com/spark-related-packages/spark-2.3.1-bin-hadoop2.6.tgz.sha512',
+        'https://archive.apache.org/dist/spark/spark-2.3.1/spark-2.3.1-bin-hadoop2.6.tgz.sha512',
+    ]